@@ -1,5 +1,5 @@
 from sqlalchemy.dialects import registry as _registry
-from .transaction import run_transaction  # noqa
+from .transaction import run_transaction, run_transaction_async, run_transactions  # noqa
 
 __version__ = "2.0.5.dev0"
 
@@ -1,9 +1,22 @@
+import asyncio
+
 from sqlalchemy.dialects.postgresql.asyncpg import PGDialect_asyncpg
+from sqlalchemy.util import await_only
 from .base import CockroachDBDialect
 from .ddl_compiler import CockroachDDLCompiler
 from .stmt_compiler import CockroachCompiler
 from .stmt_compiler import CockroachIdentifierPreparer
 
+# The oldest asyncpg that keeps the tasks of its cancel requests in
+# Connection._cancellations, as far as has been checked.
+_MIN_ASYNCPG_VERSION = (0, 31)
+
+
+def _asyncpg_version():
+    import asyncpg
+
+    return tuple(int(part) for part in asyncpg.__version__.split(".")[:2])
+
 
 class CockroachDBDialect_asyncpg(PGDialect_asyncpg, CockroachDBDialect):
     driver = "asyncpg"  # driver name
@@ -13,9 +26,28 @@ class CockroachDBDialect_asyncpg(PGDialect_asyncpg, CockroachDBDialect):
 
     supports_statement_cache = True
 
+    # The asyncpg adapter translates errors into its own exception
+    # classes but keeps the SQLSTATE around.
+    _sqlstate_attr = "sqlstate"
+
     async def setup_asyncpg_json_codec(self, conn):
         # https://github.com/cockroachdb/cockroach/issues/9990#issuecomment-579202144
         pass
 
+    def _is_cancelled_cleanly(self, dbapi_connection):
+        conn = dbapi_connection.driver_connection
+        # asyncpg sends the cancel request from a background task, which
+        # terminates the connection if the request fails. Wait for it so
+        # that the connection is idle by the time it is checked in. The
+        # tasks are private to asyncpg; if they aren't where the versions
+        # this was checked with keep them, the connection is discarded.
+        cancellations = getattr(conn, "_cancellations", None)
+        if cancellations is None or _asyncpg_version() < _MIN_ASYNCPG_VERSION:
+            return False
+        cancellations = list(cancellations)
+        if cancellations:
+            await_only(asyncio.wait(cancellations))
+        return not conn.is_closed()
+
     def get_isolation_level_values(self, dbapi_conn):
         return ("SERIALIZABLE", "AUTOCOMMIT", "READ COMMITTED")
@@ -1,12 +1,14 @@
-import collections
+import asyncio
+import contextvars
 import re
-import threading
+from sqlalchemy import event
 from sqlalchemy import text
 from sqlalchemy.dialects.postgresql.base import PGDialect
 from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.dialects.postgresql import INET
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.engine.reflection import cache
 from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.util import warn
 
@@ -14,6 +16,8 @@ import sqlalchemy.types as sqltypes
 
 from .stmt_compiler import CockroachCompiler, CockroachIdentifierPreparer
 from .ddl_compiler import CockroachDDLCompiler
+from .reflection import cached_reflection
+from .retry import RetryClassifier
 
 
 # Map type names (as returned by information_schema) to sqlalchemy type
@@ -65,7 +69,11 @@ _type_map = {
 }
 
 
-class _SavepointState(threading.local):
+_cockroach_restart = contextvars.ContextVar("cockroach_restart", default=False)
+_commit_on_release = contextvars.ContextVar("commit_on_release", default=False)
+
+
+class _SavepointState:
     """Hack to override names used in savepoint statements.
 
     To get the Session to do the right thing with transaction retries,
@@ -73,17 +81,68 @@ class _SavepointState(threading.local):
     need to transform the savepoint statements that are a part of this
     retry loop, while leaving other savepoints alone. Unfortunately
     the interface leaves us with no way to pass this information along
-    except via a thread-local variable.
+    except via a context variable, which is local to each thread and to
+    each asyncio task (SQLAlchemy runs the statements of an asyncio task
+    in a greenlet that shares its context).
+
+    ``commit_on_release`` tells the dialect that the release of the
+    cockroach_restart savepoint is the last statement of the transaction,
+    so that it can send the COMMIT along with it.
     """
 
-    def __init__(self):
-        self.cockroach_restart = False
+    @property
+    def cockroach_restart(self):
+        return _cockroach_restart.get()
+
+    @cockroach_restart.setter
+    def cockroach_restart(self, value):
+        _cockroach_restart.set(value)
+
+    @property
+    def commit_on_release(self):
+        return _commit_on_release.get()
+
+    @commit_on_release.setter
+    def commit_on_release(self, value):
+        _commit_on_release.set(value)
 
 
 savepoint_state = _SavepointState()
 
 
-class CockroachDBDialect(PGDialect):
+def _keep_cancelled_connection(context):
+    """Keep the connection of a query whose asyncio task was cancelled.
+
+    SQLAlchemy discards the connection of a statement interrupted by
+    CancelledError, since it can't know what state the connection is in.
+    The async drivers send a cancel request to the server when the task
+    awaiting a query is cancelled, though, and the dialect can tell
+    whether that left the connection usable. If so, it goes back to the
+    pool once rolled back instead of being closed.
+    """
+    conn = context.connection
+    if (
+        isinstance(context.original_exception, asyncio.CancelledError)
+        and context.is_disconnect
+        and conn is not None
+        and not conn.closed
+        and not conn.invalidated
+        and context.dialect._is_cancelled_cleanly(conn.connection.dbapi_connection)
+    ):
+        context.is_disconnect = False
+
+
+class _CockroachDBArguments:
+    # create_engine() only passes a dialect the keyword arguments that an
+    # __init__ of its class or bases takes positionally. CockroachDBDialect
+    # takes its own keyword-only, so that positional arguments still reach
+    # PGDialect, and names them here instead. This __init__ isn't called:
+    # DefaultDialect's doesn't call super().__init__().
+    def __init__(self, retry_predicates=(), reflection_cache=None, **kwargs):
+        raise NotImplementedError()
+
+
+class CockroachDBDialect(PGDialect, _CockroachDBArguments):
     name = "cockroachdb"
     supports_empty_insert = True
     supports_multivalues_insert = True
@@ -92,6 +151,14 @@ class CockroachDBDialect(PGDialect):
     preparer = CockroachIdentifierPreparer
     ddl_compiler = CockroachDDLCompiler
 
+    # The attribute that holds the SQLSTATE on the driver's exceptions.
+    _sqlstate_attr = "pgcode"
+
+    # Whether the driver can send RELEASE SAVEPOINT and COMMIT as one query,
+    # and then skips its own COMMIT because the server reports that no
+    # transaction is in progress.
+    _supports_release_and_commit = False
+
     # Override connect so we can take disable_cockroachdb_telemetry as a connect_arg to sqlalchemy.
     # The option is not used any more, but removing it is a backwards-incompatible change.
     def connect(
@@ -101,7 +168,7 @@ class CockroachDBDialect(PGDialect):
     ):
         return super().connect(**kwargs)
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, retry_predicates=(), reflection_cache=None, **kwargs):
         if kwargs.get("use_native_hstore", False):
             raise NotImplementedError("use_native_hstore is not supported")
         if kwargs.get("server_side_cursors", False):
@@ -109,6 +176,26 @@ class CockroachDBDialect(PGDialect):
         kwargs["use_native_hstore"] = False
         kwargs["server_side_cursors"] = False
         super().__init__(*args, **kwargs)
+        # Extra predicates for run_transaction() to decide whether an
+        # error can be retried. See retry.RetryClassifier.
+        self.retry_predicates = list(retry_predicates)
+        # A reflection.ReflectionCache, possibly shared with other engines.
+        self.reflection_cache = reflection_cache
+
+    @classmethod
+    def engine_created(cls, engine):
+        if cls.is_async:
+            event.listen(engine, "handle_error", _keep_cancelled_connection)
+
+    def _is_cancelled_cleanly(self, dbapi_connection):
+        """Return whether ``dbapi_connection`` can be reused after the
+        cancellation of the asyncio task that was running a query on it.
+
+        Called by the async dialects, from the task, after the driver has
+        seen the CancelledError. Connections are discarded unless the
+        driver's dialect knows better.
+        """
+        return False
 
     def initialize(self, connection):
         # Bypass PGDialect's initialize implementation, which looks at
@@ -146,6 +233,9 @@ class CockroachDBDialect(PGDialect):
         self._supports_savepoints = self._is_v201plus
         self.supports_native_enum = self._is_v202plus
         self.supports_identity_columns = True
+        # Resolve the retry classifier once so that run_transaction() doesn't
+        # have to import driver modules every time a transaction fails.
+        self._retry_classifier = RetryClassifier(self._sqlstate_attr, self.retry_predicates)
 
     def _get_server_version_info(self, conn):
         # PGDialect expects a postgres server version number here,
@@ -153,6 +243,7 @@ class CockroachDBDialect(PGDialect):
         # used.
         return (9, 5, 0)
 
+    @cache
     def get_table_names(self, conn, schema=None, **kw):
         # Upstream implementation needs correlated subqueries.
 
@@ -169,36 +260,64 @@ class CockroachDBDialect(PGDialect):
             )
         ]
 
-    def has_table(self, conn, table, schema=None, info_cache=None):
+    @cache
+    def has_table(self, conn, table_name, schema=None, **kw):
         # Upstream implementation needs pg_table_is_visible().
-        return any(t == table for t in self.get_table_names(conn, schema=schema))
-
+        self._ensure_has_table_connection(conn)
+        if not self._is_v2plus:
+            return table_name in self.get_table_names(conn, schema=schema)
+
+        schema = schema or self.default_schema_name
+        info_cache = kw.get("info_cache")
+        key = ("cockroachdb_has_table", schema)
+        if info_cache is not None and key in info_cache:
+            # A second check through the same Inspector, as Alembic makes
+            # for each table: list the schema once, and let the Inspector
+            # cache the listing for the checks after this one. A single
+            # check stays a point query.
+            return table_name in self.get_table_names(conn, schema=schema, info_cache=info_cache)
+
+        found = conn.execute(
+            text(
+                "SELECT 1 FROM information_schema.tables "
+                "WHERE table_schema = :schema AND table_name = :table_name"
+            ),
+            {"schema": schema, "table_name": table_name},
+        ).first()
+        if info_cache is not None:
+            info_cache[key] = True
+        return found is not None
+
+    @cached_reflection
     def get_multi_columns(self, connection, schema, filter_names, scope, kind, **kw):
-        if not filter_names:
-            filter_names = self.get_table_names(connection, schema)
-        return {
-            (schema, table_name): self.get_columns(connection, table_name, schema, **kw)
-            for table_name in filter_names
-        }
+        # Reflect all the tables with one query rather than one per table.
+        if filter_names:
+            table_names = list(filter_names)
+            where = "AND table_name = ANY(:table_names) "
+        else:
+            table_names = self.get_table_names(connection, schema)
+            where = ""
+        rows = connection.execute(
+            text(self._columns_query(where, kw.get("include_hidden", False))),
+            {"table_schema": schema or self.default_schema_name, "table_names": table_names},
+        )
+        result = {(schema, table_name): [] for table_name in table_names}
+        for row in rows:
+            columns = result.get((schema, row.table_name))
+            if columns is not None:
+                columns.append(self._get_column_info(row, schema))
+        return result
 
-    # The upstream implementations of the reflection functions below depend on
-    # correlated subqueries which are not yet supported.
-    def get_columns(self, conn, table_name, schema=None, **kw):
-        _include_hidden = kw.get("include_hidden", False)
+    def _columns_query(self, where, include_hidden):
         if not self._is_v191plus:
             # v2.x does not have is_generated or generation_expression
             sql = (
                 "SELECT column_name, data_type, is_nullable::bool, column_default,"
                 "numeric_precision, numeric_scale, character_maximum_length, "
                 "NULL AS is_generated, NULL AS generation_expression, is_hidden::bool,"
-                "column_comment AS comment "
+                "column_comment AS comment, table_name "
                 "FROM information_schema.columns "
-                "WHERE table_schema = :table_schema AND table_name = :table_name "
-            )
-            sql += "" if _include_hidden else "AND NOT is_hidden::bool"
-            rows = conn.execute(
-                text(sql),
-                {"table_schema": schema or self.default_schema_name, "table_name": table_name},
+                "WHERE table_schema = :table_schema "
             )
         else:
             # v19.1 or later. Information schema columns are all usable.
@@ -207,152 +326,162 @@ class CockroachDBDialect(PGDialect):
                 "numeric_precision, numeric_scale, character_maximum_length, "
                 "CASE is_generated WHEN 'ALWAYS' THEN true WHEN 'NEVER' THEN false "
                 "ELSE is_generated::bool END AS is_generated, "
-                "generation_expression, is_hidden::bool, crdb_sql_type, column_comment AS comment "
+                "generation_expression, is_hidden::bool, crdb_sql_type, column_comment AS comment, "
+                "table_name "
                 "FROM information_schema.columns "
-                "WHERE table_schema = :table_schema AND table_name = :table_name "
-            )
-            sql += "" if _include_hidden else "AND NOT is_hidden::bool"
-            rows = conn.execute(
-                text(sql),
-                {"table_schema": schema or self.default_schema_name, "table_name": table_name},
+                "WHERE table_schema = :table_schema "
             )
+        sql += where
+        sql += "" if include_hidden else "AND NOT is_hidden::bool "
+        return sql + "ORDER BY table_name, ordinal_position"
 
-        res = []
-        for row in rows:
-            name, type_str, nullable, default = row[:4]
-            if type_str == "ARRAY":
-                is_array = True
-                type_str, _ = row.crdb_sql_type.split("[", maxsplit=1)
-            else:
-                is_array = False
-            # When there are type parameters, attach them to the
-            # returned type object.
-            m = re.match(r"^(\w+(?: \w+)*)(?:\(([0-9, ]*)\))?$", type_str)
-            if m is None:
-                warn("Could not parse type name '%s'" % type_str)
-                typ = sqltypes.NULLTYPE
+    # The upstream implementations of the reflection functions below depend on
+    # correlated subqueries which are not yet supported.
+    def get_columns(self, conn, table_name, schema=None, **kw):
+        sql = self._columns_query("AND table_name = :table_name ", kw.get("include_hidden", False))
+        rows = conn.execute(
+            text(sql),
+            {"table_schema": schema or self.default_schema_name, "table_name": table_name},
+        )
+        return [self._get_column_info(row, schema) for row in rows]
+
+    def _get_column_info(self, row, schema):
+        """Turn a row of :meth:`_columns_query` into a column_info dict."""
+        name, type_str, nullable, default = row[:4]
+        if type_str == "ARRAY":
+            is_array = True
+            type_str, _ = row.crdb_sql_type.split("[", maxsplit=1)
+        else:
+            is_array = False
+        # When there are type parameters, attach them to the
+        # returned type object.
+        m = re.match(r"^(\w+(?: \w+)*)(?:\(([0-9, ]*)\))?$", type_str)
+        if m is None:
+            warn("Could not parse type name '%s'" % type_str)
+            typ = sqltypes.NULLTYPE
+        else:
+            type_name, type_args = m.groups()
+            try:
+                type_class = _type_map[type_name.lower()]
+            except KeyError:
+                warn(f"Did not recognize type '{type_name}' of column '{name}'")
+                type_class = sqltypes.NULLTYPE
+            if type_args:
+                typ = type_class(*[int(s.strip()) for s in type_args.split(",")])
+            elif type_class is sqltypes.DECIMAL:
+                typ = type_class(
+                    precision=row.numeric_precision,
+                    scale=row.numeric_scale,
+                )
+            elif type_class is sqltypes.VARCHAR or type_class is sqltypes.CHAR:
+                typ = type_class(length=row.character_maximum_length)
             else:
-                type_name, type_args = m.groups()
-                try:
-                    type_class = _type_map[type_name.lower()]
-                except KeyError:
-                    warn(f"Did not recognize type '{type_name}' of column '{name}'")
-                    type_class = sqltypes.NULLTYPE
-                if type_args:
-                    typ = type_class(*[int(s.strip()) for s in type_args.split(",")])
-                elif type_class is sqltypes.DECIMAL:
-                    typ = type_class(
-                        precision=row.numeric_precision,
-                        scale=row.numeric_scale,
+                typ = type_class
+        if row.is_generated:
+            # Currently, all computed columns are persisted.
+            computed = dict(sqltext=row.generation_expression, persisted=True)
+            default = None
+        else:
+            computed = None
+        # Check if a sequence is being used and adjust the default value.
+        autoincrement = False
+        if default is not None:
+            nextval_match = re.search(r"""(nextval\(')([^']+)('.*$)""", default)
+            unique_rowid_match = re.search(r"""unique_rowid\(""", default)
+            if nextval_match is not None or unique_rowid_match is not None:
+                if issubclass(type_class, sqltypes.Integer):
+                    autoincrement = True
+                # the default is related to a Sequence
+                sch = schema
+                if (
+                    nextval_match is not None
+                    and "." not in nextval_match.group(2)
+                    and sch is not None
+                ):
+                    # unconditionally quote the schema name.  this could
+                    # later be enhanced to obey quoting rules /
+                    # "quote schema"
+                    default = (
+                        nextval_match.group(1)
+                        + ('"%s"' % sch)
+                        + "."
+                        + nextval_match.group(2)
+                        + nextval_match.group(3)
                     )
-                elif type_class is sqltypes.VARCHAR or type_class is sqltypes.CHAR:
-                    typ = type_class(length=row.character_maximum_length)
-                else:
-                    typ = type_class
-            if row.is_generated:
-                # Currently, all computed columns are persisted.
-                computed = dict(sqltext=row.generation_expression, persisted=True)
-                default = None
-            else:
-                computed = None
-            # Check if a sequence is being used and adjust the default value.
-            autoincrement = False
-            if default is not None:
-                nextval_match = re.search(r"""(nextval\(')([^']+)('.*$)""", default)
-                unique_rowid_match = re.search(r"""unique_rowid\(""", default)
-                if nextval_match is not None or unique_rowid_match is not None:
-                    if issubclass(type_class, sqltypes.Integer):
-                        autoincrement = True
-                    # the default is related to a Sequence
-                    sch = schema
-                    if (
-                        nextval_match is not None
-                        and "." not in nextval_match.group(2)
-                        and sch is not None
-                    ):
-                        # unconditionally quote the schema name.  this could
-                        # later be enhanced to obey quoting rules /
-                        # "quote schema"
-                        default = (
-                            nextval_match.group(1)
-                            + ('"%s"' % sch)
-                            + "."
-                            + nextval_match.group(2)
-                            + nextval_match.group(3)
-                        )
-
-            column_info = dict(
-                name=name,
-                type=ARRAY(typ) if is_array else typ,
-                nullable=nullable,
-                default=default,
-                autoincrement=autoincrement,
-                is_hidden=row.is_hidden,
-                comment=row.comment,
-            )
-            if computed is not None:
-                column_info["computed"] = computed
-            res.append(column_info)
-        return res
+
+        column_info = dict(
+            name=name,
+            type=ARRAY(typ) if is_array else typ,
+            nullable=nullable,
+            default=default,
+            autoincrement=autoincrement,
+            is_hidden=row.is_hidden,
+            comment=row.comment,
+        )
+        if computed is not None:
+            column_info["computed"] = computed
+        return column_info
 
     def get_indexes(self, conn, table_name, schema=None, **kw):
-        if self._is_v192plus:
-            indexes = super().get_indexes(conn, table_name, schema, **kw)
-            # CockroachDB creates a UNIQUE INDEX automatically for each UNIQUE CONSTRAINT, and
-            # there is no difference between unique indexes and unique constraints.  We need
-            # to remove the `duplicates_constraints` value from unique indexes, otherwise
-            # alembic tries to delete and recreate unique indexes.  This is consistent with
-            # postgresql which doesn't set the duplicates_constraint flag on unique indexes
-            for index in indexes:
-                if index["unique"] and "duplicates_constraint" in index:
-                    del index["duplicates_constraint"]
-            return indexes
-
-        # The Cockroach database creates a UNIQUE INDEX implicitly whenever the
-        # UNIQUE CONSTRAINT construct is used. Currently we are just ignoring all unique indexes,
-        # but we might need to return them and add an additional key `duplicates_constraint` if
-        # it is detected as mirroring a constraint.
-        # https://www.cockroachlabs.com/docs/stable/unique.html
-        # https://github.com/sqlalchemy/sqlalchemy/blob/55f930ef3d4e60bed02a2dad16e331fe42cfd12b/lib/sqlalchemy/dialects/postgresql/base.py#L723
+        indexes = super().get_indexes(conn, table_name, schema, **kw)
+        # CockroachDB creates a UNIQUE INDEX automatically for each UNIQUE CONSTRAINT, and
+        # there is no difference between unique indexes and unique constraints.  We need
+        # to remove the `duplicates_constraints` value from unique indexes, otherwise
+        # alembic tries to delete and recreate unique indexes.  This is consistent with
+        # postgresql which doesn't set the duplicates_constraint flag on unique indexes
+        for index in indexes:
+            if index["unique"] and "duplicates_constraint" in index:
+                del index["duplicates_constraint"]
+        return indexes
+
+    def _get_legacy_indexes(self, conn, schema, filter_names):
+        """Return the indexes of the tables of ``schema`` by (schema, table
+        name), for versions that can't run the upstream reflection queries.
+
+        Each index is a dict of name, column_names and unique, in the order
+        CockroachDB lists them, which puts the primary key first. All the
+        tables are read with a single query.
+        """
+        if filter_names:
+            table_names = list(filter_names)
+            where = "AND table_name = ANY(:table_names)"
+        else:
+            table_names = self.get_table_names(conn, schema)
+            where = ""
         q = """
             SELECT
+                table_name,
                 index_name,
                 column_name,
                 (not non_unique::bool) as unique,
-                implicit::bool as implicit
+                implicit::bool as implicit,
+                storing::bool as storing
             FROM
                 information_schema.statistics
             WHERE
                 table_schema = :table_schema
-                AND table_name = :table_name
-        """
+                %s
+        """ % (
+            where,
+        )
         rows = conn.execute(
             text(q),
-            {"table_schema": (schema or self.default_schema_name), "table_name": table_name},
+            {"table_schema": (schema or self.default_schema_name), "table_names": table_names},
         )
-        indexes = collections.defaultdict(list)
+        indexes = {table_name: {} for table_name in table_names}
         for row in rows:
-            if row.implicit or row.unique:
+            table = indexes.get(row.table_name)
+            if table is None or row.implicit or row.storing:
                 continue
-            indexes[row.index_name].append(row)
-
-        result = []
-        for name, rows in indexes.items():
-            result.append(
-                {
-                    "name": name,
-                    "column_names": [r.column_name for r in rows],
-                    "unique": False,
-                }
-            )
-        return result
-
-    def get_multi_indexes(
-        self, connection, schema, filter_names, scope, kind, **kw
-    ):
-        result = super().get_multi_indexes(
-            connection, schema, filter_names, scope, kind, **kw
-        )
+            index = table.get(row.index_name)
+            if index is None:
+                index = table[row.index_name] = dict(
+                    name=row.index_name, column_names=[], unique=row.unique
+                )
+            index["column_names"].append(row.column_name)
+        return {(schema, table_name): list(idxs.values()) for table_name, idxs in indexes.items()}
+
+    def _without_postgis_tables(self, schema, result):
         if schema is None:
             result = dict(result)
             for k in [
@@ -363,75 +492,93 @@ class CockroachDBDialect(PGDialect):
                 result.pop(k, None)
         return result
 
-    def get_pk_constraint(self, conn, table_name, schema=None, **kw):
+    @cached_reflection
+    def get_multi_indexes(
+        self, connection, schema, filter_names, scope, kind, **kw
+    ):
+        if self._is_v192plus:
+            result = super().get_multi_indexes(
+                connection, schema, filter_names, scope, kind, **kw
+            )
+        else:
+            # The Cockroach database creates a UNIQUE INDEX implicitly whenever the
+            # UNIQUE CONSTRAINT construct is used. Currently we are just ignoring all unique
+            # indexes, but we might need to return them and add an additional key
+            # `duplicates_constraint` if it is detected as mirroring a constraint.
+            # https://www.cockroachlabs.com/docs/stable/unique.html
+            # https://github.com/sqlalchemy/sqlalchemy/blob/55f930ef3d4e60bed02a2dad16e331fe42cfd12b/lib/sqlalchemy/dialects/postgresql/base.py#L723
+            result = {
+                key: [index for index in idxs if not index["unique"]]
+                for key, idxs in self._get_legacy_indexes(connection, schema, filter_names).items()
+            }
+        return self._without_postgis_tables(schema, result)
+
+    @cached_reflection
+    def get_multi_pk_constraint(self, connection, schema, filter_names, scope, kind, **kw):
         if self._is_v21plus:
-            return super().get_pk_constraint(conn, table_name, schema, **kw)
+            result = super().get_multi_pk_constraint(
+                connection, schema, filter_names, scope, kind, **kw
+            )
+            return self._without_postgis_tables(schema, result)
 
         # v2.0 does not know about enough SQL to understand the query done by
         # the upstream dialect. So run a dumbed down version instead.
-        idxs = self.get_indexes(conn, table_name, schema=schema, **kw)
-        if len(idxs) == 0:
-            # virtual table. No constraints.
-            return {}
-        # The PK is always first in the index list; it may not always
-        # be named "primary".
-        pk = idxs[0]
-        res = dict(constrained_columns=pk["column_names"])
-        # The SQLAlchemy tests expect that the name field is only
-        # present if the PK was explicitly renamed by the user.
-        # Checking for a name of "primary" is an imperfect proxy for
-        # this but is good enough to pass the tests.
-        if pk["name"] != "primary":
-            res["name"] = pk["name"]
-        return res
-
-    def get_multi_pk_constraint(self, connection, schema, filter_names, scope, kind, **kw):
-        result = super().get_multi_pk_constraint(
-            connection, schema, filter_names, scope, kind, **kw
-        )
-        if schema is None:
-            result = dict(result)
-            for k in [
-                (None, "spatial_ref_sys"),
-                (None, "geometry_columns"),
-                (None, "geography_columns"),
-            ]:
-                result.pop(k, None)
-        return result
-
-    def get_unique_constraints(self, conn, table_name, schema=None, **kw):
+        result = {}
+        for key, idxs in self._get_legacy_indexes(connection, schema, filter_names).items():
+            if len(idxs) == 0:
+                # virtual table. No constraints.
+                result[key] = {}
+                continue
+            # The PK is always first in the index list; it may not always
+            # be named "primary".
+            pk = idxs[0]
+            res = dict(constrained_columns=pk["column_names"])
+            # The SQLAlchemy tests expect that the name field is only
+            # present if the PK was explicitly renamed by the user.
+            # Checking for a name of "primary" is an imperfect proxy for
+            # this but is good enough to pass the tests.
+            if pk["name"] != "primary":
+                res["name"] = pk["name"]
+            result[key] = res
+        return self._without_postgis_tables(schema, result)
+
+    @cached_reflection
+    def get_multi_unique_constraints(
+        self, connection, schema, filter_names, scope, kind, **kw
+    ):
         if self._is_v21plus:
-            return super().get_unique_constraints(conn, table_name, schema, **kw)
+            result = super().get_multi_unique_constraints(
+                connection, schema, filter_names, scope, kind, **kw
+            )
+            return self._without_postgis_tables(schema, result)
 
         # v2.0 does not know about enough SQL to understand the query done by
         # the upstream dialect. So run a dumbed down version instead.
-        res = []
         # Skip the primary key which is always first in the list.
-        idxs = self.get_indexes(conn, table_name, schema=schema, **kw)
-        if len(idxs) == 0:
-            # virtual table. No constraints.
-            return res
-        for index in idxs[1:]:
-            if index["unique"]:
-                del index["unique"]
-                res.append(index)
-        return res
+        result = {
+            key: [
+                dict(name=index["name"], column_names=index["column_names"])
+                for index in idxs[1:]
+                if index["unique"]
+            ]
+            for key, idxs in self._get_legacy_indexes(connection, schema, filter_names).items()
+        }
+        return self._without_postgis_tables(schema, result)
 
+    @cached_reflection
+    def get_multi_foreign_keys(self, connection, schema, filter_names, scope, kind, **kw):
+        return super().get_multi_foreign_keys(
+            connection, schema, filter_names, scope, kind, **kw
+        )
+
+    @cached_reflection
     def get_multi_check_constraints(
         self, connection, schema, filter_names, scope, kind, **kw
     ):
         result = super().get_multi_check_constraints(
             connection, schema, filter_names, scope, kind, **kw
         )
-        if schema is None:
-            result = dict(result)
-            for k in [
-                (None, "spatial_ref_sys"),
-                (None, "geometry_columns"),
-                (None, "geography_columns"),
-            ]:
-                result.pop(k, None)
-        return result
+        return self._without_postgis_tables(schema, result)
 
     def do_savepoint(self, connection, name):
         # Savepoint logic customized to work with run_transaction().
@@ -450,7 +597,12 @@ class CockroachDBDialect(PGDialect):
     def do_release_savepoint(self, connection, name):
         # Savepoint logic customized to work with run_transaction().
         if savepoint_state.cockroach_restart:
-            connection.execute(text("RELEASE SAVEPOINT cockroach_restart"))
+            if savepoint_state.commit_on_release and self._supports_release_and_commit:
+                # Save a round trip. The driver's own commit() that follows
+                # finds no transaction in progress and does nothing.
+                connection.exec_driver_sql("RELEASE SAVEPOINT cockroach_restart; COMMIT")
+            else:
+                connection.execute(text("RELEASE SAVEPOINT cockroach_restart"))
         else:
             super().do_release_savepoint(connection, name)
 
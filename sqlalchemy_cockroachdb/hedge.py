@@ -0,0 +1,396 @@
+"""Hedged reads across several gateway nodes.
+
+A latency-critical read that lands on a slow gateway node, e.g. one in a
+GC pause or serving a hot range, waits for that node alone. A hedged
+read sends the query to a second node when the first hasn't answered
+within a delay taken from a percentile of recent latencies, returns
+whichever result comes first, and cancels the other query::
+
+    hedged = HedgedReads.from_engine(engine)
+    row = hedged.run(lambda conn: conn.execute(stmt).one())
+
+Only read-only callbacks may be hedged, since both may run to
+completion.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import threading
+from time import perf_counter
+
+import sqlalchemy
+import sqlalchemy.ext.asyncio
+
+from .retry import get_retry_classifier
+from .transaction import _callback_name, _transaction_options
+from .transaction import run_transaction, run_transaction_async
+
+
+class _Cancelled(Exception):
+    """Raised in a read that was cancelled before it started."""
+
+
+def _worth_hedging(engine, error):
+    """Whether a read that failed on ``engine`` with ``error`` may succeed on another node.
+
+    Errors that depend on the node, such as timeouts, lost connections and
+    retry errors, are; errors such as constraint violations, or those
+    raised by the callback itself, would just happen again.
+    """
+    if isinstance(error, (TimeoutError, sqlalchemy.exc.TimeoutError)):
+        return True
+    if isinstance(error, sqlalchemy.exc.OperationalError):
+        # Includes failing to connect to the node at all.
+        return True
+    return (
+        isinstance(error, sqlalchemy.exc.DBAPIError)
+        and get_retry_classifier(engine.dialect)(error) is not None
+    )
+
+
+class _RecordedEvents:
+    """A run_transaction() listener that records the events of one of the
+    queries of a hedged read.
+
+    Only the events of the query whose result or error is returned are
+    passed on, so that the caller's listeners see one transaction per
+    read rather than a give-up for every losing query.
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def __getattr__(self, name):
+        if not name.startswith("on_"):
+            raise AttributeError(name)
+        return functools.partial(self._record, name)
+
+    def _record(self, name, *args):
+        self.events.append((name, args))
+
+    def replay(self, listeners):
+        for name, args in self.events:
+            for listener in listeners:
+                getattr(listener, name)(*args)
+
+
+class _HedgedRead:
+    """One of the queries of a hedged read, on one engine."""
+
+    def __init__(self, engine, listeners=()):
+        self.engine = engine
+        self.listeners = listeners
+        self.events = _RecordedEvents()
+        self.started_at = perf_counter()
+        self._lock = threading.Lock()
+        self._dbapi_connection = None
+        self._cancelled = False
+
+    def wrap(self, callback):
+        def read(conn):
+            with self._lock:
+                if self._cancelled:
+                    raise _Cancelled()
+                self._dbapi_connection = conn.connection.dbapi_connection
+            try:
+                return callback(conn)
+            finally:
+                # The connection goes back to the pool after this; it
+                # must not be cancelled once somebody else uses it.
+                with self._lock:
+                    self._dbapi_connection = None
+
+        return read
+
+    def report(self):
+        """Pass the events of this query on to the caller's listeners."""
+        self.events.replay(self.listeners)
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            cancel = getattr(self._dbapi_connection, "cancel", None)
+            if cancel is not None:
+                cancel()
+
+
+class HedgedReads:
+    """Run read-only callbacks on one of ``engines``, hedged on another.
+
+    ``engines`` are Engines, or AsyncEngines for :meth:`run_async`, that
+    connect to different gateway nodes of one cluster. Each read goes to
+    the next engine in turn and, if it hasn't completed after
+    :meth:`delay` seconds or fails, to the one after it as well.
+
+    The delay is the ``percentile`` of the latencies of the last
+    ``window`` reads, clamped between ``min_delay`` and ``max_delay``.
+    Until ``min_samples`` reads have completed it is ``max_delay``.
+
+    The losing query is cancelled with the ``cancel()`` method of the
+    DBAPI connection (psycopg2 and psycopg have one), or by cancelling
+    its task in :meth:`run_async`. The ``reads``, ``hedges``,
+    ``hedge_wins`` and ``cancellations`` counters are available as
+    attributes and through :meth:`stats`.
+
+    :meth:`run` starts the first read of each call on one of
+    ``max_workers`` threads. A slow read keeps its thread until the
+    cancel reaches its node, so the pool should be larger than the
+    number of slow reads expected at once.
+    """
+
+    def __init__(
+        self,
+        engines,
+        percentile=95,
+        min_delay=0.001,
+        max_delay=0.1,
+        window=256,
+        min_samples=20,
+        max_workers=32,
+    ):
+        engines = list(engines)
+        if len(engines) < 2:
+            raise ValueError("hedged reads need at least two engines")
+        if not 0 < percentile < 100 or min_delay < 0 or max_delay < min_delay:
+            raise ValueError(
+                "invalid hedging delay: percentile=%r, min_delay=%r, max_delay=%r"
+                % (percentile, min_delay, max_delay)
+            )
+        self.engines = engines
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.min_samples = min_samples
+        self.max_workers = max_workers
+        self._latencies = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._next = 0
+        self._executor = None
+        self.reads = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.cancellations = 0
+
+    @classmethod
+    def from_engine(cls, engine, engine_kwargs=None, **kwargs):
+        """Create one engine per host of ``engine``'s URL and hedge across them.
+
+        The URL must list several hosts, as in
+        ``cockroachdb://user@/db?host=node1:26257&host=node2:26257``.
+        ``engine_kwargs`` are passed to create_engine() (or to
+        create_async_engine() for an AsyncEngine) for every host, and the
+        remaining arguments to :class:`HedgedReads`. The engines are
+        available as :attr:`engines`, for the caller to dispose of.
+        """
+        is_async = isinstance(engine, sqlalchemy.ext.asyncio.AsyncEngine)
+        url = engine.url
+        hosts, ports = engine.dialect._split_multihost_from_url(url)
+        if hosts is None or len(hosts) < 2:
+            raise ValueError("%s is not configured with several hosts" % (url,))
+        url = url.difference_update_query(["host", "port"])
+        create_engine = (
+            sqlalchemy.ext.asyncio.create_async_engine if is_async else sqlalchemy.create_engine
+        )
+        engines = []
+        for host, port in zip(hosts, ports or (None,) * len(hosts)):
+            query = {"host": host}
+            if port is not None:
+                query["port"] = str(port)
+            engines.append(create_engine(url.update_query_dict(query), **(engine_kwargs or {})))
+        return cls(engines, **kwargs)
+
+    def delay(self):
+        """Return the number of seconds to wait before hedging a read."""
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < self.min_samples:
+            return self.max_delay
+        latency = samples[min(len(samples) - 1, int(len(samples) * self.percentile / 100))]
+        return min(self.max_delay, max(self.min_delay, latency))
+
+    def _pick(self):
+        with self._lock:
+            self.reads += 1
+            first = self._next
+            self._next = (first + 1) % len(self.engines)
+        return self.engines[first], self.engines[(first + 1) % len(self.engines)]
+
+    def _finish(self, winner, hedged, cancelled):
+        winner.report()
+        latency = perf_counter() - winner.started_at
+        with self._lock:
+            self._latencies.append(latency)
+            if hedged:
+                self.hedge_wins += 1
+            self.cancellations += cancelled
+
+    def run(self, callback, **kwargs):
+        """Run ``callback`` with run_transaction(), hedged on a second engine.
+
+        The remaining arguments are passed to run_transaction(); reads run
+        as implicit transactions unless ``implicit=False`` is passed, or an
+        option that needs a transaction, such as ``read_only``.
+        Return the result of the first read that completes. If both fail,
+        the error of the first read is raised. A first read that fails with
+        an error that another node would raise too, such as a constraint
+        violation or an exception from ``callback``, isn't hedged.
+        ``listeners`` only hear of the read whose result or error is
+        returned.
+
+        The first read runs on a worker thread and the hedged one on the
+        calling thread, so that hedging never waits for a worker that is
+        busy with a slow read. A first read that is still queued for a
+        worker when the delay runs out is not started at all.
+        """
+        if not _transaction_options(kwargs):
+            kwargs.setdefault("implicit", True)
+        # Listeners should see the callback, not the wrapper around it.
+        kwargs.setdefault("name", _callback_name(callback))
+        listeners = kwargs.pop("listeners", ())
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = concurrent.futures.ThreadPoolExecutor(
+                        self.max_workers, thread_name_prefix="hedged-read"
+                    )
+        primary, secondary = self._pick()
+        first = _HedgedRead(primary, listeners)
+        future = self._executor.submit(
+            run_transaction, primary, first.wrap(callback), listeners=[first.events], **kwargs
+        )
+        error = None
+        try:
+            result = future.result(timeout=self.delay())
+        except concurrent.futures.TimeoutError:
+            pass
+        except Exception as e:
+            if not _worth_hedging(primary, e):
+                first.report()
+                raise
+            error = e
+        else:
+            self._finish(first, False, 0)
+            return result
+
+        with self._lock:
+            self.hedges += 1
+        hedge = _HedgedRead(secondary, listeners)
+        kwargs["listeners"] = [hedge.events]
+        if error is None and future.cancel():
+            # All the workers are busy with slow reads and the first read
+            # hasn't even started; move it to the second engine.
+            try:
+                result = run_transaction(secondary, hedge.wrap(callback), **kwargs)
+            except Exception:
+                hedge.report()
+                raise
+            self._finish(hedge, True, 1)
+            return result
+        if error is None:
+
+            def first_done(future):
+                if not future.cancelled() and future.exception() is None:
+                    hedge.cancel()
+
+            future.add_done_callback(first_done)
+        try:
+            result = run_transaction(secondary, hedge.wrap(callback), **kwargs)
+        except Exception:
+            if error is None:
+                # The hedged read failed, or was cancelled because the
+                # first one completed.
+                error = future.exception()
+                if error is None:
+                    self._finish(first, False, 1)
+                    return future.result()
+            first.report()
+            raise error
+        cancelled = not future.done()
+        if cancelled:
+            future.cancel()
+            # Sending the cancel request opens a connection to the slow
+            # node, which the caller shouldn't have to wait for.
+            threading.Thread(target=first.cancel, daemon=True).start()
+        self._finish(hedge, True, int(cancelled))
+        return result
+
+    async def run_async(self, callback, **kwargs):
+        """The asyncio counterpart of :meth:`run`, for AsyncEngines.
+
+        ``callback`` is run with run_transaction_async(), and the losing
+        read is cancelled by cancelling its task.
+        """
+        if not _transaction_options(kwargs):
+            kwargs.setdefault("implicit", True)
+        listeners = kwargs.pop("listeners", ())
+        primary, secondary = self._pick()
+        reads = {}
+
+        def submit(engine):
+            read = _HedgedRead(engine, listeners)
+            task = asyncio.ensure_future(
+                run_transaction_async(engine, callback, listeners=[read.events], **kwargs)
+            )
+            reads[task] = read
+
+        submit(primary)
+        (first,) = reads
+        pending = set(reads)
+        timeout = self.delay()
+        error = error_read = None
+        try:
+            while True:
+                done, pending = await asyncio.wait(
+                    pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        if len(reads) == 1 and not _worth_hedging(primary, e):
+                            reads[task].report()
+                            raise
+                        if error is None:
+                            error, error_read = e, reads[task]
+                        continue
+                    cancelled = 0
+                    for other in reads:
+                        if other is not task and not other.done():
+                            other.cancel()
+                            cancelled += 1
+                    self._finish(reads[task], task is not first, cancelled)
+                    return result
+                if len(reads) == 1:
+                    with self._lock:
+                        self.hedges += 1
+                    submit(secondary)
+                    pending = {task for task in reads if not task.done()}
+                    timeout = None
+                elif not pending:
+                    error_read.report()
+                    raise error
+        finally:
+            # The caller was cancelled, or both reads are done: don't leave
+            # a read running on a connection.
+            for task in reads:
+                if not task.done():
+                    task.cancel()
+
+    def stats(self):
+        """Return the counters and the current hedging delay as a dict."""
+        delay = self.delay()
+        with self._lock:
+            return dict(
+                reads=self.reads,
+                hedges=self.hedges,
+                hedge_wins=self.hedge_wins,
+                cancellations=self.cancellations,
+                delay=delay,
+            )
+
+    def close(self):
+        """Shut down the threads that run the reads of :meth:`run`."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
@@ -0,0 +1,201 @@
+"""Instrumentation of the run_transaction() retry loop.
+
+Pass listeners to run_transaction() to be notified of what the retry
+loop does::
+
+    collector = MetricsCollector()
+    run_transaction(engine, callback, listeners=[collector])
+    collector.snapshot()
+
+Transactions are identified by the qualified name of their callback,
+unless a ``name`` is passed to run_transaction().
+"""
+import bisect
+import threading
+
+# Upper bounds, in seconds, of the buckets of the wall time histograms.
+WALL_TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+
+class RetryListener:
+    """Base class for run_transaction() listeners.
+
+    All the hooks do nothing by default. They are called synchronously
+    from the retry loop, possibly from several threads at once, so they
+    should be quick and thread-safe.
+    """
+
+    def on_lock_wait(self, name, seconds):
+        """The transaction waited ``seconds`` for its ``contention_key``."""
+
+    def on_attempt(self, name, attempt):
+        """An attempt is starting. ``attempt`` counts from 1."""
+
+    def on_retry(self, name, attempt, sqlstate):
+        """Attempt number ``attempt`` failed with a retryable error."""
+
+    def on_backoff(self, name, attempt, seconds):
+        """The retry loop is about to sleep before the next attempt."""
+
+    def on_priority(self, name, attempt, priority):
+        """The transaction is restarting at ``priority`` after attempt ``attempt``."""
+
+    def on_give_up(self, name, attempts, elapsed, error):
+        """The transaction failed with ``error`` after ``attempts`` attempts.
+
+        ``error`` is a database error that could not be retried, a
+        TransactionTimeoutError, or any exception raised by the callback,
+        which is never retried. ``elapsed`` is the wall time of the whole
+        call.
+        """
+
+    def on_commit(self, name, attempts, elapsed, commit_latency):
+        """The transaction committed.
+
+        ``elapsed`` is the wall time of the whole call, including retries
+        and back-off, and ``commit_latency`` the time between the last
+        return of the callback and the end of the COMMIT.
+        """
+
+
+class _CallbackMetrics:
+    def __init__(self):
+        self.committed = 0
+        self.failed = 0
+        self.attempts = {}
+        self.retries = {}
+        self.escalations = {}
+        self.wall_time = [0] * len(WALL_TIME_BUCKETS)
+        self.wall_time_total = 0.0
+        self.wall_time_max = 0.0
+        self.backoff_total = 0.0
+        self.commit_latency_total = 0.0
+        self.commit_latency_max = 0.0
+        self.lock_waits = 0
+        self.lock_wait_total = 0.0
+        self.lock_wait_max = 0.0
+
+    def record(self, attempts, elapsed):
+        self.attempts[attempts] = self.attempts.get(attempts, 0) + 1
+        self.wall_time[bisect.bisect_left(WALL_TIME_BUCKETS, elapsed)] += 1
+        self.wall_time_total += elapsed
+        self.wall_time_max = max(self.wall_time_max, elapsed)
+
+    def merge(self, other):
+        self.committed += other.committed
+        self.failed += other.failed
+        for attempts, count in other.attempts.items():
+            self.attempts[attempts] = self.attempts.get(attempts, 0) + count
+        for sqlstate, count in other.retries.items():
+            self.retries[sqlstate] = self.retries.get(sqlstate, 0) + count
+        for priority, count in other.escalations.items():
+            self.escalations[priority] = self.escalations.get(priority, 0) + count
+        self.wall_time = [a + b for a, b in zip(self.wall_time, other.wall_time)]
+        self.wall_time_total += other.wall_time_total
+        self.wall_time_max = max(self.wall_time_max, other.wall_time_max)
+        self.backoff_total += other.backoff_total
+        self.commit_latency_total += other.commit_latency_total
+        self.commit_latency_max = max(self.commit_latency_max, other.commit_latency_max)
+        self.lock_waits += other.lock_waits
+        self.lock_wait_total += other.lock_wait_total
+        self.lock_wait_max = max(self.lock_wait_max, other.lock_wait_max)
+
+    def snapshot(self):
+        return dict(
+            transactions=self.committed + self.failed,
+            committed=self.committed,
+            failed=self.failed,
+            attempts=dict(self.attempts),
+            retries=dict(self.retries),
+            escalations=dict(self.escalations),
+            wall_time=dict(zip(WALL_TIME_BUCKETS, self.wall_time)),
+            wall_time_total=self.wall_time_total,
+            wall_time_max=self.wall_time_max,
+            backoff_total=self.backoff_total,
+            commit_latency_total=self.commit_latency_total,
+            commit_latency_max=self.commit_latency_max,
+            lock_waits=self.lock_waits,
+            lock_wait_total=self.lock_wait_total,
+            lock_wait_max=self.lock_wait_max,
+        )
+
+
+class MetricsCollector(RetryListener):
+    """An in-memory listener that aggregates metrics per transaction name.
+
+    :meth:`snapshot` returns a dict keyed by name. For each name it holds
+    the number of transactions that committed or failed, a histogram of
+    the number of attempts per transaction, the number of retries per
+    SQLSTATE, the number of priority escalations per priority, a histogram
+    of wall times bucketed by :data:`WALL_TIME_BUCKETS`, totals for wall
+    time, back-off and commit latency, and the number of waits for a
+    ``contention_key`` with their total and maximum.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get(self, name):
+        metrics = self._metrics.get(name)
+        if metrics is None:
+            metrics = self._metrics[name] = _CallbackMetrics()
+        return metrics
+
+    def on_lock_wait(self, name, seconds):
+        if seconds <= 0:
+            return
+        with self._lock:
+            metrics = self._get(name)
+            metrics.lock_waits += 1
+            metrics.lock_wait_total += seconds
+            metrics.lock_wait_max = max(metrics.lock_wait_max, seconds)
+
+    def on_retry(self, name, attempt, sqlstate):
+        with self._lock:
+            retries = self._get(name).retries
+            retries[sqlstate] = retries.get(sqlstate, 0) + 1
+
+    def on_backoff(self, name, attempt, seconds):
+        with self._lock:
+            self._get(name).backoff_total += seconds
+
+    def on_priority(self, name, attempt, priority):
+        with self._lock:
+            escalations = self._get(name).escalations
+            escalations[priority] = escalations.get(priority, 0) + 1
+
+    def on_give_up(self, name, attempts, elapsed, error):
+        with self._lock:
+            metrics = self._get(name)
+            metrics.failed += 1
+            metrics.record(attempts, elapsed)
+
+    def on_commit(self, name, attempts, elapsed, commit_latency):
+        with self._lock:
+            metrics = self._get(name)
+            metrics.committed += 1
+            metrics.record(attempts, elapsed)
+            metrics.commit_latency_total += commit_latency
+            metrics.commit_latency_max = max(metrics.commit_latency_max, commit_latency)
+
+    def snapshot(self):
+        """Return the metrics collected so far as a dict."""
+        with self._lock:
+            return {name: metrics.snapshot() for name, metrics in self._metrics.items()}
+
+    def totals(self):
+        """Return the metrics of all the transactions merged into one dict.
+
+        It has the same fields as the per-name dicts of :meth:`snapshot`.
+        """
+        total = _CallbackMetrics()
+        with self._lock:
+            for metrics in self._metrics.values():
+                total.merge(metrics)
+        return total.snapshot()
+
+    def reset(self):
+        """Forget the metrics collected so far."""
+        with self._lock:
+            self._metrics.clear()
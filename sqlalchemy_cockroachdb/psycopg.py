@@ -1,4 +1,5 @@
 from psycopg.crdb import connect as crdb_connect
+from psycopg.pq import TransactionStatus
 from sqlalchemy import util
 from sqlalchemy.dialects.postgresql.psycopg import PGDialect_psycopg, PGDialectAsync_psycopg
 from ._psycopg_common import _CockroachDBDialect_common_psycopg
@@ -15,6 +16,9 @@ class CockroachDBDialect_psycopg(_CockroachDBDialect_common_psycopg, PGDialect_p
 
     supports_statement_cache = True
 
+    _sqlstate_attr = "sqlstate"
+    _supports_release_and_commit = True
+
     @util.memoized_property
     def _psycopg_json(self):
         from psycopg.types import json
@@ -39,6 +43,20 @@ class CockroachDBDialectAsync_psycopg(_CockroachDBDialect_common_psycopg, PGDial
     is_async = True
     supports_statement_cache = True
 
+    _sqlstate_attr = "sqlstate"
+    _supports_release_and_commit = True
+
+    def _is_cancelled_cleanly(self, dbapi_connection):
+        conn = dbapi_connection.driver_connection
+        # psycopg cancels the query and waits for it to stop before letting
+        # the CancelledError through, and closes the connection if it
+        # doesn't stop.
+        return not conn.closed and conn.info.transaction_status in (
+            TransactionStatus.IDLE,
+            TransactionStatus.INTRANS,
+            TransactionStatus.INERROR,
+        )
+
 
 dialect = CockroachDBDialect_psycopg
 dialect_async = CockroachDBDialectAsync_psycopg
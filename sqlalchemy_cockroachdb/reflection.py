@@ -0,0 +1,439 @@
+"""A reflection cache that outlives Inspectors and Engines.
+
+SQLAlchemy caches reflection results for the life of one Inspector, so
+every MetaData.reflect() or Alembic run queries the catalog again. A
+:class:`ReflectionCache` passed to create_engine() keeps the results of
+the dialect's get_multi_*() methods per table, and reuses them for as
+long as the version of the table's descriptor is unchanged::
+
+    cache = ReflectionCache()
+    engine = create_engine(url, reflection_cache=cache)
+
+CockroachDB bumps the version of a descriptor on every schema change, so
+one query on crdb_internal.tables per schema and Inspector tells which
+entries are still valid, and only the tables that changed are reflected
+again.
+
+:func:`reflect_snapshot` goes further for processes that start often: it
+saves the reflected MetaData to a file, and loads it instead of
+reflecting for as long as the versions of the schema's tables are
+unchanged. :func:`reflect_parallel` reflects many schemas or tables over
+several connections at once.
+"""
+import collections
+import concurrent.futures
+import copy
+import functools
+import hashlib
+import math
+import os
+import pickle
+import tempfile
+import threading
+import zlib
+
+import sqlalchemy
+from sqlalchemy import MetaData, inspect, text
+from sqlalchemy.engine import Engine
+
+# Marks a table for which a reflection method returned nothing, e.g. a
+# view when only tables were asked for.
+_ABSENT = object()
+
+
+class ReflectionCache:
+    """A bounded LRU cache of reflection results, keyed by table version.
+
+    Entries are keyed by cluster, database, schema, table, reflection
+    method and its options, and hold the descriptor versions they were
+    reflected at: the table's own, plus those of the tables referred to
+    by its foreign keys. At most ``maxsize`` entries are kept, the least
+    recently used are evicted first.
+
+    The versions are read from crdb_internal.tables. On v26.1 and later,
+    sessions that don't set allow_unsafe_internals may not read it, and
+    reflect without the cache.
+
+    One cache can be shared by the Engines of a process, even if they
+    connect to different clusters. The ``hits``, ``misses`` and
+    ``evictions`` counters are available as attributes and through
+    :meth:`stats`.
+
+    A ``COMMENT ON`` statement may not change the version of a
+    descriptor; call :meth:`clear` after one.
+    """
+
+    def __init__(self, maxsize=10000):
+        if maxsize < 1:
+            raise ValueError("maxsize must be positive, not %r" % (maxsize,))
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """Drop all the entries."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return the counters and the number of entries as a dict."""
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                size=len(self._entries),
+            )
+
+    def _get(self, key, versions):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                deps, value = entry
+                if all(versions.get(name) == version for name, version in deps):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def _export(self, scope_key):
+        with self._lock:
+            return [(key, entry) for key, entry in self._entries.items() if key[0] == scope_key]
+
+    def _import(self, entries):
+        for key, (deps, value) in entries:
+            self._put(key, deps, value)
+
+    def _put(self, key, deps, value):
+        with self._lock:
+            self._entries[key] = (deps, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_multi(self, fn, dialect, connection, schema, filter_names, scope, kind, **kw):
+        """Run the reflection method ``fn`` for the tables whose results
+        aren't cached, and merge its results with the cached ones."""
+        options = tuple(sorted((k, v) for k, v in kw.items() if k not in _UNCACHED_KWARGS))
+        try:
+            hash(options)
+        except TypeError:
+            return fn(dialect, connection, schema, filter_names, scope, kind, **kw)
+
+        schema_name = schema or dialect.default_schema_name
+        table_versions = _table_versions(connection, schema_name, kw.get("info_cache"))
+        if table_versions is None:
+            return fn(dialect, connection, schema, filter_names, scope, kind, **kw)
+        scope_key, versions = table_versions
+        # PGDialect names the schema of referred tables only if the
+        # schema was named explicitly.
+        method_key = (scope_key, fn.__name__, schema is None, scope, kind, options)
+        result = {}
+        missing = []
+        for table_name in filter_names or versions:
+            value = None
+            if table_name in versions:
+                value = self._get(method_key + (table_name,), versions)
+            if value is None:
+                missing.append(table_name)
+            elif value is not _ABSENT:
+                result[(schema, table_name)] = copy.deepcopy(value)
+        if not missing:
+            return result
+
+        reflected = fn(dialect, connection, schema, missing, scope, kind, **kw)
+        reflected = dict(reflected)
+        for table_name in missing:
+            if table_name not in versions:
+                # Not a table of this schema, or just created; don't
+                # cache anything about it.
+                if (schema, table_name) in reflected:
+                    result[(schema, table_name)] = reflected[(schema, table_name)]
+                continue
+            value = reflected.get((schema, table_name), _ABSENT)
+            deps = _dependencies(fn.__name__, table_name, value, schema_name, versions)
+            if deps is not None:
+                self._put(
+                    method_key + (table_name,),
+                    deps,
+                    value if value is _ABSENT else copy.deepcopy(value),
+                )
+            if value is not _ABSENT:
+                result[(schema, table_name)] = value
+        return result
+
+
+# Keyword arguments of reflection methods that aren't options.
+_UNCACHED_KWARGS = frozenset(["info_cache", "unreflectable"])
+
+
+def _internals_allowed(connection, info_cache):
+    """Whether the session may read crdb_internal.
+
+    From v26.1 on, crdb_internal is off limits unless the
+    allow_unsafe_internals session setting is on. Querying it anyway
+    would fail, and abort the transaction the query is part of.
+    """
+    if not connection.dialect._is_v261plus:
+        return True
+    key = "cockroachdb_internals_allowed"
+    if info_cache is not None and key in info_cache:
+        return info_cache[key]
+    value = connection.execute(
+        text("SELECT current_setting('allow_unsafe_internals', true)")
+    ).scalar()
+    # No such setting means nothing is off limits.
+    allowed = value is None or value.lower() in ("on", "true")
+    if info_cache is not None:
+        info_cache[key] = allowed
+    return allowed
+
+
+def _table_versions(connection, schema_name, info_cache):
+    """Return the scope of the cache keys of ``schema_name`` and the
+    descriptor versions of its tables, by name, or None if the session
+    may not read them.
+
+    The versions are queried once per Inspector, which passes the same
+    ``info_cache`` to every reflection method.
+    """
+    key = ("cockroachdb_table_versions", schema_name)
+    if info_cache is not None and key in info_cache:
+        return info_cache[key]
+    if not _internals_allowed(connection, info_cache):
+        return None
+    rows = connection.execute(
+        text(
+            "SELECT crdb_internal.cluster_id()::TEXT AS cluster_id, "
+            "current_database() AS database_name, name, table_id, version "
+            "FROM crdb_internal.tables "
+            "WHERE database_name = current_database() AND schema_name = :schema "
+            "AND drop_time IS NULL"
+        ),
+        {"schema": schema_name},
+    ).all()
+    scope_key = (rows[0].cluster_id, rows[0].database_name, schema_name) if rows else None
+    versions = {row.name: (row.table_id, row.version) for row in rows}
+    if info_cache is not None:
+        info_cache[key] = (scope_key, versions)
+    return scope_key, versions
+
+
+def _dependencies(method, table_name, value, schema_name, versions):
+    """Return the (table name, version) pairs an entry depends on, or None
+    if it can't be cached."""
+    names = {table_name}
+    if method == "get_multi_foreign_keys" and value is not _ABSENT:
+        for fk in value:
+            if fk["referred_schema"] not in (None, schema_name):
+                return None
+            names.add(fk["referred_table"])
+    if not names.issubset(versions):
+        return None
+    return tuple(sorted((name, versions[name]) for name in names))
+
+
+def cached_reflection(fn):
+    """Serve a get_multi_*() method of the dialect from its reflection
+    cache, if it has one."""
+
+    @functools.wraps(fn)
+    def get_multi(self, connection, schema, filter_names, scope, kind, **kw):
+        cache = self.reflection_cache
+        if cache is None or not self._is_v202plus:
+            return fn(self, connection, schema, filter_names, scope, kind, **kw)
+        return cache.get_multi(fn, self, connection, schema, filter_names, scope, kind, **kw)
+
+    return get_multi
+
+
+def reflect_snapshot(bind, path, schema=None, **kw):
+    """Return a MetaData reflected from ``schema``, or loaded from the
+    snapshot file at ``path``.
+
+    ``bind`` is an Engine or a Connection; the remaining arguments are
+    passed to MetaData.reflect(), and must be literals, e.g. ``only`` a
+    list of names rather than a function. A snapshot is used if its
+    fingerprint, a hash of the ids and descriptor versions of the tables
+    of ``schema`` and of the arguments, matches the current one, which
+    takes a single query. Otherwise the schema is reflected and the
+    snapshot written anew. If the dialect has a :class:`ReflectionCache`,
+    the snapshot carries its entries for the schema as well.
+
+    The versions are read from crdb_internal.tables; sessions that may
+    not read it, see :class:`ReflectionCache`, reflect the schema
+    without a snapshot.
+
+    Snapshots are pickles: ``path`` must not be writable by anybody the
+    application doesn't trust. For AsyncEngines, call this function with
+    AsyncConnection.run_sync().
+    """
+    if isinstance(bind, Engine):
+        with bind.connect() as conn:
+            return reflect_snapshot(conn, path, schema, **kw)
+
+    dialect = bind.dialect
+    metadata = MetaData()
+    options = sorted((name, _literal(value)) for name, value in kw.items())
+    table_versions = None
+    if dialect._is_v202plus:
+        # A schema change between the fingerprint query and the
+        # reflection only makes the snapshot stale from the start.
+        table_versions = _table_versions(bind, schema or dialect.default_schema_name, None)
+    if table_versions is None:
+        metadata.reflect(bind, schema=schema, **kw)
+        return metadata
+
+    scope_key, versions = table_versions
+    fingerprint = _fingerprint(scope_key, versions, schema, options)
+    snapshot = _read_snapshot(path, fingerprint)
+    cache = dialect.reflection_cache
+    if snapshot is not None:
+        metadata, entries = snapshot
+        if cache is not None:
+            cache._import(entries)
+        return metadata
+
+    metadata.reflect(bind, schema=schema, **kw)
+    entries = cache._export(scope_key) if cache is not None and scope_key is not None else []
+    _write_snapshot(path, fingerprint, (metadata, entries))
+    return metadata
+
+
+def reflect_parallel(engine, schemas=(None,), workers=None, chunk_size=None, **kw):
+    """Reflect the tables of ``schemas`` on a thread pool and return them
+    in one MetaData.
+
+    ``schemas`` defaults to the default schema alone. The tables of each
+    schema are split into chunks of at most ``chunk_size`` tables, by
+    default as many tables as it takes to give each worker one chunk, and
+    each chunk is reflected by MetaData.reflect() on its own pooled
+    connection. The results are merged with Table.to_metadata().
+
+    ``workers`` is the maximum number of threads. As with
+    :func:`.run_transactions`, it is capped at the size of the Engine's
+    connection pool and defaults to that size. The remaining arguments
+    are passed to MetaData.reflect().
+    """
+    # transaction imports base, which imports this module.
+    from .transaction import _pool_capacity
+
+    if not isinstance(engine, Engine):
+        raise TypeError("don't know how to reflect in parallel with %s" % type(engine))
+    capacity = _pool_capacity(engine)
+    if workers is None:
+        # The default of ThreadPoolExecutor.
+        workers = capacity or min(32, (os.cpu_count() or 1) + 4)
+    elif capacity is not None:
+        workers = min(workers, capacity)
+    workers = max(1, workers)
+    schemas = list(schemas)
+
+    def list_tables(schema):
+        # The tables MetaData.reflect() would consider.
+        with engine.connect() as conn:
+            insp = inspect(conn)
+            names = insp.get_table_names(schema)
+            if kw.get("views"):
+                names += insp.get_view_names(schema)
+                names += insp.get_materialized_view_names(schema)
+        return names
+
+    def reflect_chunk(schema, names):
+        metadata = MetaData()
+        with engine.connect() as conn:
+            metadata.reflect(conn, schema=schema, only=names, **kw)
+        return metadata
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        listings = list(executor.map(list_tables, schemas))
+        size = chunk_size or max(1, math.ceil(sum(map(len, listings)) / workers))
+        futures = [
+            executor.submit(reflect_chunk, schema, names[i:i + size])
+            for schema, names in zip(schemas, listings)
+            for i in range(0, len(names), size)
+        ]
+        try:
+            parts = [future.result() for future in futures]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    metadata = MetaData()
+    for part in parts:
+        for key, table in part.tables.items():
+            # A table referred to by foreign keys is reflected along with
+            # the chunks of the tables that refer to it.
+            if key not in metadata.tables:
+                table.to_metadata(metadata)
+    return metadata
+
+
+def _literal(value):
+    """Return ``value`` in a form whose repr() is the same in every process.
+
+    The repr() of a function or most other objects holds its address,
+    which would make every fingerprint new.
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_literal(item) for item in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted(_literal(item) for item in value)
+    raise TypeError("reflect_snapshot() arguments must be literals, not %r" % (value,))
+
+
+def _fingerprint(scope_key, versions, schema, options):
+    from . import __version__
+
+    digest = hashlib.sha256()
+    for part in (
+        sqlalchemy.__version__,
+        __version__,
+        scope_key,
+        schema,
+        options,
+        sorted(versions.items()),
+    ):
+        digest.update(repr(part).encode())
+    return digest.hexdigest().encode()
+
+
+def _read_snapshot(path, fingerprint):
+    # The fingerprint is stored on the first line so that a stale snapshot
+    # is rejected without being decompressed.
+    try:
+        with open(path, "rb") as f:
+            if f.readline().rstrip(b"\n") != fingerprint:
+                return None
+            return pickle.loads(zlib.decompress(f.read()))
+    except Exception:
+        # Missing, truncated, or written by incompatible versions of the
+        # libraries; reflect again.
+        return None
+
+
+def _write_snapshot(path, fingerprint, snapshot):
+    data = zlib.compress(pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL))
+    # Write to a temporary file and rename it, so that concurrent readers
+    # see either the old snapshot or the new one.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(fingerprint + b"\n")
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
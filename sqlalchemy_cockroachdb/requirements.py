@@ -166,6 +166,12 @@ class Requirements(SuiteRequirementsSQLA, SuiteRequirementsAlembic):
             lambda config: config.db.dialect.driver in ["psycopg2", "psycopg"]
         )
 
+    @property
+    def async_driver(self):
+        # The testing harness can only dispose of async engines when the
+        # test database itself is async, which rules out cockroachdb+psycopg.
+        return exclusions.only_if(lambda config: config.db.dialect.is_async)
+
     @property
     def array_type(self):
         # DDL like
@@ -0,0 +1,700 @@
+"""Retry policies for run_transaction().
+
+CockroachDB asks clients to retry a transaction by returning SQLSTATE
+40001. It can also report that the outcome of a COMMIT is unknown
+(40003) and drops connections when a node is drained or restarted.
+Each driver surfaces these conditions through its own exception
+classes, so rather than importing driver modules and walking
+``isinstance()`` chains whenever a transaction fails, every dialect
+builds a :class:`RetryClassifier` once, when it is initialized, that
+only has to look up the SQLSTATE of the error.
+"""
+import asyncio
+import random
+import threading
+import time
+
+from .metrics import RetryListener
+
+# A serialization failure. The transaction can be restarted in place
+# by rolling back to the cockroach_restart savepoint.
+RETRY_TRANSACTION = "transaction"
+
+# The transaction may or may not have committed. It is finished either
+# way, so it can only be retried by running it again from the start.
+RETRY_AMBIGUOUS = "ambiguous"
+
+# The connection was lost, e.g. because the node it was connected to
+# is draining. The transaction can only be retried on a new connection.
+RETRY_CONNECTION = "connection"
+
+_sqlstate_kinds = {
+    # serialization_failure
+    "40001": RETRY_TRANSACTION,
+    # statement_completion_unknown, "result is ambiguous"
+    "40003": RETRY_AMBIGUOUS,
+    # connection_exception, connection_does_not_exist, connection_failure
+    "08000": RETRY_CONNECTION,
+    "08003": RETRY_CONNECTION,
+    "08006": RETRY_CONNECTION,
+    # admin_shutdown, crash_shutdown, cannot_connect_now
+    "57P01": RETRY_CONNECTION,
+    "57P02": RETRY_CONNECTION,
+    "57P03": RETRY_CONNECTION,
+}
+
+# Transaction priorities, from lowest to highest.
+PRIORITIES = ("LOW", "NORMAL", "HIGH")
+
+# How often RetryBudget.acquire_async() checks for deposits.
+_ASYNC_POLL_INTERVAL = 0.05
+
+# The first interval at which ContentionLocks.acquire_async() checks a
+# lock. It doubles up to _ASYNC_POLL_INTERVAL.
+_ASYNC_LOCK_POLL_INTERVAL = 0.001
+
+
+class RetryClassifier:
+    """Decide whether a ``sqlalchemy.exc.DBAPIError`` may be retried.
+
+    Calling the classifier returns one of :data:`RETRY_TRANSACTION`,
+    :data:`RETRY_AMBIGUOUS` or :data:`RETRY_CONNECTION`, or None if the
+    error should be raised to the caller.
+
+    ``sqlstate_attr`` names the attribute that holds the SQLSTATE on the
+    driver's exceptions. ``predicates`` is a sequence of callables that
+    are consulted, in order, for errors that are not recognized by
+    SQLSTATE. Each one is called with the ``DBAPIError`` and returns
+    None or False to pass, True to retry the transaction in place, or
+    one of the ``RETRY_*`` constants.
+    """
+
+    def __init__(self, sqlstate_attr="pgcode", predicates=()):
+        self.sqlstate_attr = sqlstate_attr
+        self.predicates = predicates
+
+    def sqlstate(self, exc):
+        """Return the SQLSTATE of ``exc``, or None if it doesn't have one."""
+        return getattr(exc.orig, self.sqlstate_attr, None)
+
+    def __call__(self, exc):
+        kind = _sqlstate_kinds.get(getattr(exc.orig, self.sqlstate_attr, None))
+        if kind is not None:
+            return kind
+        if exc.connection_invalidated:
+            return RETRY_CONNECTION
+        for predicate in self.predicates:
+            kind = predicate(exc)
+            if kind:
+                return RETRY_TRANSACTION if kind is True else kind
+        return None
+
+
+def get_retry_classifier(dialect):
+    """Return the retry classifier that was built for ``dialect``."""
+    classifier = getattr(dialect, "_retry_classifier", None)
+    if classifier is None:
+        # Not one of our dialects, or it has not been initialized yet.
+        classifier = RetryClassifier("pgcode" if dialect.driver == "psycopg2" else "sqlstate")
+    return classifier
+
+
+class Backoff:
+    """Base class for the back-off strategies of run_transaction().
+
+    The delay before retry number ``n`` (counting from 1) grows
+    exponentially from ``base`` seconds, as ``base * 2 ** (n - 1)``,
+    and is capped at ``cap`` seconds. Subclasses decide how it is
+    randomized so that competing transactions do not retry in lockstep;
+    see https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+
+    Strategies hold no state of their own and may be shared.
+    """
+
+    def __init__(self, base=0.01, cap=1.0):
+        if base <= 0 or cap < base:
+            raise ValueError("invalid back-off: base=%r, cap=%r" % (base, cap))
+        self.base = base
+        self.cap = cap
+
+    def _ceiling(self, retry_count):
+        # Clamp the exponent so that long retry loops don't overflow.
+        return min(self.cap, self.base * 2 ** min(retry_count - 1, 64))
+
+    def delay(self, retry_count, previous):
+        """Return the number of seconds to sleep before retry ``retry_count``.
+
+        ``previous`` is the delay returned for the previous retry, or 0.
+        """
+        raise NotImplementedError()
+
+
+class FullJitterBackoff(Backoff):
+    """Sleep a random time between 0 and the exponential ceiling."""
+
+    def delay(self, retry_count, previous):
+        return random.uniform(0, self._ceiling(retry_count))
+
+
+class EqualJitterBackoff(Backoff):
+    """Sleep at least half the exponential ceiling, plus a random part."""
+
+    def delay(self, retry_count, previous):
+        ceiling = self._ceiling(retry_count)
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+
+class DecorrelatedJitterBackoff(Backoff):
+    """Sleep a random time between ``base`` and three times the previous delay."""
+
+    def delay(self, retry_count, previous):
+        return min(self.cap, random.uniform(self.base, max(previous, self.base) * 3))
+
+
+# Used by run_transaction() unless it is given a back-off strategy or a
+# max_backoff.
+DEFAULT_BACKOFF = FullJitterBackoff(base=0.01, cap=1.0)
+
+
+class RetryBudget:
+    """A token bucket that limits retries to a fraction of first attempts.
+
+    Under contention every run_transaction() caller retries on its own,
+    which multiplies the load on the hottest ranges exactly when the
+    cluster is struggling. A budget shared by all the callers of an
+    Engine (or of a process) caps the retries across all of them::
+
+        budget = RetryBudget(ratio=0.1)
+        run_transaction(engine, callback, retry_budget=budget)
+
+    Every first attempt deposits ``ratio`` tokens and every retry
+    withdraws one, so that in the long run retries are at most ``ratio``
+    times the number of transactions. ``min_retries_per_second`` tokens
+    are added over time so that retries remain possible at low
+    throughput, and the balance is capped at ``max_tokens``.
+
+    When the budget is exhausted, a retry waits up to ``max_wait``
+    seconds for a token (forever if ``max_wait`` is None). If no token
+    becomes available, the error that triggered the retry is raised to
+    the caller. The default of 0 fails fast.
+
+    The ``attempts``, ``retries``, ``rejected``, ``waits`` and
+    ``wait_time`` counters are available as attributes and through
+    :meth:`stats`.
+    """
+
+    def __init__(self, ratio=0.1, min_retries_per_second=10.0, max_tokens=100.0, max_wait=0):
+        if ratio < 0 or min_retries_per_second < 0 or max_tokens < 1:
+            raise ValueError("invalid retry budget")
+        self.ratio = ratio
+        self.min_retries_per_second = min_retries_per_second
+        self.max_tokens = max_tokens
+        self.max_wait = max_wait
+        self._tokens = max_tokens
+        self._refilled_at = time.monotonic()
+        self._cond = threading.Condition(threading.Lock())
+        self.attempts = 0
+        self.retries = 0
+        self.rejected = 0
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def _refill(self, now):
+        self._tokens = min(
+            self.max_tokens,
+            self._tokens + (now - self._refilled_at) * self.min_retries_per_second,
+        )
+        self._refilled_at = now
+
+    def _next_token_in(self):
+        # Seconds until the time-based refill alone yields a token.
+        if self.min_retries_per_second == 0:
+            return None
+        return (1 - self._tokens) / self.min_retries_per_second
+
+    def record_attempt(self):
+        """Record the first attempt of a transaction."""
+        with self._cond:
+            self.attempts += 1
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+            if self._tokens >= 1:
+                self._cond.notify()
+
+    def try_acquire(self):
+        """Take a token for a retry without waiting. Return True on success."""
+        with self._cond:
+            self._refill(time.monotonic())
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self.retries += 1
+                return True
+            return False
+
+    def acquire(self):
+        """Take a token for a retry, waiting up to ``max_wait`` seconds.
+
+        Return True if the retry may proceed.
+        """
+        start = time.monotonic()
+        deadline = None if self.max_wait is None else start + self.max_wait
+        waited = False
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self.retries += 1
+                    granted = True
+                    break
+                if deadline is not None and now >= deadline:
+                    self.rejected += 1
+                    granted = False
+                    break
+                timeout = self._next_token_in()
+                if deadline is not None:
+                    timeout = deadline - now if timeout is None else min(timeout, deadline - now)
+                self._cond.wait(timeout)
+                waited = True
+            if waited:
+                self.waits += 1
+                self.wait_time += now - start
+        return granted
+
+    async def acquire_async(self):
+        """The asyncio counterpart of :meth:`acquire`.
+
+        Waiting polls the bucket instead of blocking the event loop on
+        the lock, so a deposit may be noticed with some delay.
+        """
+        start = time.monotonic()
+        deadline = None if self.max_wait is None else start + self.max_wait
+        waited = False
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self.retries += 1
+                    granted = True
+                    break
+                if deadline is not None and now >= deadline:
+                    self.rejected += 1
+                    granted = False
+                    break
+                timeout = self._next_token_in()
+            if timeout is None or timeout > _ASYNC_POLL_INTERVAL:
+                timeout = _ASYNC_POLL_INTERVAL
+            if deadline is not None:
+                timeout = min(timeout, deadline - now)
+            await asyncio.sleep(timeout)
+            waited = True
+        if waited:
+            with self._cond:
+                self.waits += 1
+                self.wait_time += now - start
+        return granted
+
+    def stats(self):
+        """Return the counters and the current balance as a dict."""
+        with self._cond:
+            self._refill(time.monotonic())
+            return dict(
+                attempts=self.attempts,
+                retries=self.retries,
+                rejected=self.rejected,
+                waits=self.waits,
+                wait_time=self.wait_time,
+                tokens=self._tokens,
+            )
+
+
+class _ReentrantStripe:
+    """A lock that its owner, a thread id or an asyncio task, may take again.
+
+    Unlike an RLock, the owner is given by the caller, since the tasks of
+    an event loop share its thread, and it may be released from anywhere.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._owner = None
+        self._depth = 0
+
+    def acquire(self, owner, blocking=True, timeout=-1):
+        # Only the owner sets _owner to itself, so this check is safe
+        # without the lock.
+        if owner is not None and self._owner == owner:
+            self._depth += 1
+            return True
+        if not self._lock.acquire(blocking, timeout):
+            return False
+        self._owner = owner
+        self._depth = 1
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            self._owner = None
+            self._lock.release()
+
+
+class ContentionLocks:
+    """In-process locks that serialize transactions on the same hot rows.
+
+    When many workers update the same row, e.g. a counter or the stock of
+    a product, their transactions mostly abort each other and are retried
+    over and over. Passing a ``contention_key`` that names the row to
+    run_transaction() makes the callers in this process that share the
+    key wait for each other before they reach the database::
+
+        run_transaction(engine, callback, contention_key=("sku", sku_id))
+
+    Keys must be hashable, and are mapped onto a fixed number of
+    ``stripes``, so memory doesn't grow with the number of keys; keys that
+    share a stripe are serialized too. A thread, or with
+    :meth:`acquire_async` a task, that already holds the lock of a stripe
+    gets it again without waiting, so that a nested run_transaction()
+    whose key shares the stripe doesn't deadlock. Only the callers of one
+    process are coordinated, so the transactions of other processes still
+    conflict.
+
+    The ``acquisitions``, ``waits``, ``wait_time``, ``max_wait_time`` and
+    ``timeouts`` counters are available as attributes and through
+    :meth:`stats`.
+    """
+
+    def __init__(self, stripes=256):
+        if stripes < 1:
+            raise ValueError("stripes must be at least 1")
+        self._locks = [_ReentrantStripe() for _ in range(stripes)]
+        self._stats_lock = threading.Lock()
+        self.acquisitions = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.timeouts = 0
+
+    def _lock(self, key):
+        return self._locks[hash(key) % len(self._locks)]
+
+    def _record(self, waited, acquired):
+        with self._stats_lock:
+            if acquired:
+                self.acquisitions += 1
+            else:
+                self.timeouts += 1
+            if waited > 0:
+                self.waits += 1
+                self.wait_time += waited
+                self.max_wait_time = max(self.max_wait_time, waited)
+
+    def acquire(self, key, timeout=None):
+        """Wait for the lock of ``key``, for up to ``timeout`` seconds.
+
+        Return the number of seconds waited, or None if the lock could not
+        be acquired in time.
+        """
+        lock = self._lock(key)
+        owner = threading.get_ident()
+        if lock.acquire(owner, blocking=False):
+            self._record(0.0, True)
+            return 0.0
+        if timeout is not None and timeout <= 0:
+            self._record(0.0, False)
+            return None
+        start = time.monotonic()
+        acquired = lock.acquire(owner, timeout=-1 if timeout is None else timeout)
+        waited = time.monotonic() - start
+        self._record(waited, acquired)
+        return waited if acquired else None
+
+    async def acquire_async(self, key, timeout=None):
+        """The asyncio counterpart of :meth:`acquire`.
+
+        Waiting polls the lock instead of blocking the event loop, so a
+        release may be noticed with some delay.
+        """
+        lock = self._lock(key)
+        owner = asyncio.current_task()
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        interval = _ASYNC_LOCK_POLL_INTERVAL
+        waited = 0.0
+        while not lock.acquire(owner, blocking=False):
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                self._record(now - start, False)
+                return None
+            if deadline is not None:
+                interval = min(interval, deadline - now)
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, _ASYNC_POLL_INTERVAL)
+            waited = time.monotonic() - start
+        self._record(waited, True)
+        return waited
+
+    def release(self, key):
+        """Release the lock of ``key``."""
+        self._lock(key).release()
+
+    def stats(self):
+        """Return the counters as a dict."""
+        with self._stats_lock:
+            return dict(
+                acquisitions=self.acquisitions,
+                waits=self.waits,
+                wait_time=self.wait_time,
+                max_wait_time=self.max_wait_time,
+                timeouts=self.timeouts,
+            )
+
+
+# Used by run_transaction() when it is given a contention_key but no
+# contention_locks.
+DEFAULT_CONTENTION_LOCKS = ContentionLocks()
+
+
+class ConcurrencyLimiter(RetryListener):
+    """Limit the number of concurrent run_transaction() calls, adaptively.
+
+    Connection pools are sized for peak load, but when transactions
+    contend, more concurrency only produces more retries. A limiter
+    shared by all the callers of an Engine admits at most :attr:`limit`
+    transactions at a time and makes the others wait::
+
+        limiter = ConcurrencyLimiter(initial_limit=20, max_limit=50)
+        run_transaction(engine, callback, limiter=limiter)
+
+    The limiter listens to the transactions it admits. After every
+    ``window`` transactions it compares the share of their attempts that
+    were retried, counting transactions that ran out of time as retried
+    too, with ``threshold``. Above it, the limit is multiplied by
+    ``decrease_ratio``; otherwise it grows by ``increase``. The limit
+    stays between ``min_limit`` and ``max_limit``.
+
+    :attr:`limit`, :attr:`in_flight` and :attr:`queue_depth` may be read
+    at any time for monitoring, and :meth:`stats` also returns the
+    number of increases, decreases and admission timeouts, and the time
+    spent waiting to be admitted.
+    """
+
+    def __init__(
+        self,
+        initial_limit=10,
+        min_limit=1,
+        max_limit=100,
+        threshold=0.1,
+        window=20,
+        increase=1,
+        decrease_ratio=0.5,
+    ):
+        if not 1 <= min_limit <= initial_limit <= max_limit:
+            raise ValueError(
+                "invalid limits: min_limit=%r, initial_limit=%r, max_limit=%r"
+                % (min_limit, initial_limit, max_limit)
+            )
+        if window < 1 or increase <= 0 or not 0 < decrease_ratio < 1:
+            raise ValueError("invalid concurrency limiter")
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.threshold = threshold
+        self.window = window
+        self.increase = increase
+        self.decrease_ratio = decrease_ratio
+        self._limit = float(initial_limit)
+        self._cond = threading.Condition(threading.Lock())
+        self.in_flight = 0
+        self.queue_depth = 0
+        self.increases = 0
+        self.decreases = 0
+        self.rejected = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self._completed = 0
+        self._attempts = 0
+        self._retries = 0
+
+    @property
+    def limit(self):
+        """The number of transactions that may run at once."""
+        return int(self._limit)
+
+    def _admitted(self, start, queued):
+        # Called with the lock held.
+        self.in_flight += 1
+        if not queued:
+            return 0.0
+        waited = time.monotonic() - start
+        self.queue_depth -= 1
+        self.waits += 1
+        self.wait_time += waited
+        return waited
+
+    def _rejected(self):
+        # Called with the lock held.
+        self.queue_depth -= 1
+        self.rejected += 1
+
+    def acquire(self, timeout=None):
+        """Wait, for up to ``timeout`` seconds, until a transaction may start.
+
+        Return the number of seconds waited, or None if the transaction
+        was not admitted in time. Every successful call must be followed
+        by a call to :meth:`release`.
+        """
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        with self._cond:
+            queued = False
+            while self.in_flight >= self.limit:
+                if not queued:
+                    self.queue_depth += 1
+                    queued = True
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self._rejected()
+                    return None
+                self._cond.wait(remaining)
+            return self._admitted(start, queued)
+
+    async def acquire_async(self, timeout=None):
+        """The asyncio counterpart of :meth:`acquire`.
+
+        Waiting polls the limiter instead of blocking the event loop, so
+        a release may be noticed with some delay.
+        """
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        interval = _ASYNC_LOCK_POLL_INTERVAL
+        queued = False
+        while True:
+            with self._cond:
+                if self.in_flight < self.limit:
+                    return self._admitted(start, queued)
+                if not queued:
+                    self.queue_depth += 1
+                    queued = True
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    self._rejected()
+                    return None
+            if deadline is not None:
+                interval = min(interval, deadline - now)
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, _ASYNC_POLL_INTERVAL)
+
+    def release(self):
+        """Let the next transaction start."""
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+    def _complete(self, timed_out=False):
+        with self._cond:
+            self._completed += 1
+            if timed_out:
+                self._retries += 1
+            if self._completed < self.window:
+                return
+            rate = self._retries / max(self._attempts, 1)
+            if rate > self.threshold:
+                limit = max(self.min_limit, self._limit * self.decrease_ratio)
+                if limit < self._limit:
+                    self.decreases += 1
+            else:
+                limit = min(self.max_limit, self._limit + self.increase)
+                if limit > self._limit:
+                    self.increases += 1
+                    self._cond.notify_all()
+            self._limit = limit
+            self._completed = self._attempts = self._retries = 0
+
+    def on_attempt(self, name, attempt):
+        with self._cond:
+            self._attempts += 1
+
+    def on_retry(self, name, attempt, sqlstate):
+        with self._cond:
+            self._retries += 1
+
+    def on_give_up(self, name, attempts, elapsed, error):
+        self._complete(timed_out=isinstance(error, TimeoutError))
+
+    def on_commit(self, name, attempts, elapsed, commit_latency):
+        self._complete()
+
+    def stats(self):
+        """Return the limit, the counters and the current state as a dict."""
+        with self._cond:
+            return dict(
+                limit=self.limit,
+                in_flight=self.in_flight,
+                queue_depth=self.queue_depth,
+                increases=self.increases,
+                decreases=self.decreases,
+                rejected=self.rejected,
+                waits=self.waits,
+                wait_time=self.wait_time,
+            )
+
+
+class PriorityPolicy:
+    """Choose the priority of a transaction, and raise it under contention.
+
+    A transaction that keeps losing conflicts to shorter ones can be
+    retried forever. With a policy, run_transaction() begins the
+    transaction at the ``initial`` priority (one of :data:`PRIORITIES`,
+    or None for the session default) and, after ``escalate_after``
+    consecutive serialization failures, restarts it at the next priority,
+    up to ``maximum``::
+
+        run_transaction(engine, callback, priority=PriorityPolicy(escalate_after=3))
+
+    CockroachDB can't change the priority of a transaction that is
+    running, so an escalation rolls the whole transaction back and begins
+    a new one with ``SET TRANSACTION PRIORITY``; the callback is run again
+    from the start. An ``escalate_after`` of None never escalates.
+
+    run_transaction() also accepts a priority name as ``priority``, which
+    is a shortcut for a policy that never escalates.
+    """
+
+    def __init__(self, initial=None, escalate_after=3, maximum="HIGH"):
+        if initial is not None:
+            initial = _check_priority(initial)
+        maximum = _check_priority(maximum)
+        if escalate_after is not None and escalate_after < 1:
+            raise ValueError("escalate_after must be at least 1")
+        self.initial = initial
+        self.escalate_after = escalate_after
+        self.maximum = maximum
+
+    def escalate(self, priority, consecutive_retries):
+        """Return the priority to restart at, or None to retry in place.
+
+        ``priority`` is the priority the transaction is running at, and
+        ``consecutive_retries`` the number of serialization failures in a
+        row since it started at that priority.
+        """
+        if self.escalate_after is None or consecutive_retries < self.escalate_after:
+            return None
+        current = PRIORITIES.index(priority or "NORMAL")
+        if current >= PRIORITIES.index(self.maximum):
+            return None
+        return PRIORITIES[current + 1]
+
+
+def _check_priority(priority):
+    if priority.upper() not in PRIORITIES:
+        raise ValueError("unknown transaction priority: %r" % (priority,))
+    return priority.upper()
+
+
+def get_priority_policy(priority):
+    """Return the policy for the ``priority`` argument of run_transaction()."""
+    if priority is None or isinstance(priority, PriorityPolicy):
+        return priority
+    return PriorityPolicy(initial=priority, escalate_after=None)
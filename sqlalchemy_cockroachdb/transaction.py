@@ -1,11 +1,28 @@
-from random import uniform
-from time import sleep
+import asyncio
+import concurrent.futures
+import datetime
+import functools
+import os
+import re
+from time import monotonic, perf_counter, sleep
 
 import sqlalchemy.engine
 import sqlalchemy.exc
+import sqlalchemy.ext.asyncio
 import sqlalchemy.orm
+import sqlalchemy.pool
 
 from .base import savepoint_state
+from .metrics import MetricsCollector
+from .retry import (
+    DEFAULT_BACKOFF,
+    DEFAULT_CONTENTION_LOCKS,
+    RETRY_CONNECTION,
+    RETRY_TRANSACTION,
+    FullJitterBackoff,
+    get_priority_policy,
+    get_retry_classifier,
+)
 
 
 class ChainTransaction:
@@ -17,7 +34,7 @@ class ChainTransaction:
         self.results.append(result)
 
 
-def run_transaction(transactor, callback, max_retries=None, max_backoff=0, **kwargs):
+def run_transaction(transactor, callback, max_retries=None, max_backoff=None, **kwargs):
     """Run a transaction with retries.
 
     ``callback()`` will be called with one argument to execute the
@@ -34,33 +51,327 @@ def run_transaction(transactor, callback, max_retries=None, max_backoff=0, **kwa
     ``max_retries`` is an optional integer that specifies how many times the
     transaction should be retried before giving up.
     ``max_backoff`` is an optional integer that specifies the capped number of seconds
-    for the exponential back-off.
-    ``inject_error`` forces retry loop to run via SET inject_retry_errors_enabled = 'true'
+    for the exponential back-off. 0 disables the back-off.
+    ``backoff`` is an optional `sqlalchemy_cockroachdb.retry.Backoff` strategy that decides
+    how long to sleep between retries. It defaults to ``retry.DEFAULT_BACKOFF`` unless
+    ``max_backoff`` is given.
+    ``inject_error`` forces retry loop to run via SET inject_retry_errors_enabled = 'true'.
+    It has no effect with ``implicit``, since only explicit transactions get the errors.
     ``use_cockroach_restart``, default true, utilizes the special cockroach_restart protocol,
     as outlined in: https://www.cockroachlabs.com/blog/nested-transactions-in-cockroachdb-20-1/
+    ``retry_budget`` is an optional `sqlalchemy_cockroachdb.retry.RetryBudget`, shared
+    between callers, that limits the number of retries to a fraction of the transactions.
+    ``listeners`` is an optional sequence of `sqlalchemy_cockroachdb.metrics.RetryListener`
+    objects that are notified of attempts, retries, back-off, failures and commits.
+    ``name`` identifies the transaction to the listeners; it defaults to the qualified
+    name of ``callback``.
+    ``restore_session_state``, default false, applies when the callback is given a
+    Session. When an attempt is rolled back to the savepoint, SQLAlchemy expires the
+    objects that the attempt changed, and the next attempt loads them again. With this
+    option, the column values that objects loaded before the attempt had when it began
+    are put back instead, so only the objects loaded by the failed attempt, and
+    relationships, are loaded again. It costs a copy of the identity map per attempt.
+    ``contention_key`` is an optional hashable that names the rows the transaction
+    contends on, such as a hot counter. Calls in this process that share the key wait
+    for each other, so that they don't abort each other in the database. The locks
+    are taken from ``contention_locks``, a `sqlalchemy_cockroachdb.retry.ContentionLocks`,
+    or from ``retry.DEFAULT_CONTENTION_LOCKS``. Waits are reported to listeners through
+    ``on_lock_wait()``, and count against ``timeout`` and ``deadline``.
+    ``limiter`` is an optional `sqlalchemy_cockroachdb.retry.ConcurrencyLimiter`,
+    shared by the callers of an Engine, that admits a limited number of transactions
+    at once and adapts the limit to their retry rate. Waiting to be admitted counts
+    against ``timeout`` and ``deadline``.
+    ``priority`` is an optional priority name (``"LOW"``, ``"NORMAL"`` or ``"HIGH"``)
+    to run the transaction at, or a `sqlalchemy_cockroachdb.retry.PriorityPolicy`
+    that also raises the priority after repeated serialization failures.
+    ``read_only``, default false, runs a callback that only reads as a historical read
+    with ``SET TRANSACTION AS OF SYSTEM TIME follower_read_timestamp()``, which can be
+    served by the nearest replica and doesn't conflict with writers. No savepoint is
+    used; the rare retryable error reruns the whole transaction.
+    ``as_of`` implies ``read_only`` and reads at the given time instead: a negative
+    interval such as ``"-10s"``, a ``datetime.timedelta`` into the past, or a
+    ``datetime.datetime``.
+    ``isolation_aware``, default false, skips the savepoint when the connection runs
+    at READ COMMITTED, where CockroachDB retries statements by itself; a
+    serialization failure then reruns the whole transaction. The isolation level is
+    taken from the execution options, then from ``create_engine()``, then from the
+    server's default. Priority escalation doesn't apply to such transactions.
+    ``implicit``, default false, runs ``callback`` on a connection in AUTOCOMMIT mode,
+    without BEGIN, savepoint or COMMIT, so that each statement runs in an implicit
+    transaction that CockroachDB can retry by itself. It is meant for callbacks that
+    execute a single statement, or for a `StatementBatch`; separate statements are
+    committed separately. Only Engine and Connection transactors are supported, and
+    ``priority``, ``read_only``, ``as_of`` and ``isolation_aware``, which need a
+    transaction, can't be combined with it.
+    ``timeout`` is an optional number of seconds, and ``deadline`` an optional
+    ``time.monotonic()`` value, after which no more attempts are made. Each attempt
+    sets ``statement_timeout`` to the time that is left, back-off never sleeps past
+    the deadline, and `TransactionTimeoutError` is raised when time runs out. In
+    implicit mode there is no transaction to scope ``statement_timeout`` to, so only
+    retries and back-off are bounded.
+
+    When ``transactor`` is an Engine or a sessionmaker, a transaction whose
+    connection is lost, e.g. because its node is drained during a rolling restart,
+    is run again from the start on a new connection, and the dead one is
+    invalidated. Such replays count against ``max_retries`` and ``retry_budget``
+    and back off like retries. A connection that is lost while committing leaves
+    the outcome of the transaction unknown, so the error is raised instead.
     """
+    _check_implicit(kwargs)
+    _set_deadline(kwargs)
+    contention_key = kwargs.pop("contention_key", None)
+    contention_locks = kwargs.pop("contention_locks", None) or DEFAULT_CONTENTION_LOCKS
+    if contention_key is None:
+        return _run_transaction(transactor, callback, max_retries, max_backoff, **kwargs)
+    timeout = _time_left(kwargs)
+    waited = contention_locks.acquire(contention_key, timeout)
+    _report_lock_wait(callback, waited, timeout, kwargs)
+    try:
+        return _run_transaction(transactor, callback, max_retries, max_backoff, **kwargs)
+    finally:
+        contention_locks.release(contention_key)
+
+
+def _run_transaction(transactor, callback, max_retries, max_backoff, limiter=None, **kwargs):
+    if limiter is not None:
+        timeout = _time_left(kwargs)
+        if limiter.acquire(timeout) is None:
+            raise _give_up_waiting(callback, max(timeout, 0), kwargs)
+        kwargs["listeners"] = list(kwargs.get("listeners", ())) + [limiter]
+        try:
+            return _run_transaction(transactor, callback, max_retries, max_backoff, **kwargs)
+        finally:
+            limiter.release()
+    if kwargs.pop("implicit", False):
+        return _run_implicit(transactor, callback, max_retries, max_backoff, **kwargs)
     if isinstance(transactor, (sqlalchemy.engine.Connection, sqlalchemy.orm.Session)):
         return _txn_retry_loop(transactor, callback, max_retries, max_backoff, **kwargs)
-    elif isinstance(transactor, sqlalchemy.engine.Engine):
-        with transactor.connect() as connection:
-            return _txn_retry_loop(connection, callback, max_retries, max_backoff, **kwargs)
-    elif isinstance(transactor, sqlalchemy.orm.sessionmaker):
-        session = transactor()
-        return _txn_retry_loop(session, callback, max_retries, max_backoff, **kwargs)
+    elif isinstance(transactor, (sqlalchemy.engine.Engine, sqlalchemy.orm.sessionmaker)):
+        return _reconnect_loop(transactor, callback, max_retries, max_backoff, **kwargs)
     else:
         raise TypeError("don't know how to run a transaction on %s", type(transactor))
 
 
+async def run_transaction_async(
+    transactor, callback, max_retries=None, max_backoff=None, **kwargs
+):
+    """Run a transaction with retries on an asyncio transactor.
+
+    This is the asyncio counterpart of :func:`run_transaction`. ``callback``
+    must be a coroutine function; it is awaited with one argument and, as
+    with :func:`run_transaction`, may be called more than once.
+
+    The ``transactor`` argument may be one of the following types:
+    * `sqlalchemy.ext.asyncio.AsyncConnection`: the same connection is passed to the callback.
+    * `sqlalchemy.ext.asyncio.AsyncEngine`: a connection is created and passed to the callback.
+    * `sqlalchemy.ext.asyncio.AsyncSession`: the same session is passed to the callback.
+    * `sqlalchemy.ext.asyncio.async_sessionmaker`: a session is created and passed to the
+      callback.
+
+    The remaining arguments are the same as for :func:`run_transaction`. Back-off
+    between retries uses ``asyncio.sleep()`` so that it does not block the event loop.
+    With ``implicit``, only AsyncEngine and AsyncConnection transactors are supported,
+    and `StatementBatch` can't be used since it isn't a coroutine function.
+    """
+    _check_implicit(kwargs)
+    _set_deadline(kwargs)
+    contention_key = kwargs.pop("contention_key", None)
+    contention_locks = kwargs.pop("contention_locks", None) or DEFAULT_CONTENTION_LOCKS
+    if contention_key is None:
+        return await _run_transaction_async(
+            transactor, callback, max_retries, max_backoff, **kwargs
+        )
+    timeout = _time_left(kwargs)
+    waited = await contention_locks.acquire_async(contention_key, timeout)
+    _report_lock_wait(callback, waited, timeout, kwargs)
+    try:
+        return await _run_transaction_async(
+            transactor, callback, max_retries, max_backoff, **kwargs
+        )
+    finally:
+        contention_locks.release(contention_key)
+
+
+async def _run_transaction_async(
+    transactor, callback, max_retries, max_backoff, limiter=None, **kwargs
+):
+    if limiter is not None:
+        timeout = _time_left(kwargs)
+        if await limiter.acquire_async(timeout) is None:
+            raise _give_up_waiting(callback, max(timeout, 0), kwargs)
+        kwargs["listeners"] = list(kwargs.get("listeners", ())) + [limiter]
+        try:
+            return await _run_transaction_async(
+                transactor, callback, max_retries, max_backoff, **kwargs
+            )
+        finally:
+            limiter.release()
+    if kwargs.pop("implicit", False):
+        return await _run_implicit_async(transactor, callback, max_retries, max_backoff, **kwargs)
+    if isinstance(
+        transactor, (sqlalchemy.ext.asyncio.AsyncConnection, sqlalchemy.ext.asyncio.AsyncSession)
+    ):
+        return await _txn_retry_loop_async(transactor, callback, max_retries, max_backoff, **kwargs)
+    elif isinstance(
+        transactor, (sqlalchemy.ext.asyncio.AsyncEngine, sqlalchemy.ext.asyncio.async_sessionmaker)
+    ):
+        return await _reconnect_loop_async(
+            transactor, callback, max_retries, max_backoff, **kwargs
+        )
+    else:
+        raise TypeError("don't know how to run a transaction on %s", type(transactor))
+
+
+class StatementBatch:
+    """A batch of statements that is sent to the server in one round trip.
+
+    ``statements`` may be SQL strings or SQLAlchemy statements; the latter
+    are rendered with their parameters inlined, so the batch can only hold
+    values that the dialect knows how to render as literals. The batch is a
+    callback::
+
+        run_transaction(engine, StatementBatch([stmt1, stmt2]), implicit=True)
+
+    With ``implicit=True`` the batch runs as a single implicit transaction,
+    which the gateway node retries without involving the client. Results
+    of the statements are discarded. The driver must accept several
+    statements in one query, which rules out asyncpg.
+    """
+
+    def __init__(self, statements):
+        self.statements = list(statements)
+
+    def compile(self, dialect):
+        """Return the SQL of the batch as one string."""
+        sql = []
+        for statement in self.statements:
+            if not isinstance(statement, str):
+                statement = str(
+                    statement.compile(dialect=dialect, compile_kwargs={"literal_binds": True})
+                )
+            sql.append(statement)
+        return ";\n".join(sql)
+
+    def __call__(self, conn):
+        conn.exec_driver_sql(self.compile(conn.dialect))
+
+
+class TransactionTimeoutError(TimeoutError):
+    """run_transaction() reached its deadline before the transaction committed.
+
+    ``attempts`` is the number of attempts that were made and ``elapsed``
+    the number of seconds spent. The error that ended the last attempt,
+    if any, is chained as ``__cause__``.
+    """
+
+    def __init__(self, attempts, elapsed):
+        super().__init__(
+            "transaction did not commit before its deadline (%d attempts in %.3fs)"
+            % (attempts, elapsed)
+        )
+        self.attempts = attempts
+        self.elapsed = elapsed
+
+
+class BatchResult:
+    """The outcome of :func:`run_transactions`.
+
+    ``results`` holds the return values of the callbacks, in the order in
+    which the callbacks were given. ``stats`` holds the retry metrics of
+    the whole batch, as returned by `MetricsCollector.totals()`.
+    """
+
+    def __init__(self, results, stats):
+        self.results = results
+        self.stats = stats
+
+
+def run_transactions(transactor, callbacks, workers=None, **kwargs):
+    """Run many independent transactions concurrently.
+
+    Each callback is passed to :func:`run_transaction` on a thread pool,
+    so that it runs on its own pooled connection (or session) with its own
+    retry loop. ``transactor`` must be a `sqlalchemy.engine.Engine` or a
+    `sqlalchemy.orm.sessionmaker`; connections and sessions can't be
+    shared between threads.
+
+    ``workers`` is the maximum number of threads. It is capped at the
+    size of the Engine's connection pool, so that workers don't queue for
+    connections or take overflow connections away from the rest of the
+    application, and defaults to that size.
+
+    If a callback raises, the callbacks that have not started yet are
+    cancelled, the ones in progress are waited for, and the error of the
+    first failed callback, in the order in which they were given, is
+    raised.
+
+    The remaining arguments are passed to :func:`run_transaction`.
+    Returns a :class:`BatchResult`.
+    """
+    if isinstance(transactor, sqlalchemy.engine.Engine):
+        engine = transactor
+    elif isinstance(transactor, sqlalchemy.orm.sessionmaker):
+        engine = transactor.kw.get("bind")
+    else:
+        raise TypeError("don't know how to run transactions concurrently on %s", type(transactor))
+    callbacks = list(callbacks)
+    if not callbacks:
+        return BatchResult([], MetricsCollector().totals())
+
+    capacity = _pool_capacity(engine) if isinstance(engine, sqlalchemy.engine.Engine) else None
+    if workers is None:
+        # The default of ThreadPoolExecutor.
+        workers = capacity or min(32, (os.cpu_count() or 1) + 4)
+    elif capacity is not None:
+        workers = min(workers, capacity)
+    workers = max(1, min(workers, len(callbacks)))
+
+    collector = MetricsCollector()
+    kwargs["listeners"] = list(kwargs.get("listeners", ())) + [collector]
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        futures = [
+            executor.submit(run_transaction, transactor, callback, **kwargs)
+            for callback in callbacks
+        ]
+        results = []
+        try:
+            for future in futures:
+                results.append(future.result())
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    return BatchResult(results, collector.totals())
+
+
+def _pool_capacity(engine):
+    """Return how many connections ``engine`` keeps, or None if there's no limit."""
+    pool = engine.pool
+    if isinstance(pool, sqlalchemy.pool.QueuePool):
+        # A pool_size of 0 means no limit.
+        return pool.size() or None
+    if isinstance(pool, sqlalchemy.pool.SingletonThreadPool):
+        return pool.size
+    if isinstance(pool, sqlalchemy.pool.StaticPool):
+        return 1
+    return None
+
+
 class _NestedTransaction:
-    """Wraps begin_nested() to set the savepoint_state thread-local.
+    """Wraps begin_nested() to set the savepoint_state context variable.
 
     This causes the savepoint statements that are a part of this retry
-    loop to be rewritten by the dialect.
+    loop to be rewritten by the dialect. With ``restore_session_state``,
+    the objects of a Session that the rollback of the savepoint expires
+    get back the values they had when it was taken.
     """
 
-    def __init__(self, conn, use_cockroach_restart=True):
+    def __init__(self, conn, use_cockroach_restart=True, restore_session_state=False):
         self.conn = conn
         self.use_cockroach_restart = use_cockroach_restart
+        self.restore_session_state = restore_session_state
+        self.commit_on_release = False
+        self.snapshot = None
 
     def __enter__(self):
         try:
@@ -74,16 +385,664 @@ class _NestedTransaction:
         finally:
             if self.use_cockroach_restart:
                 savepoint_state.cockroach_restart = False
+        if self.restore_session_state and isinstance(self.conn, sqlalchemy.orm.Session):
+            self.snapshot = _snapshot_session(self.conn)
         return self
 
     def __exit__(self, typ, value, tb):
         try:
             if self.use_cockroach_restart:
                 savepoint_state.cockroach_restart = True
+                savepoint_state.commit_on_release = self.commit_on_release and typ is None
             self.txn.__exit__(typ, value, tb)
+            if typ is not None and self.snapshot is not None:
+                _restore_session(self.conn, self.snapshot)
         finally:
             if self.use_cockroach_restart:
                 savepoint_state.cockroach_restart = False
+                savepoint_state.commit_on_release = False
+
+
+class _AsyncNestedTransaction:
+    """The asyncio counterpart of _NestedTransaction."""
+
+    def __init__(self, conn, use_cockroach_restart=True, restore_session_state=False):
+        self.conn = conn
+        self.use_cockroach_restart = use_cockroach_restart
+        self.restore_session_state = restore_session_state
+        self.commit_on_release = False
+        self.snapshot = None
+
+    async def __aenter__(self):
+        try:
+            if self.use_cockroach_restart:
+                savepoint_state.cockroach_restart = True
+            self.txn = await self.conn.begin_nested()
+            if self.use_cockroach_restart and isinstance(
+                self.conn, sqlalchemy.ext.asyncio.AsyncSession
+            ):
+                await self.conn.connection()
+        finally:
+            if self.use_cockroach_restart:
+                savepoint_state.cockroach_restart = False
+        if self.restore_session_state and isinstance(
+            self.conn, sqlalchemy.ext.asyncio.AsyncSession
+        ):
+            self.snapshot = _snapshot_session(self.conn.sync_session)
+        return self
+
+    async def __aexit__(self, typ, value, tb):
+        try:
+            if self.use_cockroach_restart:
+                savepoint_state.cockroach_restart = True
+                savepoint_state.commit_on_release = self.commit_on_release and typ is None
+            await self.txn.__aexit__(typ, value, tb)
+            if typ is not None and self.snapshot is not None:
+                _restore_session(self.conn.sync_session, self.snapshot)
+        finally:
+            if self.use_cockroach_restart:
+                savepoint_state.cockroach_restart = False
+                savepoint_state.commit_on_release = False
+
+
+def _snapshot_session(session):
+    """Return the loaded column values of the objects in ``session``."""
+    snapshot = {}
+    for state in session.identity_map.all_states():
+        dict_ = state.dict
+        snapshot[state] = {
+            prop.key: dict_[prop.key]
+            for prop in state.mapper.column_attrs
+            # In-place changes to mutable values can't be undone.
+            if prop.key in dict_ and not isinstance(dict_[prop.key], (dict, list, set))
+        }
+    return snapshot
+
+
+def _restore_session(session, snapshot):
+    """Put back the values from ``snapshot`` that a rollback expired.
+
+    Objects that were loaded after the snapshot was taken, and
+    relationships, stay expired and are loaded again when used.
+    """
+    identity_map = session.identity_map
+    for state, values in snapshot.items():
+        if not state.expired_attributes or not identity_map.contains_state(state):
+            continue
+        dict_ = state.dict
+        for key in state.expired_attributes.intersection(values):
+            state.manager[key].impl.set_committed_value(state, dict_, values[key])
+
+
+def _callback_name(callback):
+    while isinstance(callback, functools.partial):
+        callback = callback.func
+    return getattr(callback, "__qualname__", None) or type(callback).__qualname__
+
+
+class _TransactionRun:
+    """Bookkeeping for one call of run_transaction().
+
+    This counts the attempts and retries made on behalf of the call, across
+    priority escalations and replays, and dispatches the events of the
+    retry loop to the listeners that were passed to it.
+    """
+
+    def __init__(self, callback, listeners=(), name=None, deadline=None):
+        self.name = name or _callback_name(callback)
+        self.listeners = listeners
+        self.deadline = deadline
+        self.attempts = 0
+        self.retries = 0
+        self.priority = None
+        self.started_at = perf_counter()
+        self.returned_at = None
+        # Set while the caller may still replay the transaction on a new
+        # connection, which then reports the failure itself.
+        self.replayable = False
+
+    def attempt(self):
+        self.attempts += 1
+        self.returned_at = None
+        for listener in self.listeners:
+            listener.on_attempt(self.name, self.attempts)
+
+    def retry(self, sqlstate):
+        self.retries += 1
+        for listener in self.listeners:
+            listener.on_retry(self.name, self.attempts, sqlstate)
+
+    def exhausted(self, max_retries):
+        """Return True if the call may not retry again."""
+        return max_retries is not None and self.retries >= max_retries
+
+    def backoff(self, seconds):
+        for listener in self.listeners:
+            listener.on_backoff(self.name, self.attempts, seconds)
+
+    def escalate(self, priority):
+        self.priority = priority
+        self.returned_at = None
+        for listener in self.listeners:
+            listener.on_priority(self.name, self.attempts, priority)
+
+    def expired(self, delay=0):
+        """Return True if the deadline will have passed in ``delay`` seconds."""
+        return self.deadline is not None and monotonic() + delay >= self.deadline
+
+    def statement_timeout(self):
+        # SET LOCAL is scoped to the transaction, so the setting doesn't
+        # outlive it on a pooled connection. 0 would disable the timeout.
+        milliseconds = max(1, int((self.deadline - monotonic()) * 1000))
+        return sqlalchemy.text("SET LOCAL statement_timeout = %d" % milliseconds)
+
+    def timeout_error(self):
+        return TransactionTimeoutError(self.attempts, perf_counter() - self.started_at)
+
+    def give_up(self, error):
+        if self.replayable:
+            return
+        elapsed = perf_counter() - self.started_at
+        for listener in self.listeners:
+            listener.on_give_up(self.name, self.attempts, elapsed, error)
+
+    def commit(self):
+        now = perf_counter()
+        elapsed = now - self.started_at
+        commit_latency = now - (self.returned_at or now)
+        for listener in self.listeners:
+            listener.on_commit(self.name, self.attempts, elapsed, commit_latency)
+
+
+# Arguments of run_transaction() that need a transaction, and can't be
+# combined with implicit=True.
+_TRANSACTION_OPTIONS = ("priority", "read_only", "as_of", "isolation_aware")
+
+
+def _transaction_options(kwargs):
+    """Return the names of the _TRANSACTION_OPTIONS set in ``kwargs``."""
+    return [name for name in _TRANSACTION_OPTIONS if kwargs.get(name) not in (None, False)]
+
+
+def _check_implicit(kwargs):
+    if kwargs.get("implicit"):
+        options = _transaction_options(kwargs)
+        if options:
+            raise ValueError("%s can't be used with implicit=True" % ", ".join(options))
+
+
+def _set_deadline(kwargs):
+    """Fold the ``timeout`` argument of run_transaction() into ``deadline``."""
+    timeout = kwargs.pop("timeout", None)
+    if timeout is not None:
+        deadline = monotonic() + timeout
+        if kwargs.get("deadline") is not None:
+            deadline = min(deadline, kwargs["deadline"])
+        kwargs["deadline"] = deadline
+
+
+def _time_left(kwargs):
+    """Return the seconds left before the ``deadline`` in ``kwargs``, if any."""
+    deadline = kwargs.get("deadline")
+    return None if deadline is None else deadline - monotonic()
+
+
+def _report_lock_wait(callback, waited, timeout, kwargs):
+    """Tell the listeners how long the transaction waited for its
+    ``contention_key``.
+
+    ``waited`` is None if the lock could not be acquired before the
+    deadline, in which case TransactionTimeoutError is raised.
+    """
+    name = kwargs.get("name") or _callback_name(callback)
+    for listener in kwargs.get("listeners", ()):
+        listener.on_lock_wait(name, max(timeout, 0) if waited is None else waited)
+    if waited is None:
+        raise _give_up_waiting(callback, max(timeout, 0), kwargs)
+
+
+def _give_up_waiting(callback, waited, kwargs):
+    """Tell the listeners that the transaction ran out of time before its
+    first attempt, and return the TransactionTimeoutError to raise.
+    """
+    name = kwargs.get("name") or _callback_name(callback)
+    error = TransactionTimeoutError(0, waited)
+    for listener in kwargs.get("listeners", ()):
+        listener.on_give_up(name, 0, waited, error)
+    return error
+
+
+def _run_implicit(transactor, callback, max_retries, max_backoff, **kwargs):
+    kwargs["statement_timeout"] = False
+    # CockroachDB only injects retry errors into explicit transactions.
+    kwargs.pop("inject_error", None)
+    # Only unset ones are left, see _check_implicit().
+    for name in _TRANSACTION_OPTIONS:
+        kwargs.pop(name, None)
+    if isinstance(transactor, sqlalchemy.engine.Engine):
+        with transactor.connect() as connection:
+            connection.execution_options(isolation_level="AUTOCOMMIT")
+            return _flat_retry_loop(connection, callback, max_retries, max_backoff, **kwargs)
+    elif isinstance(transactor, sqlalchemy.engine.Connection):
+        # Put the connection back in the isolation level it was in.
+        isolation_level = transactor.get_execution_options().get(
+            "isolation_level", transactor.default_isolation_level
+        )
+        transactor.execution_options(isolation_level="AUTOCOMMIT")
+        try:
+            return _flat_retry_loop(transactor, callback, max_retries, max_backoff, **kwargs)
+        finally:
+            transactor.execution_options(isolation_level=isolation_level)
+    else:
+        raise TypeError("don't know how to run an implicit transaction on %s", type(transactor))
+
+
+async def _run_implicit_async(transactor, callback, max_retries, max_backoff, **kwargs):
+    """The asyncio counterpart of _run_implicit."""
+    kwargs["statement_timeout"] = False
+    # CockroachDB only injects retry errors into explicit transactions.
+    kwargs.pop("inject_error", None)
+    # Only unset ones are left, see _check_implicit().
+    for name in _TRANSACTION_OPTIONS:
+        kwargs.pop(name, None)
+    if isinstance(transactor, sqlalchemy.ext.asyncio.AsyncEngine):
+        async with transactor.connect() as connection:
+            await connection.execution_options(isolation_level="AUTOCOMMIT")
+            return await _flat_retry_loop_async(
+                connection, callback, max_retries, max_backoff, **kwargs
+            )
+    elif isinstance(transactor, sqlalchemy.ext.asyncio.AsyncConnection):
+        isolation_level = transactor.sync_connection.get_execution_options().get(
+            "isolation_level", transactor.default_isolation_level
+        )
+        await transactor.execution_options(isolation_level="AUTOCOMMIT")
+        try:
+            return await _flat_retry_loop_async(
+                transactor, callback, max_retries, max_backoff, **kwargs
+            )
+        finally:
+            await transactor.execution_options(isolation_level=isolation_level)
+    else:
+        raise TypeError("don't know how to run an implicit transaction on %s", type(transactor))
+
+
+def _reconnect_loop(transactor, callback, max_retries, max_backoff, **kwargs):
+    """Run _txn_retry_loop on a new connection from ``transactor`` until it
+    doesn't lose its connection.
+
+    ``transactor`` is an Engine or a sessionmaker. The sessions that are
+    created are left open, as they hold the objects loaded by ``callback``.
+    """
+    txn_run = _TransactionRun(
+        callback, kwargs.pop("listeners", ()), kwargs.pop("name", None), kwargs.get("deadline")
+    )
+    retry_budget = kwargs.get("retry_budget")
+    backoff = _get_backoff(kwargs.get("backoff"), max_backoff)
+    is_engine = isinstance(transactor, sqlalchemy.engine.Engine)
+    replays = 0
+    delay = 0
+    while True:
+        conn = None
+        txn_run.replayable = True
+        try:
+            conn = transactor.connect() if is_engine else transactor()
+            return _txn_retry_loop(
+                conn,
+                callback,
+                max_retries,
+                max_backoff,
+                txn_run=txn_run,
+                **kwargs,
+            )
+        except sqlalchemy.exc.DBAPIError as e:
+            classify = get_retry_classifier(transactor.dialect if is_engine else _get_dialect(conn))
+            kind = classify(e)
+            if kind == RETRY_CONNECTION and conn is not None:
+                # Keep the pool from handing out the dead connection again.
+                conn.invalidate()
+            if (
+                kind != RETRY_CONNECTION
+                # Lost during the COMMIT: the transaction may have committed.
+                or txn_run.returned_at is not None
+                or txn_run.exhausted(max_retries)
+                or (retry_budget is not None and not retry_budget.acquire())
+            ):
+                txn_run.replayable = False
+                txn_run.give_up(e)
+                raise
+            txn_run.retry(classify.sqlstate(e))
+            replays += 1
+            if backoff is not None:
+                delay = backoff.delay(replays, delay)
+            if txn_run.expired(delay):
+                txn_run.replayable = False
+                txn_run.give_up(e)
+                raise txn_run.timeout_error() from e
+            if backoff is not None:
+                txn_run.backoff(delay)
+                sleep(delay)
+        except BaseException as e:
+            # A timeout, or an error of the callback, which isn't retried.
+            txn_run.replayable = False
+            txn_run.give_up(e)
+            raise
+        finally:
+            if is_engine and conn is not None:
+                conn.close()
+
+
+def _flat_retry_loop(
+    conn,
+    callback,
+    max_retries,
+    max_backoff,
+    retry_budget=None,
+    backoff=None,
+    listeners=(),
+    name=None,
+    statement=None,
+    deadline=None,
+    statement_timeout=True,
+    use_cockroach_restart=True,
+    restore_session_state=False,
+    inject_error=False,
+    txn_run=None,
+):
+    """Retry loop for transactions that don't use a savepoint.
+
+    A retryable error aborts the transaction, so it is rolled back and
+    ``callback`` is run again from the start in a new one. ``statement``
+    is executed first in every transaction, to set its mode. ``conn`` may
+    be a Connection or a Session. ``use_cockroach_restart`` and
+    ``restore_session_state`` are accepted for the sake of the callers of
+    run_transaction() and ignored. ``inject_error`` makes the first attempt
+    fail with a retryable error.
+    ``txn_run`` continues the bookkeeping of a transaction that is being
+    replayed; ``listeners`` and ``name`` are then ignored.
+
+    This is used for implicit transactions, where the connection is in
+    AUTOCOMMIT mode: ``begin()`` and ``commit()`` don't go to the server,
+    and only end the Connection's own transaction so that its isolation
+    level can be reset afterwards.
+    """
+    classify = get_retry_classifier(_get_dialect(conn))
+    if txn_run is None:
+        txn_run = _TransactionRun(callback, listeners, name, deadline)
+    backoff = _get_backoff(backoff, max_backoff)
+
+    if retry_budget is not None and txn_run.attempts == 0:
+        retry_budget.record_attempt()
+    retry_count = 0
+    delay = 0
+    while True:
+        txn_run.attempt()
+        try:
+            with conn.begin():
+                if statement is not None:
+                    conn.execute(statement)
+                if inject_error and txn_run.retries == 0:
+                    conn.execute(_INJECT_RETRY_ERRORS)
+                if statement_timeout and deadline is not None:
+                    conn.execute(txn_run.statement_timeout())
+                result = callback(conn)
+                if isinstance(result, ChainTransaction):
+                    for transaction in result.transactions:
+                        result.add_result(transaction(conn))
+                txn_run.returned_at = perf_counter()
+            break
+        except sqlalchemy.exc.DBAPIError as e:
+            if _is_timeout(classify, e, txn_run):
+                txn_run.give_up(e)
+                raise txn_run.timeout_error() from e
+            if (
+                txn_run.exhausted(max_retries)
+                or classify(e) != RETRY_TRANSACTION
+                or (retry_budget is not None and not retry_budget.acquire())
+            ):
+                txn_run.give_up(e)
+                raise
+            txn_run.retry(classify.sqlstate(e))
+            retry_count += 1
+            if backoff is not None:
+                delay = backoff.delay(retry_count, delay)
+            if txn_run.expired(delay):
+                txn_run.give_up(e)
+                raise txn_run.timeout_error() from e
+            if backoff is not None:
+                txn_run.backoff(delay)
+                sleep(delay)
+        except BaseException as e:
+            # Errors of the callback are not retried.
+            txn_run.give_up(e)
+            raise
+    txn_run.commit()
+    return result
+
+
+async def _reconnect_loop_async(transactor, callback, max_retries, max_backoff, **kwargs):
+    """The asyncio counterpart of _reconnect_loop.
+
+    ``transactor`` is an AsyncEngine or an async_sessionmaker.
+    """
+    txn_run = _TransactionRun(
+        callback, kwargs.pop("listeners", ()), kwargs.pop("name", None), kwargs.get("deadline")
+    )
+    retry_budget = kwargs.get("retry_budget")
+    backoff = _get_backoff(kwargs.get("backoff"), max_backoff)
+    is_engine = isinstance(transactor, sqlalchemy.ext.asyncio.AsyncEngine)
+    replays = 0
+    delay = 0
+    while True:
+        conn = None
+        txn_run.replayable = True
+        try:
+            conn = await transactor.connect() if is_engine else transactor()
+            return await _txn_retry_loop_async(
+                conn,
+                callback,
+                max_retries,
+                max_backoff,
+                txn_run=txn_run,
+                **kwargs,
+            )
+        except sqlalchemy.exc.DBAPIError as e:
+            classify = get_retry_classifier(transactor.dialect if is_engine else _get_dialect(conn))
+            kind = classify(e)
+            if kind == RETRY_CONNECTION and conn is not None:
+                await conn.invalidate()
+            if (
+                kind != RETRY_CONNECTION
+                or txn_run.returned_at is not None
+                or txn_run.exhausted(max_retries)
+                or (retry_budget is not None and not await retry_budget.acquire_async())
+            ):
+                txn_run.replayable = False
+                txn_run.give_up(e)
+                raise
+            txn_run.retry(classify.sqlstate(e))
+            replays += 1
+            if backoff is not None:
+                delay = backoff.delay(replays, delay)
+            if txn_run.expired(delay):
+                txn_run.replayable = False
+                txn_run.give_up(e)
+                raise txn_run.timeout_error() from e
+            if backoff is not None:
+                txn_run.backoff(delay)
+                await asyncio.sleep(delay)
+        except BaseException as e:
+            # A timeout, or an error of the callback, which isn't retried.
+            txn_run.replayable = False
+            txn_run.give_up(e)
+            raise
+        finally:
+            if is_engine and conn is not None:
+                await conn.close()
+
+
+async def _flat_retry_loop_async(
+    conn,
+    callback,
+    max_retries,
+    max_backoff,
+    retry_budget=None,
+    backoff=None,
+    listeners=(),
+    name=None,
+    statement=None,
+    deadline=None,
+    statement_timeout=True,
+    use_cockroach_restart=True,
+    restore_session_state=False,
+    inject_error=False,
+    txn_run=None,
+):
+    """The asyncio counterpart of _flat_retry_loop."""
+    classify = get_retry_classifier(_get_dialect(conn))
+    if txn_run is None:
+        txn_run = _TransactionRun(callback, listeners, name, deadline)
+    backoff = _get_backoff(backoff, max_backoff)
+
+    if retry_budget is not None and txn_run.attempts == 0:
+        retry_budget.record_attempt()
+    retry_count = 0
+    delay = 0
+    while True:
+        txn_run.attempt()
+        try:
+            async with conn.begin():
+                if statement is not None:
+                    await conn.execute(statement)
+                if inject_error and txn_run.retries == 0:
+                    await conn.execute(_INJECT_RETRY_ERRORS)
+                if statement_timeout and deadline is not None:
+                    await conn.execute(txn_run.statement_timeout())
+                result = await callback(conn)
+                if isinstance(result, ChainTransaction):
+                    for transaction in result.transactions:
+                        result.add_result(await transaction(conn))
+                txn_run.returned_at = perf_counter()
+            break
+        except sqlalchemy.exc.DBAPIError as e:
+            if _is_timeout(classify, e, txn_run):
+                txn_run.give_up(e)
+                raise txn_run.timeout_error() from e
+            if (
+                txn_run.exhausted(max_retries)
+                or classify(e) != RETRY_TRANSACTION
+                or (retry_budget is not None and not await retry_budget.acquire_async())
+            ):
+                txn_run.give_up(e)
+                raise
+            txn_run.retry(classify.sqlstate(e))
+            retry_count += 1
+            if backoff is not None:
+                delay = backoff.delay(retry_count, delay)
+            if txn_run.expired(delay):
+                txn_run.give_up(e)
+                raise txn_run.timeout_error() from e
+            if backoff is not None:
+                txn_run.backoff(delay)
+                await asyncio.sleep(delay)
+        except BaseException as e:
+            # Errors of the callback are not retried.
+            txn_run.give_up(e)
+            raise
+    txn_run.commit()
+    return result
+
+
+# Scoped to the transaction, so that only its first attempt fails and the
+# setting doesn't outlive it on a pooled connection.
+_INJECT_RETRY_ERRORS = sqlalchemy.text("SET LOCAL inject_retry_errors_enabled = 'true'")
+
+# query_canceled, which is what statement_timeout raises.
+_QUERY_CANCELED = "57014"
+
+
+def _is_timeout(classify, exc, txn_run):
+    """Return True if ``exc`` means that the transaction ran out of time."""
+    if not txn_run.expired():
+        return False
+    return classify.sqlstate(exc) == _QUERY_CANCELED or classify(exc) == RETRY_TRANSACTION
+
+
+def _get_bind(conn):
+    """Return the Connection or Engine behind ``conn``."""
+    if isinstance(conn, (sqlalchemy.orm.Session, sqlalchemy.ext.asyncio.AsyncSession)):
+        return conn.get_bind()
+    if isinstance(conn, sqlalchemy.ext.asyncio.AsyncConnection):
+        return conn.sync_connection
+    return conn
+
+
+def _get_dialect(conn):
+    return _get_bind(conn).dialect
+
+
+def _is_read_committed(conn):
+    """Return True if transactions on ``conn`` run at READ COMMITTED.
+
+    The isolation level is looked up, without a round trip, in the
+    execution options of the connection (or of the session's bind), then
+    in the ``isolation_level`` given to create_engine(), and finally in
+    the server's default.
+    """
+    bind = _get_bind(conn)
+    level = bind.get_execution_options().get("isolation_level")
+    if level is None:
+        dialect = bind.dialect
+        level = dialect._on_connect_isolation_level or dialect.default_isolation_level
+    return level == "READ COMMITTED"
+
+
+_as_of_interval = re.compile(r"-\d+(\.\d+)?(us|ms|s|m|h)$")
+
+
+def _as_of_statement(as_of):
+    """Return the statement that makes a transaction read ``as_of``.
+
+    ``as_of`` is None for follower reads, a negative interval such as
+    ``"-10s"`` or a ``datetime.timedelta``, or a ``datetime.datetime``.
+    """
+    if as_of is None:
+        expression = "follower_read_timestamp()"
+    elif isinstance(as_of, datetime.datetime):
+        # Escape the colons of the timestamp from text().
+        expression = "'%s'" % as_of.isoformat().replace(":", "\\:")
+    elif isinstance(as_of, datetime.timedelta):
+        if as_of <= datetime.timedelta(0):
+            raise ValueError("as_of must be in the past: %r" % (as_of,))
+        expression = "'-%dus'" % (as_of // datetime.timedelta(microseconds=1))
+    elif isinstance(as_of, str) and _as_of_interval.match(as_of):
+        expression = "'%s'" % as_of
+    else:
+        raise ValueError("invalid as_of: %r" % (as_of,))
+    return sqlalchemy.text("SET TRANSACTION AS OF SYSTEM TIME %s" % expression)
+
+
+class _PriorityEscalation(Exception):
+    """Raised from the nested retry loop to restart the transaction at ``priority``."""
+
+    def __init__(self, priority):
+        super().__init__(priority)
+        self.priority = priority
+
+
+def _set_priority_statement(priority):
+    return sqlalchemy.text("SET TRANSACTION PRIORITY %s" % priority)
+
+
+def _get_backoff(backoff, max_backoff):
+    if backoff is not None:
+        return backoff
+    if max_backoff is None:
+        return DEFAULT_BACKOFF
+    if max_backoff > 0:
+        # The historical behavior of max_backoff: full jitter, starting
+        # from 0.2 seconds.
+        return FullJitterBackoff(base=min(0.2, max_backoff), cap=max_backoff)
+    return None
 
 
 def retry_exponential_backoff(retry_count: int, max_backoff: int = 0) -> None:
@@ -93,67 +1052,341 @@ def retry_exponential_backoff(retry_count: int, max_backoff: int = 0) -> None:
     and the sleep time varies for each failed transaction
     capped by the max_backoff parameter.
 
+    It sleeps as run_transaction() does when given ``max_backoff``.
+
     :param retry_count: The number for the current retry count
     :param max_backoff: The capped number of seconds for the exponential back-off
     :return: None
     """
 
-    sleep_secs = uniform(0, min(max_backoff, 0.1 * (2**retry_count)))
-    sleep(sleep_secs)
+    backoff = _get_backoff(None, max_backoff)
+    if backoff is not None:
+        sleep(backoff.delay(retry_count, 0))
 
 
 def run_in_nested_transaction(
-    conn, callback, max_retries, max_backoff, inject_error=False, **kwargs
+    conn,
+    callback,
+    max_retries,
+    max_backoff,
+    inject_error=False,
+    retry_budget=None,
+    backoff=None,
+    txn_run=None,
+    priority_policy=None,
+    commit_on_release=False,
+    **kwargs,
 ):
-    if isinstance(conn, sqlalchemy.orm.Session):
-        dbapi_name = conn.bind.driver
-    else:
-        dbapi_name = conn.engine.driver
+    classify = get_retry_classifier(_get_dialect(conn))
+    if txn_run is None:
+        txn_run = _TransactionRun(callback)
+    backoff = _get_backoff(backoff, max_backoff)
 
+    if retry_budget is not None and txn_run.attempts == 0:
+        retry_budget.record_attempt()
     retry_count = 0
+    delay = 0
     while True:
-        if inject_error and retry_count == 0:
+        if inject_error and txn_run.retries == 0:
             conn.execute(sqlalchemy.text("SET inject_retry_errors_enabled = 'true'"))
         elif inject_error:
             conn.execute(sqlalchemy.text("SET inject_retry_errors_enabled = 'false'"))
+        txn_run.attempt()
         try:
-            with _NestedTransaction(conn, **kwargs):
-                return callback(conn)
-        except sqlalchemy.exc.DatabaseError as e:
-            if max_retries is not None and retry_count >= max_retries:
+            with _NestedTransaction(conn, **kwargs) as nested:
+                if txn_run.deadline is not None:
+                    conn.execute(txn_run.statement_timeout())
+                result = callback(conn)
+                txn_run.returned_at = perf_counter()
+                # Nothing else runs in the transaction after this callback.
+                nested.commit_on_release = commit_on_release and not isinstance(
+                    result, ChainTransaction
+                )
+            return result
+        except sqlalchemy.exc.DBAPIError as e:
+            # Catch the base class: asyncpg errors are not mapped onto the
+            # DBAPI exception hierarchy.
+            if _is_timeout(classify, e, txn_run):
+                raise txn_run.timeout_error() from e
+            if txn_run.exhausted(max_retries):
                 raise
-            do_retry = False
-            if dbapi_name == "psycopg2":
-                import psycopg2
-                import psycopg2.errorcodes
-
-                if isinstance(e.orig, psycopg2.OperationalError):
-                    if e.orig.pgcode == psycopg2.errorcodes.SERIALIZATION_FAILURE:
-                        do_retry = True
-            else:
-                import psycopg
-
-                if isinstance(e.orig, psycopg.errors.SerializationFailure):
-                    do_retry = True
-            if do_retry:
+            # Only serialization failures can be retried in place; errors
+            # that end the transaction or the connection are raised.
+            if classify(e) == RETRY_TRANSACTION:
+                if retry_budget is not None and not retry_budget.acquire():
+                    raise
+                txn_run.retry(classify.sqlstate(e))
                 retry_count += 1
-                if max_backoff > 0:
-                    retry_exponential_backoff(retry_count, max_backoff)
+                if priority_policy is not None:
+                    priority = priority_policy.escalate(txn_run.priority, retry_count)
+                    if priority is not None:
+                        raise _PriorityEscalation(priority) from e
+                if backoff is not None:
+                    delay = backoff.delay(retry_count, delay)
+                if txn_run.expired(delay):
+                    raise txn_run.timeout_error() from e
+                if backoff is not None:
+                    txn_run.backoff(delay)
+                    sleep(delay)
                 continue
             raise
 
 
-def _txn_retry_loop(conn, callback, max_retries, max_backoff, **kwargs):
+def _txn_retry_loop(
+    conn,
+    callback,
+    max_retries,
+    max_backoff,
+    listeners=(),
+    name=None,
+    priority=None,
+    read_only=False,
+    as_of=None,
+    deadline=None,
+    isolation_aware=False,
+    txn_run=None,
+    **kwargs,
+):
     """Inner transaction retry loop.
 
     ``conn`` may be either a Connection or a Session, but they both
-    have compatible ``begin()`` and ``begin_nested()`` methods.
-    """
-    with conn.begin():
-        result = run_in_nested_transaction(conn, callback, max_retries, max_backoff, **kwargs)
-        if isinstance(result, ChainTransaction):
-            for transaction in result.transactions:
-                result.add_result(
-                    run_in_nested_transaction(conn, transaction, max_retries, max_backoff, **kwargs)
+    have compatible ``begin()`` and ``begin_nested()`` methods. ``txn_run``
+    is passed by _reconnect_loop when the transaction is being replayed.
+    """
+    if read_only or as_of is not None:
+        return _flat_retry_loop(
+            conn,
+            callback,
+            max_retries,
+            max_backoff,
+            listeners=listeners,
+            name=name,
+            statement=_as_of_statement(as_of),
+            deadline=deadline,
+            txn_run=txn_run,
+            **kwargs,
+        )
+    priority_policy = get_priority_policy(priority)
+    if isolation_aware and _is_read_committed(conn):
+        # CockroachDB retries the statements of READ COMMITTED transactions
+        # by itself, so a savepoint to restart from is not worth its round
+        # trips. The rare serialization failure reruns the whole transaction.
+        initial = priority_policy.initial if priority_policy is not None else None
+        return _flat_retry_loop(
+            conn,
+            callback,
+            max_retries,
+            max_backoff,
+            listeners=listeners,
+            name=name,
+            statement=_set_priority_statement(initial) if initial is not None else None,
+            deadline=deadline,
+            txn_run=txn_run,
+            **kwargs,
+        )
+    if txn_run is None:
+        txn_run = _TransactionRun(callback, listeners, name, deadline)
+    if priority_policy is not None and txn_run.priority is None:
+        txn_run.priority = priority_policy.initial
+    kwargs.update(txn_run=txn_run, priority_policy=priority_policy)
+    # A Session may still run flush hooks between the release of the
+    # savepoint and its commit, so only connections commit on release.
+    commit_on_release = not isinstance(conn, sqlalchemy.orm.Session)
+    try:
+        while True:
+            try:
+                with conn.begin():
+                    if txn_run.priority is not None:
+                        conn.execute(_set_priority_statement(txn_run.priority))
+                    result = run_in_nested_transaction(
+                        conn,
+                        callback,
+                        max_retries,
+                        max_backoff,
+                        commit_on_release=commit_on_release,
+                        **kwargs,
+                    )
+                    if isinstance(result, ChainTransaction):
+                        for i, transaction in enumerate(result.transactions, 1):
+                            result.add_result(
+                                run_in_nested_transaction(
+                                    conn,
+                                    transaction,
+                                    max_retries,
+                                    max_backoff,
+                                    commit_on_release=(
+                                        commit_on_release and i == len(result.transactions)
+                                    ),
+                                    **kwargs,
+                                )
+                            )
+                break
+            except _PriorityEscalation as e:
+                txn_run.escalate(e.priority)
+    except BaseException as e:
+        # Including errors of the callback, which are not retried.
+        txn_run.give_up(e)
+        raise
+    txn_run.commit()
+    return result
+
+
+async def run_in_nested_transaction_async(
+    conn,
+    callback,
+    max_retries,
+    max_backoff,
+    inject_error=False,
+    retry_budget=None,
+    backoff=None,
+    txn_run=None,
+    priority_policy=None,
+    commit_on_release=False,
+    **kwargs,
+):
+    classify = get_retry_classifier(_get_dialect(conn))
+    if txn_run is None:
+        txn_run = _TransactionRun(callback)
+    backoff = _get_backoff(backoff, max_backoff)
+
+    if retry_budget is not None and txn_run.attempts == 0:
+        retry_budget.record_attempt()
+    retry_count = 0
+    delay = 0
+    while True:
+        if inject_error and txn_run.retries == 0:
+            await conn.execute(sqlalchemy.text("SET inject_retry_errors_enabled = 'true'"))
+        elif inject_error:
+            await conn.execute(sqlalchemy.text("SET inject_retry_errors_enabled = 'false'"))
+        txn_run.attempt()
+        try:
+            async with _AsyncNestedTransaction(conn, **kwargs) as nested:
+                if txn_run.deadline is not None:
+                    await conn.execute(txn_run.statement_timeout())
+                result = await callback(conn)
+                txn_run.returned_at = perf_counter()
+                # Nothing else runs in the transaction after this callback.
+                nested.commit_on_release = commit_on_release and not isinstance(
+                    result, ChainTransaction
                 )
-        return result
+            return result
+        except sqlalchemy.exc.DBAPIError as e:
+            if _is_timeout(classify, e, txn_run):
+                raise txn_run.timeout_error() from e
+            if txn_run.exhausted(max_retries):
+                raise
+            # Only serialization failures can be retried in place; errors
+            # that end the transaction or the connection are raised.
+            if classify(e) == RETRY_TRANSACTION:
+                if retry_budget is not None and not await retry_budget.acquire_async():
+                    raise
+                txn_run.retry(classify.sqlstate(e))
+                retry_count += 1
+                if priority_policy is not None:
+                    priority = priority_policy.escalate(txn_run.priority, retry_count)
+                    if priority is not None:
+                        raise _PriorityEscalation(priority) from e
+                if backoff is not None:
+                    delay = backoff.delay(retry_count, delay)
+                if txn_run.expired(delay):
+                    raise txn_run.timeout_error() from e
+                if backoff is not None:
+                    txn_run.backoff(delay)
+                    await asyncio.sleep(delay)
+                continue
+            raise
+
+
+async def _txn_retry_loop_async(
+    conn,
+    callback,
+    max_retries,
+    max_backoff,
+    listeners=(),
+    name=None,
+    priority=None,
+    read_only=False,
+    as_of=None,
+    deadline=None,
+    isolation_aware=False,
+    txn_run=None,
+    **kwargs,
+):
+    """The asyncio counterpart of _txn_retry_loop.
+
+    ``conn`` may be either an AsyncConnection or an AsyncSession.
+    """
+    if read_only or as_of is not None:
+        return await _flat_retry_loop_async(
+            conn,
+            callback,
+            max_retries,
+            max_backoff,
+            listeners=listeners,
+            name=name,
+            statement=_as_of_statement(as_of),
+            deadline=deadline,
+            txn_run=txn_run,
+            **kwargs,
+        )
+    priority_policy = get_priority_policy(priority)
+    if isolation_aware and _is_read_committed(conn):
+        # CockroachDB retries the statements of READ COMMITTED transactions
+        # by itself, so a savepoint to restart from is not worth its round
+        # trips. The rare serialization failure reruns the whole transaction.
+        initial = priority_policy.initial if priority_policy is not None else None
+        return await _flat_retry_loop_async(
+            conn,
+            callback,
+            max_retries,
+            max_backoff,
+            listeners=listeners,
+            name=name,
+            statement=_set_priority_statement(initial) if initial is not None else None,
+            deadline=deadline,
+            txn_run=txn_run,
+            **kwargs,
+        )
+    if txn_run is None:
+        txn_run = _TransactionRun(callback, listeners, name, deadline)
+    if priority_policy is not None and txn_run.priority is None:
+        txn_run.priority = priority_policy.initial
+    kwargs.update(txn_run=txn_run, priority_policy=priority_policy)
+    commit_on_release = not isinstance(conn, sqlalchemy.ext.asyncio.AsyncSession)
+    try:
+        while True:
+            try:
+                async with conn.begin():
+                    if txn_run.priority is not None:
+                        await conn.execute(_set_priority_statement(txn_run.priority))
+                    result = await run_in_nested_transaction_async(
+                        conn,
+                        callback,
+                        max_retries,
+                        max_backoff,
+                        commit_on_release=commit_on_release,
+                        **kwargs,
+                    )
+                    if isinstance(result, ChainTransaction):
+                        for i, transaction in enumerate(result.transactions, 1):
+                            result.add_result(
+                                await run_in_nested_transaction_async(
+                                    conn,
+                                    transaction,
+                                    max_retries,
+                                    max_backoff,
+                                    commit_on_release=(
+                                        commit_on_release and i == len(result.transactions)
+                                    ),
+                                    **kwargs,
+                                )
+                            )
+                break
+            except _PriorityEscalation as e:
+                txn_run.escalate(e.priority)
+    except BaseException as e:
+        # Including errors of the callback, which are not retried.
+        txn_run.give_up(e)
+        raise
+    txn_run.commit()
+    return result
@@ -0,0 +1,83 @@
+"""Goodput of run_transaction() on a hot row with each back-off strategy.
+
+A benchmark rather than a test: it is skipped unless
+SQLALCHEMY_COCKROACHDB_BENCH is set. Run it with -s to see the results::
+
+    SQLALCHEMY_COCKROACHDB_BENCH=1 pytest -s test/test_bench_backoff.py
+"""
+import os
+import threading
+import time
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.testing import engines, fixtures
+
+from sqlalchemy_cockroachdb import run_transaction
+from sqlalchemy_cockroachdb.metrics import MetricsCollector
+from sqlalchemy_cockroachdb.retry import (
+    DecorrelatedJitterBackoff,
+    EqualJitterBackoff,
+    FullJitterBackoff,
+)
+
+THREADS = 16
+SECONDS = 3.0
+
+
+@pytest.mark.skipif(
+    not os.environ.get("SQLALCHEMY_COCKROACHDB_BENCH"),
+    reason="benchmark; set SQLALCHEMY_COCKROACHDB_BENCH=1 to run it",
+)
+class BackoffBenchmark(fixtures.TestBase):
+    __requires__ = ("sync_driver",)
+
+    def _goodput(self, label, **kwargs):
+        # Every attempt works on the hot row for 2ms. One that another
+        # thread committed in the meantime fails with a retry error, which
+        # keeps the server's own conflict handling out of the comparison.
+        eng = engines.testing_engine(options={"pool_size": THREADS})
+        collector = MetricsCollector()
+        lock = threading.Lock()
+        version = [0]
+
+        def txn(conn):
+            seen = version[0]
+            conn.execute(text("SELECT 1"))
+            time.sleep(0.002)
+            with lock:
+                conflict = version[0] != seen
+                if not conflict:
+                    version[0] += 1
+            if conflict:
+                if conn.dialect._is_v261plus:
+                    conn.execute(text("SET allow_unsafe_internals = true"))
+                conn.execute(text("SELECT crdb_internal.force_retry('1h')"))
+
+        def worker(stop):
+            while time.monotonic() < stop:
+                run_transaction(eng, txn, listeners=[collector], name="hot", **kwargs)
+
+        stop = time.monotonic() + SECONDS
+        threads = [threading.Thread(target=worker, args=(stop,)) for _ in range(THREADS)]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+        eng.dispose()
+
+        metrics = collector.snapshot()["hot"]
+        attempts = sum(k * v for k, v in metrics["attempts"].items())
+        print(
+            "%-30s %7.1f txn/s %6.2f attempts/txn"
+            % (label, metrics["committed"] / elapsed, attempts / metrics["committed"])
+        )
+
+    def test_goodput(self):
+        print()
+        self._goodput("no back-off (max_backoff=0)", max_backoff=0)
+        self._goodput("full jitter 10ms..1s", backoff=FullJitterBackoff(0.01, 1.0))
+        self._goodput("equal jitter 10ms..1s", backoff=EqualJitterBackoff(0.01, 1.0))
+        self._goodput("decorrelated 10ms..1s", backoff=DecorrelatedJitterBackoff(0.01, 1.0))
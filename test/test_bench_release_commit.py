@@ -0,0 +1,98 @@
+"""Latency of short run_transaction() calls with and without sending
+RELEASE SAVEPOINT and COMMIT in one round trip.
+
+A benchmark rather than a test: it is skipped unless
+SQLALCHEMY_COCKROACHDB_BENCH is set, and only the psycopg dialects send
+the two together. The saving is one round trip per transaction, so run
+it against a remote server, or through a proxy that delays responses,
+with -s to see the results::
+
+    SQLALCHEMY_COCKROACHDB_BENCH=1 pytest -s test/test_bench_release_commit.py \\
+        --dburi cockroachdb+psycopg://root@remote:26257/defaultdb
+"""
+import asyncio
+import os
+import time
+
+import pytest
+from sqlalchemy import Column, Integer, MetaData, Table, testing, text
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.testing import engines, eq_, fixtures
+
+from sqlalchemy_cockroachdb import run_transaction, run_transaction_async
+
+TRANSACTIONS = 100
+
+meta = MetaData()
+
+counter_table = Table(
+    "counter",
+    meta,
+    Column("id", Integer, primary_key=True),
+    Column("n", Integer),
+)
+
+UPDATE = text("UPDATE counter SET n = n + 1 WHERE id = 1")
+
+
+@pytest.mark.skipif(
+    not os.environ.get("SQLALCHEMY_COCKROACHDB_BENCH"),
+    reason="benchmark; set SQLALCHEMY_COCKROACHDB_BENCH=1 to run it",
+)
+class ReleaseCommitBenchmark(fixtures.TestBase):
+    __requires__ = ("sync_driver",)
+
+    def setup_method(self):
+        if not testing.db.dialect._supports_release_and_commit:
+            pytest.skip("only the psycopg dialects send RELEASE and COMMIT together")
+        meta.create_all(testing.db)
+        with testing.db.begin() as conn:
+            conn.execute(counter_table.insert(), {"id": 1, "n": 0})
+
+    def teardown_method(self, method):
+        meta.drop_all(testing.db)
+
+    def _count(self):
+        with testing.db.connect() as conn:
+            return conn.execute(text("SELECT n FROM counter WHERE id = 1")).scalar()
+
+    def _report(self, label, batched, elapsed):
+        print(
+            "%-14s batched=%-5s %6.2f ms/txn"
+            % (label, batched, elapsed / TRANSACTIONS * 1000)
+        )
+
+    def test_sync(self):
+        print()
+        eng = engines.testing_engine()
+        for batched in (False, True):
+            eng.dialect._supports_release_and_commit = batched
+            with eng.connect() as conn:
+                run_transaction(conn, lambda conn: conn.execute(UPDATE))
+                start = time.perf_counter()
+                for _ in range(TRANSACTIONS):
+                    run_transaction(conn, lambda conn: conn.execute(UPDATE))
+                self._report("psycopg", batched, time.perf_counter() - start)
+        eng.dispose()
+        eq_(self._count(), 2 * (TRANSACTIONS + 1))
+
+    def test_async(self):
+        print()
+
+        async def update(conn):
+            await conn.execute(UPDATE)
+
+        async def run():
+            eng = create_async_engine(testing.db.url)
+            for batched in (False, True):
+                eng.dialect._supports_release_and_commit = batched
+                async with eng.connect() as conn:
+                    await run_transaction_async(conn, update)
+                    start = time.perf_counter()
+                    for _ in range(TRANSACTIONS):
+                        await run_transaction_async(conn, update)
+                    self._report("psycopg async", batched, time.perf_counter() - start)
+            await eng.dispose()
+
+        asyncio.run(run())
+        eq_(self._count(), 2 * (TRANSACTIONS + 1))
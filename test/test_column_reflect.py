@@ -96,3 +96,16 @@ class ReflectHiddenColumnsTest(fixtures.TestBase):
                 },
             ],
         )
+
+    def test_reflect_multi_columns(self):
+        insp = inspect(testing.db)
+        for include_hidden in (False, True):
+            multi = insp.get_multi_columns(include_hidden=include_hidden)
+            for table_name in ("with_pk", "without_pk"):
+                for row in multi[(None, table_name)]:
+                    row["type"] = str(row["type"])
+                eq_(
+                    multi[(None, table_name)],
+                    self._get_col_info(table_name, include_hidden=include_hidden),
+                )
+        eq_(list(insp.get_multi_columns(filter_names=["without_pk"])), [(None, "without_pk")])
@@ -0,0 +1,176 @@
+import asyncio
+import time
+
+import pytest
+from sqlalchemy import exc
+from sqlalchemy import text
+from sqlalchemy.testing import async_test, engines, eq_
+from sqlalchemy.testing import fixtures
+
+from sqlalchemy_cockroachdb.hedge import HedgedReads
+from sqlalchemy_cockroachdb.metrics import MetricsCollector
+
+
+class HedgedReadsTest(fixtures.TestBase):
+    def test_invalid(self):
+        with pytest.raises(ValueError, match="at least two engines"):
+            HedgedReads([object()])
+        with pytest.raises(ValueError, match="invalid hedging delay"):
+            HedgedReads([object(), object()], min_delay=0.2, max_delay=0.1)
+
+    def test_delay(self):
+        hedged = HedgedReads([object(), object()], min_delay=0.01, max_delay=0.5, min_samples=10)
+        eq_(hedged.delay(), 0.5)
+        hedged._latencies.extend(i / 1000 for i in range(1, 101))
+        eq_(hedged.delay(), 0.096)
+        hedged._latencies.clear()
+        hedged._latencies.extend([1.0] * 10)
+        eq_(hedged.delay(), 0.5)
+        hedged._latencies.clear()
+        hedged._latencies.extend([0.001] * 10)
+        eq_(hedged.delay(), 0.01)
+
+
+class HedgedReadsSyncTest(fixtures.TestBase):
+    __requires__ = ("sync_driver",)
+
+    def test_hedged_read(self):
+        slow, fast = engines.testing_engine(), engines.testing_engine()
+        hedged = HedgedReads([slow, fast], max_delay=0.05)
+
+        def read(conn):
+            if conn.engine is slow:
+                conn.execute(text("select pg_sleep(2)"))
+            return conn.execute(text("select 1")).scalar()
+
+        start = time.monotonic()
+        eq_(hedged.run(read), 1)
+        assert time.monotonic() - start < 1
+        eq_(hedged.run(read), 1)
+        eq_(
+            {k: v for k, v in hedged.stats().items() if k != "delay"},
+            dict(reads=2, hedges=1, hedge_wins=1, cancellations=1),
+        )
+        # The slow query was cancelled rather than left to run.
+        start = time.monotonic()
+        hedged.close()
+        assert time.monotonic() - start < 1
+
+    def test_listeners(self):
+        # The caller's listeners hear of the winning read alone.
+        slow, fast = engines.testing_engine(), engines.testing_engine()
+        hedged = HedgedReads([slow, fast], max_delay=0.05)
+        collector = MetricsCollector()
+
+        def read(conn):
+            if conn.engine is slow:
+                conn.execute(text("select pg_sleep(2)"))
+            return conn.execute(text("select 1")).scalar()
+
+        eq_(hedged.run(read, listeners=[collector]), 1)
+        hedged.close()
+        totals = collector.totals()
+        eq_((totals["committed"], totals["failed"], totals["attempts"]), (1, 0, {1: 1}))
+
+    def test_name(self):
+        hedged = HedgedReads([engines.testing_engine(), engines.testing_engine()])
+        collector = MetricsCollector()
+
+        def fetch(conn):
+            return conn.execute(text("select 1")).scalar()
+
+        eq_(hedged.run(fetch, listeners=[collector]), 1)
+        eq_(list(collector.snapshot()), [fetch.__qualname__])
+        hedged.close()
+
+    def test_not_hedged(self):
+        engines_ = [engines.testing_engine(), engines.testing_engine()]
+        hedged = HedgedReads(engines_, max_delay=0.5)
+        calls = []
+
+        def read(conn):
+            calls.append(conn.engine)
+            conn.execute(text("select * from no_such_table"))
+
+        with pytest.raises(exc.ProgrammingError, match="no_such_table"):
+            hedged.run(read)
+        eq_(len(calls), 1)
+        eq_(hedged.hedges, 0)
+        hedged.close()
+
+
+class HedgedReadsAsyncTest(fixtures.TestBase):
+    __requires__ = ("async_driver",)
+
+    @async_test
+    async def test_hedged_read(self):
+        slow = engines.testing_engine(asyncio=True)
+        fast = engines.testing_engine(asyncio=True)
+        hedged = HedgedReads([slow, fast], max_delay=0.05)
+
+        async def read(conn):
+            if conn.engine is slow:
+                await conn.execute(text("select pg_sleep(2)"))
+            return (await conn.execute(text("select 1"))).scalar()
+
+        start = time.monotonic()
+        eq_(await hedged.run_async(read), 1)
+        assert time.monotonic() - start < 1
+        eq_(await hedged.run_async(read), 1)
+        eq_(
+            {k: v for k, v in hedged.stats().items() if k != "delay"},
+            dict(reads=2, hedges=1, hedge_wins=1, cancellations=1),
+        )
+
+    @async_test
+    async def test_cancelled(self):
+        engines_ = [engines.testing_engine(asyncio=True) for _ in range(2)]
+        hedged = HedgedReads(engines_, max_delay=0.01)
+
+        async def read(conn):
+            await conn.execute(text("select pg_sleep(2)"))
+
+        task = asyncio.ensure_future(hedged.run_async(read))
+        await asyncio.sleep(0.2)
+        eq_(hedged.hedges, 1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # Both reads were cancelled and gave their connections back.
+        start = time.monotonic()
+        while any(e.sync_engine.pool.checkedout() for e in engines_):
+            assert time.monotonic() - start < 1
+            await asyncio.sleep(0.01)
+
+    @async_test
+    async def test_not_hedged(self):
+        engines_ = [engines.testing_engine(asyncio=True) for _ in range(2)]
+        hedged = HedgedReads(engines_, max_delay=0.5)
+        calls = []
+
+        async def read(conn):
+            calls.append(conn.engine)
+            await conn.execute(text("select * from no_such_table"))
+
+        with pytest.raises(exc.ProgrammingError, match="no_such_table"):
+            await hedged.run_async(read)
+        eq_(len(calls), 1)
+        eq_(hedged.hedges, 0)
+
+    @async_test
+    async def test_listeners(self):
+        slow = engines.testing_engine(asyncio=True)
+        fast = engines.testing_engine(asyncio=True)
+        hedged = HedgedReads([slow, fast], max_delay=0.05)
+        collector = MetricsCollector()
+
+        async def read(conn):
+            if conn.engine is slow:
+                await conn.execute(text("select pg_sleep(2)"))
+            return (await conn.execute(text("select 1"))).scalar()
+
+        eq_(await hedged.run_async(read, listeners=[collector]), 1)
+        # Give the cancelled read time to give up.
+        await asyncio.sleep(0.2)
+        totals = collector.totals()
+        eq_((totals["committed"], totals["failed"], totals["attempts"]), (1, 0, {1: 1}))
@@ -5,14 +5,16 @@ from sqlalchemy import (
     Column,
     MetaData,
     testing,
+    inspect,
     ForeignKey,
     UniqueConstraint,
     CheckConstraint,
+    event,
     text,
 )
 from sqlalchemy.types import Integer, String, Boolean
 import sqlalchemy.types as sqltypes
-from sqlalchemy.testing import fixtures
+from sqlalchemy.testing import engines, eq_, fixtures, is_false, is_true
 from sqlalchemy.dialects.postgresql import INET
 from sqlalchemy.dialects.postgresql import UUID
 
@@ -65,6 +67,101 @@ class IntrospectionTest(fixtures.TestBase):
         Table("index", meta2, autoload_with=testing.db)
         Table("view", meta2, autoload_with=testing.db)
 
+    def test_legacy_reflection(self):
+        # Versions before v19.2 reflect indexes and constraints from
+        # information_schema.statistics, which current versions still have.
+        eng = engines.testing_engine()
+        with eng.connect() as conn:
+            conn.dialect._is_v192plus = conn.dialect._is_v21plus = False
+            insp = inspect(conn)
+            eq_(insp.get_indexes("customer"), [])
+            eq_(insp.get_pk_constraint("customer")["constrained_columns"], ["id"])
+            eq_(
+                insp.get_unique_constraints("customer"),
+                [{"name": "customer_email_key", "column_names": ["email"]}],
+            )
+            eq_(
+                insp.get_multi_pk_constraint(filter_names=["customer", "order"]),
+                {
+                    (None, "customer"): insp.get_pk_constraint("customer"),
+                    (None, "order"): insp.get_pk_constraint("order"),
+                },
+            )
+
+    @testing.provide_metadata
+    def test_postgis_tables(self):
+        # The tables that the PostGIS extension creates are left out.
+        Table(
+            "spatial_ref_sys",
+            self.metadata,
+            Column("srid", Integer, primary_key=True),
+            Column("auth_name", String),
+            UniqueConstraint("auth_name"),
+        )
+        self.metadata.create_all(testing.db)
+        for legacy in (False, True):
+            eng = engines.testing_engine()
+            with eng.connect() as conn:
+                if legacy:
+                    conn.dialect._is_v192plus = conn.dialect._is_v21plus = False
+                insp = inspect(conn)
+                for result in (
+                    insp.get_multi_indexes(),
+                    insp.get_multi_pk_constraint(),
+                    insp.get_multi_unique_constraints(),
+                    insp.get_multi_check_constraints(),
+                ):
+                    is_true((None, "customer") in result)
+                    is_false((None, "spatial_ref_sys") in result)
+
+    def test_has_table_checkfirst(self):
+        # Each check of create_all() and drop_all() looks up its table.
+        eng = engines.testing_engine()
+        statements = []
+        event.listen(eng, "before_cursor_execute", lambda *args: statements.append(args[2]))
+        with eng.begin() as conn:
+            is_true(eng.dialect.has_table(conn, "customer"))
+            is_false(eng.dialect.has_table(conn, "nonexistent"))
+            eq_(len(statements), 2)
+            del statements[:]
+            meta.drop_all(conn, tables=[index_table, view_table])
+            eq_([s.split()[0] for s in statements], ["SELECT", "SELECT", "DROP", "DROP"])
+            del statements[:]
+            meta.create_all(conn)
+            eq_([s.split()[0] for s in statements], ["SELECT"] * 4 + ["CREATE", "CREATE"])
+            is_true(eng.dialect.has_table(conn, "index"))
+
+    def test_has_table_inspector(self):
+        # The second check through an Inspector lists the tables of the
+        # schema, which answers the checks after it.
+        eng = engines.testing_engine()
+        statements = []
+        event.listen(eng, "before_cursor_execute", lambda *args: statements.append(args[2]))
+        with eng.connect() as conn:
+            insp = inspect(conn)
+            is_true(insp.has_table("customer"))
+            eq_(len(statements), 1)
+            is_true(insp.has_table("order"))
+            is_true(insp.has_table("index"))
+            is_false(insp.has_table("nonexistent"))
+            eq_(len(statements), 2)
+
+    def test_has_table_other_session(self):
+        # A table that another session creates shows up, e.g. when
+        # polling for it.
+        eng = engines.testing_engine()
+        with eng.connect() as conn:
+            conn.execution_options(isolation_level="AUTOCOMMIT")
+            is_false(inspect(conn).has_table("polled"))
+            is_false(inspect(conn).has_table("polled"))
+            with testing.db.begin() as other:
+                other.execute(text("CREATE TABLE polled (id INT PRIMARY KEY)"))
+            try:
+                is_true(inspect(conn).has_table("polled"))
+            finally:
+                with testing.db.begin() as other:
+                    other.execute(text("DROP TABLE polled"))
+
 
 class TestTypeReflection(fixtures.TestBase):
     __requires__ = ("sync_driver",)
@@ -0,0 +1,52 @@
+from sqlalchemy.testing import eq_
+from sqlalchemy.testing import fixtures
+
+from sqlalchemy_cockroachdb.metrics import MetricsCollector
+
+
+class MetricsCollectorTest(fixtures.TestBase):
+    """No live database connection required."""
+
+    def test_snapshot(self):
+        collector = MetricsCollector()
+        collector.on_attempt("transfer", 1)
+        collector.on_retry("transfer", 1, "40001")
+        collector.on_backoff("transfer", 1, 0.25)
+        collector.on_priority("transfer", 1, "HIGH")
+        collector.on_attempt("transfer", 2)
+        collector.on_commit("transfer", 2, 0.3, 0.02)
+        collector.on_attempt("transfer", 1)
+        collector.on_commit("transfer", 1, 0.004, 0.001)
+        collector.on_lock_wait("report", 0.0)
+        collector.on_lock_wait("report", 0.5)
+        collector.on_attempt("report", 1)
+        collector.on_give_up("report", 1, 12.0, Exception())
+
+        snapshot = collector.snapshot()
+        eq_(sorted(snapshot), ["report", "transfer"])
+
+        transfer = snapshot["transfer"]
+        eq_(transfer["transactions"], 2)
+        eq_(transfer["committed"], 2)
+        eq_(transfer["failed"], 0)
+        eq_(transfer["attempts"], {1: 1, 2: 1})
+        eq_(transfer["retries"], {"40001": 1})
+        eq_(transfer["escalations"], {"HIGH": 1})
+        eq_(transfer["wall_time"][0.005], 1)
+        eq_(transfer["wall_time"][0.5], 1)
+        eq_(transfer["backoff_total"], 0.25)
+        eq_(transfer["commit_latency_max"], 0.02)
+
+        report = snapshot["report"]
+        eq_(report["failed"], 1)
+        eq_(report["wall_time"][float("inf")], 1)
+        eq_((report["lock_waits"], report["lock_wait_max"]), (1, 0.5))
+
+        totals = collector.totals()
+        eq_(totals["transactions"], 3)
+        eq_(totals["attempts"], {1: 2, 2: 1})
+        eq_(totals["retries"], {"40001": 1})
+        eq_(totals["wall_time_max"], 12.0)
+
+        collector.reset()
+        eq_(collector.snapshot(), {})
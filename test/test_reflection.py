@@ -0,0 +1,197 @@
+import os
+
+import pytest
+from sqlalchemy import Column, ForeignKey, Integer, MetaData, String, Table, event, inspect
+from sqlalchemy import testing, text
+from sqlalchemy.testing import engines, eq_, fixtures
+
+from sqlalchemy_cockroachdb.reflection import ReflectionCache, reflect_parallel, reflect_snapshot
+
+meta = MetaData()
+
+parent_table = Table(
+    "parent",
+    meta,
+    Column("id", Integer, primary_key=True),
+    Column("name", String),
+)
+
+child_table = Table(
+    "child",
+    meta,
+    Column("id", Integer, primary_key=True),
+    Column("parent_id", Integer, ForeignKey("parent.id")),
+)
+
+
+def _testing_engine(**options):
+    if testing.db.dialect._is_v261plus:
+        # The cache reads table versions from crdb_internal, which is off
+        # limits by default from v26.1 on.
+        options["connect_args"] = {"options": "-c allow_unsafe_internals=true"}
+    return engines.testing_engine(options=options)
+
+
+class ReflectionCacheTest(fixtures.TestBase):
+    __requires__ = ("sync_driver",)
+
+    def teardown_method(self, method):
+        meta.drop_all(testing.db)
+
+    def setup_method(self):
+        meta.create_all(testing.db)
+
+    def _reflect(self, bind):
+        meta2 = MetaData()
+        meta2.reflect(bind, only=["parent", "child"])
+        return {name: [c.name for c in table.c] for name, table in meta2.tables.items()}
+
+    def test_shared_cache(self):
+        cache = ReflectionCache()
+        first = _testing_engine(reflection_cache=cache)
+        second = _testing_engine(reflection_cache=cache)
+        expected = {"parent": ["id", "name"], "child": ["id", "parent_id"]}
+
+        # Six reflection methods for two tables.
+        eq_(self._reflect(first), expected)
+        eq_(cache.stats(), dict(hits=0, misses=12, evictions=0, size=12))
+
+        # Another engine finds everything in the cache.
+        eq_(self._reflect(second), expected)
+        eq_(cache.stats(), dict(hits=12, misses=12, evictions=0, size=12))
+
+        # Changing parent invalidates its six entries and the foreign keys
+        # of child, which refer to it, but not the other five of child.
+        with testing.db.begin() as conn:
+            conn.execute(text("ALTER TABLE parent ADD COLUMN extra INT"))
+        eq_(self._reflect(second), dict(expected, parent=["id", "name", "extra"]))
+        eq_(cache.stats(), dict(hits=17, misses=19, evictions=0, size=12))
+
+    def test_explicit_schema(self):
+        # Foreign keys name the referred schema only if it was named.
+        cache = ReflectionCache()
+        eng = _testing_engine(reflection_cache=cache)
+        schema = testing.db.dialect.default_schema_name
+        with eng.connect() as conn:
+            for name in (None, schema, None, schema):
+                fks = inspect(conn).get_foreign_keys("child", schema=name)
+                eq_([fk["referred_schema"] for fk in fks], [name])
+        eq_(cache.stats()["hits"], 2)
+        meta2 = MetaData()
+        meta2.reflect(eng, schema=schema, only=["child"])
+        eq_(sorted(meta2.tables), ["%s.child" % schema, "%s.parent" % schema])
+
+    @testing.skip_if(
+        lambda config: not config.db.dialect._is_v261plus,
+        "crdb_internal is readable without allow_unsafe_internals before v26.1",
+    )
+    def test_internals_not_allowed(self):
+        # Without allow_unsafe_internals, the cache isn't used, and the
+        # transaction reflection runs in isn't aborted.
+        cache = ReflectionCache()
+        eng = engines.testing_engine(options={"reflection_cache": cache})
+        with eng.begin() as conn:
+            eq_(
+                self._reflect(conn),
+                {"parent": ["id", "name"], "child": ["id", "parent_id"]},
+            )
+            eq_(conn.execute(text("SELECT 1")).scalar(), 1)
+        eq_(cache.stats(), dict(hits=0, misses=0, evictions=0, size=0))
+
+
+class ReflectionCacheEvictionTest(fixtures.TestBase):
+    def test_lru(self):
+        cache = ReflectionCache(maxsize=2)
+        versions = {"a": (1, 1), "b": (2, 1), "c": (3, 1)}
+        for name in "ab":
+            cache._put(name, ((name, versions[name]),), name.upper())
+        eq_(cache._get("a", versions), "A")
+        cache._put("c", (("c", versions["c"]),), "C")
+        eq_(cache._get("b", versions), None)
+        eq_(cache._get("a", versions), "A")
+        eq_(cache._get("a", dict(versions, a=(1, 2))), None)
+        eq_(cache.stats(), dict(hits=2, misses=2, evictions=1, size=1))
+
+    def test_invalid(self):
+        with pytest.raises(ValueError, match="maxsize must be positive"):
+            ReflectionCache(maxsize=0)
+
+
+class ReflectionSnapshotTest(fixtures.TestBase):
+    __requires__ = ("sync_driver",)
+
+    def teardown_method(self, method):
+        meta.drop_all(testing.db)
+
+    def setup_method(self):
+        meta.create_all(testing.db)
+
+    def test_snapshot(self, tmp_path):
+        path = str(tmp_path / "schema.snapshot")
+        cache = ReflectionCache()
+        eng = _testing_engine(reflection_cache=cache)
+        statements = []
+        event.listen(eng, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+        meta2 = reflect_snapshot(eng, path, only=["parent", "child"])
+        eq_(sorted(meta2.tables), ["child", "parent"])
+
+        # Loaded from the file with a single query, after checking that
+        # crdb_internal may be read.
+        queries = 2 if testing.db.dialect._is_v261plus else 1
+        del statements[:]
+        cache.clear()
+        meta3 = reflect_snapshot(eng, path, only=["parent", "child"])
+        eq_(len(statements), queries)
+        eq_([c.name for c in meta3.tables["child"].c], ["id", "parent_id"])
+        # Along with the entries of the reflection cache, for six methods
+        # and two tables.
+        eq_(len(cache), 12)
+
+        # A schema change makes the snapshot stale.
+        with testing.db.begin() as conn:
+            conn.execute(text("ALTER TABLE parent ADD COLUMN extra INT"))
+        meta4 = reflect_snapshot(eng, path, only=["parent", "child"])
+        eq_([c.name for c in meta4.tables["parent"].c], ["id", "name", "extra"])
+        del statements[:]
+        reflect_snapshot(eng, path, only=["parent", "child"])
+        eq_(len(statements), queries)
+
+    def test_not_literal(self, tmp_path):
+        path = str(tmp_path / "schema.snapshot")
+        with pytest.raises(TypeError, match="arguments must be literals"):
+            reflect_snapshot(_testing_engine(), path, only=lambda name, meta: True)
+
+    @testing.skip_if(
+        lambda config: not config.db.dialect._is_v261plus,
+        "crdb_internal is readable without allow_unsafe_internals before v26.1",
+    )
+    def test_internals_not_allowed(self, tmp_path):
+        # Without allow_unsafe_internals, the schema is reflected every
+        # time, and no snapshot is written.
+        path = str(tmp_path / "schema.snapshot")
+        eng = engines.testing_engine()
+        meta2 = reflect_snapshot(eng, path, only=["parent", "child"])
+        eq_(sorted(meta2.tables), ["child", "parent"])
+        assert not os.path.exists(path)
+
+
+class ReflectParallelTest(fixtures.TestBase):
+    __requires__ = ("sync_driver",)
+
+    def teardown_method(self, method):
+        meta.drop_all(testing.db)
+
+    def setup_method(self):
+        meta.create_all(testing.db)
+
+    def test_reflect_parallel(self):
+        # One table per chunk; child's chunk reflects parent as well.
+        meta2 = reflect_parallel(testing.db, chunk_size=1)
+        assert {"child", "parent"} <= set(meta2.tables)
+        eq_([c.name for c in meta2.tables["parent"].c], ["id", "name"])
+        assert meta2.tables["child"].c.parent_id.references(meta2.tables["parent"].c.id)
+
+    def test_invalid(self):
+        with pytest.raises(TypeError, match="don't know how to reflect in parallel"):
+            reflect_parallel(object())
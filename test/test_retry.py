@@ -0,0 +1,354 @@
+import asyncio
+import datetime
+import threading
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.testing import async_test, eq_
+from sqlalchemy.testing import fixtures
+
+from sqlalchemy_cockroachdb.retry import (
+    RETRY_AMBIGUOUS,
+    RETRY_CONNECTION,
+    RETRY_TRANSACTION,
+    ConcurrencyLimiter,
+    ContentionLocks,
+    DecorrelatedJitterBackoff,
+    EqualJitterBackoff,
+    FullJitterBackoff,
+    PriorityPolicy,
+    RetryBudget,
+    RetryClassifier,
+    get_priority_policy,
+)
+from sqlalchemy_cockroachdb.transaction import _as_of_statement, _get_backoff
+
+
+class _FakeError(Exception):
+    def __init__(self, **attrs):
+        super().__init__("fake")
+        self.__dict__.update(attrs)
+
+
+def _wrap(orig, connection_invalidated=False):
+    return DBAPIError("SELECT 1", {}, orig, connection_invalidated=connection_invalidated)
+
+
+class RetryClassifierTest(fixtures.TestBase):
+    """No live database connection required."""
+
+    def test_sqlstates(self):
+        classify = RetryClassifier("pgcode")
+        eq_(classify(_wrap(_FakeError(pgcode="40001"))), RETRY_TRANSACTION)
+        eq_(classify(_wrap(_FakeError(pgcode="40003"))), RETRY_AMBIGUOUS)
+        eq_(classify(_wrap(_FakeError(pgcode="57P01"))), RETRY_CONNECTION)
+        eq_(classify(_wrap(_FakeError(pgcode="23505"))), None)
+        eq_(classify(_wrap(_FakeError())), None)
+
+    def test_sqlstate_attr(self):
+        classify = RetryClassifier("sqlstate")
+        eq_(classify(_wrap(_FakeError(sqlstate="40001"))), RETRY_TRANSACTION)
+        eq_(classify(_wrap(_FakeError(pgcode="40001"))), None)
+
+    def test_connection_invalidated(self):
+        classify = RetryClassifier("pgcode")
+        eq_(classify(_wrap(_FakeError(), connection_invalidated=True)), RETRY_CONNECTION)
+
+    def test_predicates(self):
+        classify = RetryClassifier(
+            "pgcode",
+            [
+                lambda e: e.orig.pgcode == "XX001",
+                lambda e: RETRY_CONNECTION if e.orig.pgcode == "XX002" else None,
+            ],
+        )
+        eq_(classify(_wrap(_FakeError(pgcode="XX001"))), RETRY_TRANSACTION)
+        eq_(classify(_wrap(_FakeError(pgcode="XX002"))), RETRY_CONNECTION)
+        eq_(classify(_wrap(_FakeError(pgcode="XX003"))), None)
+
+    def test_engine_retry_predicates(self):
+        def predicate(e):
+            return False
+
+        engine = create_engine(
+            "cockroachdb+psycopg2://root@localhost:26257/defaultdb",
+            retry_predicates=[predicate],
+        )
+        eq_(engine.dialect.retry_predicates, [predicate])
+
+
+class RetryBudgetTest(fixtures.TestBase):
+    """No live database connection required."""
+
+    def test_fail_fast(self):
+        budget = RetryBudget(ratio=0.5, min_retries_per_second=0, max_tokens=2)
+        assert budget.acquire()
+        assert budget.acquire()
+        assert not budget.acquire()
+        budget.record_attempt()
+        assert not budget.acquire()
+        budget.record_attempt()
+        assert budget.acquire()
+        stats = budget.stats()
+        eq_(
+            (stats["attempts"], stats["retries"], stats["rejected"], stats["waits"]),
+            (2, 3, 2, 0),
+        )
+
+    def test_wait_for_refill(self):
+        budget = RetryBudget(ratio=0, min_retries_per_second=100, max_tokens=1, max_wait=1)
+        assert budget.acquire()
+        assert budget.acquire()
+        eq_(budget.waits, 1)
+        assert budget.wait_time > 0
+
+    def test_wait_times_out(self):
+        budget = RetryBudget(ratio=0, min_retries_per_second=0, max_tokens=1, max_wait=0.01)
+        assert budget.try_acquire()
+        assert not budget.acquire()
+        eq_(budget.rejected, 1)
+
+
+class ContentionLocksTest(fixtures.TestBase):
+    """No live database connection required."""
+
+    def test_serialize(self):
+        locks = ContentionLocks(stripes=4)
+        eq_(locks.acquire("counter"), 0.0)
+        waited = []
+        thread = threading.Thread(target=lambda: waited.append(locks.acquire("counter")))
+        thread.start()
+        thread.join(0.05)
+        assert thread.is_alive()
+        locks.release("counter")
+        thread.join()
+        assert waited[0] > 0
+        locks.release("counter")
+        stats = locks.stats()
+        eq_((stats["acquisitions"], stats["waits"], stats["timeouts"]), (2, 1, 0))
+        eq_(stats["max_wait_time"], waited[0])
+
+    def test_timeout(self):
+        locks = ContentionLocks(stripes=1)
+        locks.acquire("a")
+        # Keys that share a stripe are serialized too.
+        results = []
+
+        def acquire():
+            results.append(locks.acquire("b", timeout=0.01))
+            results.append(locks.acquire("b", timeout=0))
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        thread.join()
+        eq_(results, [None, None])
+        eq_(locks.timeouts, 2)
+
+    def test_nested(self):
+        # A thread that holds a stripe may take it again, for another key
+        # too; other threads still wait until it is released as often.
+        locks = ContentionLocks(stripes=1)
+        eq_(locks.acquire("a"), 0.0)
+        eq_(locks.acquire("b", timeout=0), 0.0)
+        acquired = []
+        thread = threading.Thread(target=lambda: acquired.append(locks.acquire("a", timeout=0)))
+        thread.start()
+        thread.join()
+        eq_(acquired, [None])
+        locks.release("b")
+        assert locks.acquire("c", timeout=0.01) == 0.0
+        locks.release("c")
+        locks.release("a")
+        thread = threading.Thread(target=lambda: acquired.append(locks.acquire("a", timeout=0)))
+        thread.start()
+        thread.join()
+        eq_(acquired, [None, 0.0])
+
+    @async_test
+    async def test_nested_async(self):
+        locks = ContentionLocks(stripes=1)
+        eq_(await locks.acquire_async("a"), 0.0)
+        eq_(await locks.acquire_async("b", timeout=0), 0.0)
+
+        async def other():
+            return await locks.acquire_async("a", timeout=0.01)
+
+        # Tasks share the thread but not the lock.
+        assert await asyncio.ensure_future(other()) is None
+        locks.release("b")
+        locks.release("a")
+        assert await asyncio.ensure_future(other()) == 0.0
+
+    @async_test
+    async def test_acquire_async(self):
+        locks = ContentionLocks(stripes=1)
+        locks.acquire("a")
+        assert await locks.acquire_async("b", timeout=0.01) is None
+        asyncio.get_running_loop().call_later(0.01, locks.release, "a")
+        assert await locks.acquire_async("b", timeout=1) > 0
+        eq_((locks.acquisitions, locks.waits, locks.timeouts), (2, 2, 1))
+
+    def test_invalid(self):
+        with pytest.raises(ValueError, match="stripes must be at least 1"):
+            ContentionLocks(stripes=0)
+
+
+class ConcurrencyLimiterTest(fixtures.TestBase):
+    """No live database connection required."""
+
+    def test_admission(self):
+        limiter = ConcurrencyLimiter(initial_limit=1)
+        eq_(limiter.acquire(), 0.0)
+        assert limiter.acquire(timeout=0.01) is None
+        waited = []
+        thread = threading.Thread(target=lambda: waited.append(limiter.acquire()))
+        thread.start()
+        thread.join(0.05)
+        eq_((limiter.in_flight, limiter.queue_depth), (1, 1))
+        limiter.release()
+        thread.join()
+        assert waited[0] > 0
+        limiter.release()
+        stats = limiter.stats()
+        eq_(
+            (stats["in_flight"], stats["queue_depth"], stats["rejected"], stats["waits"]),
+            (0, 0, 1, 1),
+        )
+
+    def _run(self, limiter, transactions, retries=0, error=None):
+        for _ in range(transactions):
+            limiter.on_attempt("t", 1)
+            for attempt in range(retries):
+                limiter.on_retry("t", attempt + 1, "40001")
+                limiter.on_attempt("t", attempt + 2)
+            if error is None:
+                limiter.on_commit("t", retries + 1, 0.01, 0.001)
+            else:
+                limiter.on_give_up("t", retries + 1, 0.01, error)
+
+    def test_aimd(self):
+        limiter = ConcurrencyLimiter(initial_limit=8, max_limit=10, window=5, threshold=0.2)
+        self._run(limiter, 5)
+        eq_(limiter.limit, 9)
+        self._run(limiter, 4, retries=1)
+        eq_(limiter.limit, 9)
+        self._run(limiter, 1, retries=1)
+        eq_(limiter.limit, 4)
+        self._run(limiter, 5, error=TimeoutError())
+        eq_(limiter.limit, 2)
+        self._run(limiter, 10, error=Exception())
+        eq_(limiter.limit, 4)
+        eq_((limiter.increases, limiter.decreases), (3, 2))
+
+    @async_test
+    async def test_acquire_async(self):
+        limiter = ConcurrencyLimiter(initial_limit=1)
+        await limiter.acquire_async()
+        assert await limiter.acquire_async(timeout=0.01) is None
+        asyncio.get_running_loop().call_later(0.01, limiter.release)
+        assert await limiter.acquire_async(timeout=1) > 0
+        eq_((limiter.in_flight, limiter.queue_depth, limiter.rejected), (1, 0, 1))
+
+    def test_invalid(self):
+        for kwargs, message in [
+            (dict(initial_limit=0), "invalid limits"),
+            (dict(min_limit=5, initial_limit=2), "invalid limits"),
+            (dict(window=0), "invalid concurrency limiter"),
+        ]:
+            with pytest.raises(ValueError, match=message):
+                ConcurrencyLimiter(**kwargs)
+
+
+class BackoffTest(fixtures.TestBase):
+    """No live database connection required."""
+
+    def test_full_jitter(self):
+        backoff = FullJitterBackoff(base=0.1, cap=0.5)
+        for retry_count, ceiling in [(1, 0.1), (2, 0.2), (3, 0.4), (4, 0.5), (1000, 0.5)]:
+            for _ in range(20):
+                assert 0 <= backoff.delay(retry_count, 0) <= ceiling
+
+    def test_equal_jitter(self):
+        backoff = EqualJitterBackoff(base=0.1, cap=0.5)
+        for retry_count, ceiling in [(1, 0.1), (3, 0.4), (1000, 0.5)]:
+            for _ in range(20):
+                assert ceiling / 2 <= backoff.delay(retry_count, 0) <= ceiling
+
+    def test_decorrelated_jitter(self):
+        backoff = DecorrelatedJitterBackoff(base=0.1, cap=0.5)
+        delay = 0
+        for retry_count in range(1, 20):
+            previous, delay = delay, backoff.delay(retry_count, delay)
+            assert 0.1 <= delay <= min(0.5, max(previous, 0.1) * 3)
+
+    def test_invalid(self):
+        for base, cap in [(0, 1), (1, 0.5)]:
+            with pytest.raises(ValueError, match="invalid back-off"):
+                FullJitterBackoff(base=base, cap=cap)
+
+    def test_max_backoff(self):
+        eq_(_get_backoff(None, 0), None)
+        assert _get_backoff(None, None) is not None
+        backoff = _get_backoff(None, 5)
+        eq_((backoff.base, backoff.cap), (0.2, 5))
+        strategy = EqualJitterBackoff()
+        assert _get_backoff(strategy, 5) is strategy
+
+
+class AsOfTest(fixtures.TestBase):
+    """No live database connection required."""
+
+    def test_as_of(self):
+        for as_of, expression in [
+            (None, "follower_read_timestamp()"),
+            ("-10s", "'-10s'"),
+            (datetime.timedelta(seconds=1.5), "'-1500000us'"),
+            (datetime.datetime(2026, 1, 2, 3, 4, 5), "'2026-01-02T03:04:05'"),
+        ]:
+            eq_(
+                _as_of_statement(as_of).compile().string,
+                "SET TRANSACTION AS OF SYSTEM TIME " + expression,
+            )
+
+    def test_invalid(self):
+        for as_of, message in [
+            ("now()", "invalid as_of"),
+            ("10s", "invalid as_of"),
+            ("-1s; SELECT 1", "invalid as_of"),
+            (datetime.timedelta(0), "as_of must be in the past"),
+            (5, "invalid as_of"),
+        ]:
+            with pytest.raises(ValueError, match=message):
+                _as_of_statement(as_of)
+
+
+class PriorityPolicyTest(fixtures.TestBase):
+    """No live database connection required."""
+
+    def test_escalate(self):
+        policy = PriorityPolicy(initial="low", escalate_after=2)
+        eq_(policy.initial, "LOW")
+        eq_(policy.escalate("LOW", 1), None)
+        eq_(policy.escalate("LOW", 2), "NORMAL")
+        eq_(policy.escalate(None, 2), "HIGH")
+        eq_(policy.escalate("HIGH", 5), None)
+
+    def test_maximum(self):
+        policy = PriorityPolicy(escalate_after=1, maximum="NORMAL")
+        eq_(policy.escalate("LOW", 1), "NORMAL")
+        eq_(policy.escalate("NORMAL", 1), None)
+
+    def test_fixed_priority(self):
+        policy = get_priority_policy("high")
+        eq_(policy.initial, "HIGH")
+        eq_(policy.escalate("HIGH", 100), None)
+        eq_(get_priority_policy(None), None)
+
+    def test_invalid(self):
+        for kwargs, message in [
+            (dict(initial="urgent"), "unknown transaction priority"),
+            (dict(escalate_after=0), "escalate_after must be at least 1"),
+        ]:
+            with pytest.raises(ValueError, match=message):
+                PriorityPolicy(**kwargs)
@@ -0,0 +1,198 @@
+import asyncio
+import types
+
+import pytest
+from sqlalchemy import Table, Column, select, testing, text
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.testing import async_test, engines, fixtures, is_false
+from sqlalchemy.types import Integer
+
+from sqlalchemy_cockroachdb import run_transaction_async
+from sqlalchemy_cockroachdb.metrics import MetricsCollector
+from sqlalchemy_cockroachdb.transaction import ChainTransaction
+
+
+class RunTransactionAsyncTest(fixtures.TablesTest):
+    __requires__ = ("async_driver",)
+
+    run_inserts = "each"
+    run_deletes = "each"
+
+    @classmethod
+    def define_tables(cls, metadata):
+        Table(
+            "account",
+            metadata,
+            Column("acct", Integer, primary_key=True, autoincrement=False),
+            Column("balance", Integer),
+        )
+
+    @classmethod
+    def insert_data(cls, connection):
+        connection.execute(
+            cls.tables.account.insert(),
+            [dict(acct=1, balance=100), dict(acct=2, balance=100)],
+        )
+
+    @testing.fixture
+    def async_engine(self):
+        return engines.testing_engine(asyncio=True)
+
+    async def _force_retry_body(self, conn):
+        rs = await conn.execute(text("select acct, balance from account where acct = 1"))
+        if testing.db.dialect._is_v261plus:
+            await conn.execute(text("SET allow_unsafe_internals = true"))
+        await conn.execute(text("select crdb_internal.force_retry('1s')"))
+        return [r for r in rs]
+
+    @async_test
+    async def test_run_transaction_retry(self, async_engine):
+        async with async_engine.connect() as conn:
+            rs = await run_transaction_async(conn, self._force_retry_body, max_backoff=1)
+            assert rs[0] == (1, 100)
+
+    @async_test
+    async def test_run_transaction_engine(self, async_engine):
+        account_table = self.tables.account
+
+        async def txn_body(conn):
+            await conn.execute(
+                account_table.update()
+                .where(account_table.c.acct == 1)
+                .values(balance=account_table.c.balance - 10)
+            )
+            return (
+                await conn.execute(
+                    select(account_table.c.balance).where(account_table.c.acct == 1)
+                )
+            ).scalar()
+
+        assert await run_transaction_async(async_engine, txn_body) == 90
+
+    @async_test
+    async def test_run_transaction_reconnect(self, async_engine):
+        account_table = self.tables.account
+        calls = []
+
+        def close_dbapi_connection(conn):
+            conn.connection.dbapi_connection.close()
+
+        async def txn_body(conn):
+            calls.append(1)
+            if len(calls) == 1:
+                await conn.run_sync(close_dbapi_connection)
+            await conn.execute(
+                account_table.update().where(account_table.c.acct == 1).values(balance=0)
+            )
+
+        await run_transaction_async(async_engine, txn_body)
+        assert len(calls) == 2
+        async with async_engine.connect() as conn:
+            balance = await conn.scalar(
+                select(account_table.c.balance).where(account_table.c.acct == 1)
+            )
+            assert balance == 0
+
+    @async_test
+    async def test_run_transaction_callback_error(self, async_engine):
+        async def txn_body(conn):
+            await conn.execute(text("select 1"))
+            raise ValueError("not retried")
+
+        collector = MetricsCollector()
+        async with async_engine.connect() as conn:
+            for transactor in (conn, async_engine):
+                with pytest.raises(ValueError, match="not retried"):
+                    await run_transaction_async(transactor, txn_body, listeners=[collector])
+        metrics = collector.totals()
+        assert (metrics["committed"], metrics["failed"]) == (0, 2)
+
+    @async_test
+    async def test_run_transaction_implicit(self, async_engine):
+        account_table = self.tables.account
+
+        async def txn_body(conn):
+            return (
+                await conn.execute(
+                    account_table.update()
+                    .where(account_table.c.acct == 1)
+                    .values(balance=account_table.c.balance - 10)
+                )
+            ).rowcount
+
+        assert await run_transaction_async(async_engine, txn_body, implicit=True) == 1
+        async with async_engine.connect() as conn:
+            assert await run_transaction_async(conn, txn_body, implicit=True) == 1
+            assert not conn.in_transaction()
+            assert await conn.get_isolation_level() != "AUTOCOMMIT"
+            balance = await conn.scalar(
+                select(account_table.c.balance).where(account_table.c.acct == 1)
+            )
+            assert balance == 80
+
+    @async_test
+    async def test_run_transaction_sessionmaker(self, async_engine):
+        Session = async_sessionmaker(async_engine)
+        rs = await run_transaction_async(Session, self._force_retry_body)
+        assert rs[0] == (1, 100)
+
+    @async_test
+    async def test_run_chained_transaction(self, async_engine):
+        account_table = self.tables.account
+
+        async def _get_val(conn):
+            rs = await conn.execute(text("select acct, balance from account where acct = 99"))
+            return [r for r in rs]
+
+        async def txn_body(conn):
+            await conn.execute(account_table.insert(), [dict(acct=99, balance=100)])
+            return ChainTransaction([_get_val, _get_val])
+
+        async with async_engine.connect() as conn:
+            rs = await run_transaction_async(conn, txn_body, use_cockroach_restart=False)
+            assert rs.results[0][0] == (99, 100)
+            assert rs.results[1][0] == (99, 100)
+
+    @async_test
+    async def test_concurrent_savepoints(self, async_engine):
+        # The retry loops and the plain savepoints run in tasks that share
+        # one thread; only the former may use cockroach_restart.
+        async def txn_body(conn):
+            return (await conn.execute(text("select 1"))).scalar()
+
+        async def retry_loops():
+            async with async_engine.connect() as conn:
+                for _ in range(20):
+                    assert await run_transaction_async(conn, txn_body) == 1
+
+        async def plain_savepoints():
+            async with async_engine.connect() as conn:
+                for _ in range(20):
+                    async with conn.begin():
+                        async with conn.begin_nested():
+                            await conn.execute(text("select 1"))
+
+        await asyncio.gather(retry_loops(), retry_loops(), plain_savepoints(), plain_savepoints())
+
+    @async_test
+    async def test_cancelled_query_keeps_connection(self, async_engine):
+        async def driver_connection():
+            async with async_engine.connect() as conn:
+                return (await conn.get_raw_connection()).driver_connection
+
+        async def slow_query():
+            async with async_engine.connect() as conn:
+                await conn.execute(text("select pg_sleep(10)"))
+
+        before = await driver_connection()
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(slow_query(), 0.5)
+        # The query was cancelled on the server and the connection went
+        # back to the pool instead of being closed.
+        assert await driver_connection() is before
+
+    def test_cancelled_unknown_driver(self, async_engine):
+        # Without asyncpg's record of its cancel requests, the connection
+        # is discarded.
+        dbapi_connection = types.SimpleNamespace(driver_connection=object())
+        is_false(async_engine.dialect._is_cancelled_cleanly(dbapi_connection))
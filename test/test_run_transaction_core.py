@@ -1,13 +1,20 @@
 from concurrent.futures import ThreadPoolExecutor
-from sqlalchemy import Table, Column, MetaData, select, testing, text
-from sqlalchemy.testing import fixtures
+import pytest
+from sqlalchemy import Table, Column, MetaData, event, exc, select, testing, text
+from sqlalchemy.testing import engines, fixtures
 from sqlalchemy.types import Integer
 import threading
+import time
 from sqlalchemy.orm import sessionmaker, scoped_session
 
-
-from sqlalchemy_cockroachdb import run_transaction
-from sqlalchemy_cockroachdb.transaction import ChainTransaction
+from sqlalchemy_cockroachdb import run_transaction, run_transactions
+from sqlalchemy_cockroachdb.metrics import MetricsCollector
+from sqlalchemy_cockroachdb.retry import ConcurrencyLimiter, ContentionLocks, PriorityPolicy
+from sqlalchemy_cockroachdb.transaction import (
+    ChainTransaction,
+    StatementBatch,
+    TransactionTimeoutError,
+)
 
 meta = MetaData()
 
@@ -154,6 +161,275 @@ class RunTransactionCoreTest(BaseRunTransactionTest):
             rs = run_transaction(conn, txn_body, use_cockroach_restart=False)
             assert rs[0] == (1, 100)
 
+    def test_run_transaction_listeners(self):
+        def txn_body(conn):
+            conn.execute(text("select acct, balance from account where acct = 1"))
+            if conn.dialect._is_v261plus:
+                conn.execute(text("SET allow_unsafe_internals = true"))
+            conn.execute(text("select crdb_internal.force_retry('1s')"))
+
+        collector = MetricsCollector()
+        with testing.db.connect() as conn:
+            run_transaction(
+                conn, txn_body, max_backoff=0.1, listeners=[collector], name="force_retry"
+            )
+        metrics = collector.snapshot()["force_retry"]
+        assert metrics["committed"] == 1
+        assert metrics["retries"]["40001"] > 0
+
+    def test_run_transaction_callback_error(self):
+        # Errors of the callback end the transaction and reach the listeners.
+        def txn_body(conn):
+            conn.execute(text("select 1"))
+            raise ValueError("not retried")
+
+        collector = MetricsCollector()
+        limiter = ConcurrencyLimiter(window=1)
+        with testing.db.connect() as conn:
+            for transactor, kwargs in [
+                (conn, {}),
+                (testing.db, dict(limiter=limiter)),
+                (testing.db, dict(read_only=True)),
+                (testing.db, dict(implicit=True)),
+            ]:
+                with pytest.raises(ValueError, match="not retried"):
+                    run_transaction(transactor, txn_body, listeners=[collector], **kwargs)
+        metrics = collector.totals()
+        assert (metrics["committed"], metrics["failed"]) == (0, 4)
+        assert metrics["attempts"] == {1: 4}
+        # The limiter saw the transaction complete without retries.
+        assert limiter.stats()["increases"] == 1
+
+    def test_run_transaction_priority(self):
+        def txn_body(conn):
+            conn.execute(text("select acct, balance from account where acct = 1"))
+            if conn.dialect._is_v261plus:
+                conn.execute(text("SET allow_unsafe_internals = true"))
+            conn.execute(text("select crdb_internal.force_retry('1s')"))
+
+        collector = MetricsCollector()
+        with testing.db.connect() as conn:
+            run_transaction(
+                conn,
+                txn_body,
+                max_backoff=0.1,
+                listeners=[collector],
+                name="force_retry",
+                priority=PriorityPolicy(initial="LOW", escalate_after=1),
+            )
+        metrics = collector.snapshot()["force_retry"]
+        assert metrics["committed"] == 1
+        assert metrics["escalations"] == {"NORMAL": 1, "HIGH": 1}
+
+    def test_run_transaction_max_retries_with_priority(self):
+        # max_retries counts the retries of the whole call, not those made
+        # at each priority.
+        calls = []
+
+        def txn_body(conn):
+            calls.append(1)
+            orig = Exception("restart transaction")
+            orig.pgcode = orig.sqlstate = "40001"
+            raise exc.DBAPIError("SELECT 1", {}, orig)
+
+        collector = MetricsCollector()
+        with testing.db.connect() as conn:
+            with pytest.raises(exc.DBAPIError, match="restart transaction"):
+                run_transaction(
+                    conn,
+                    txn_body,
+                    max_retries=5,
+                    max_backoff=0,
+                    listeners=[collector],
+                    priority=PriorityPolicy(escalate_after=3),
+                )
+        assert len(calls) == 6
+        metrics = collector.totals()
+        assert metrics["attempts"] == {6: 1}
+        assert metrics["escalations"] == {"HIGH": 1}
+
+    def test_run_transaction_read_only(self):
+        # Let the rows inserted by setup_method() become visible in the past.
+        time.sleep(0.1)
+        with testing.db.connect() as conn:
+            balances = run_transaction(conn, self.get_balances, as_of="-50ms")
+            assert balances == [100, 100]
+            collector = MetricsCollector()
+            balances = run_transaction(
+                conn, self.get_balances, as_of="-50ms", inject_error=True, listeners=[collector]
+            )
+            assert balances == [100, 100]
+            assert collector.totals()["attempts"] == {2: 1}
+
+    def test_run_transaction_timeout(self):
+        def txn_body(conn):
+            conn.execute(text("select pg_sleep(5)"))
+
+        with testing.db.connect() as conn:
+            start = time.monotonic()
+            with pytest.raises(TransactionTimeoutError, match=r"deadline \(1 attempts") as e:
+                run_transaction(conn, txn_body, timeout=0.5)
+            assert e.value.attempts == 1
+            assert time.monotonic() - start < 2
+            # statement_timeout was only set for the transaction.
+            assert conn.execute(text("select pg_sleep(0.6)")) is not None
+
+    def test_run_transaction_release_and_commit(self):
+        engine = engines.testing_engine()
+        statements = []
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def before_cursor_execute(conn, cursor, statement, *arg):
+            statements.append(statement)
+
+        def txn_body(conn):
+            conn.execute(
+                account_table.update().where(account_table.c.acct == 1).values(balance=0)
+            )
+
+        with engine.connect() as conn:
+            run_transaction(conn, txn_body)
+        if engine.dialect._supports_release_and_commit:
+            assert statements[-1] == "RELEASE SAVEPOINT cockroach_restart; COMMIT"
+        else:
+            assert statements[-1] == "RELEASE SAVEPOINT cockroach_restart"
+        with testing.db.connect() as conn:
+            assert self.get_balances(conn) == [0, 100]
+
+    def test_run_transaction_isolation_aware(self):
+        engine = engines.testing_engine(options=dict(isolation_level="READ COMMITTED"))
+        statements = []
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def before_cursor_execute(conn, cursor, statement, *arg):
+            statements.append(statement)
+
+        def txn_body(conn):
+            conn.execute(
+                account_table.update().where(account_table.c.acct == 1).values(balance=0)
+            )
+
+        with engine.connect() as conn:
+            run_transaction(conn, txn_body, isolation_aware=True)
+        assert not any("SAVEPOINT" in statement for statement in statements)
+        with testing.db.connect() as conn:
+            assert self.get_balances(conn) == [0, 100]
+
+    def test_run_transaction_reconnect(self):
+        engine = engines.testing_engine()
+        collector = MetricsCollector()
+        calls = []
+
+        def txn_body(conn):
+            calls.append(conn.connection.dbapi_connection)
+            if len(calls) == 1:
+                # The node went away under the transaction.
+                conn.connection.dbapi_connection.close()
+            conn.execute(
+                account_table.update().where(account_table.c.acct == 1).values(balance=0)
+            )
+
+        run_transaction(engine, txn_body, listeners=[collector])
+        assert len(calls) == 2 and calls[0] is not calls[1]
+        metrics = collector.totals()
+        assert metrics["committed"] == 1 and metrics["failed"] == 0
+        assert metrics["attempts"] == {2: 1}
+        with testing.db.connect() as conn:
+            assert self.get_balances(conn) == [0, 100]
+
+        calls.clear()
+        with pytest.raises(exc.DBAPIError, match="closed") as e:
+            run_transaction(engine, txn_body, max_retries=0)
+        assert e.value.connection_invalidated
+
+    def test_run_transaction_contention_key(self):
+        locks = ContentionLocks()
+
+        def txn_body(conn):
+            conn.execute(
+                account_table.update()
+                .where(account_table.c.acct == 1)
+                .values(balance=account_table.c.balance + 1)
+            )
+            time.sleep(0.02)
+
+        batch = run_transactions(
+            testing.db,
+            [txn_body] * 4,
+            workers=4,
+            contention_key=("account", 1),
+            contention_locks=locks,
+        )
+        assert batch.stats["committed"] == 4
+        assert batch.stats["lock_waits"] == locks.waits > 0
+        assert locks.acquisitions == 4
+        with testing.db.connect() as conn:
+            assert self.get_balances(conn) == [104, 100]
+
+    def test_run_transaction_limiter(self):
+        limiter = ConcurrencyLimiter(initial_limit=2, window=8)
+        in_flight = []
+
+        def txn_body(conn):
+            in_flight.append(limiter.in_flight)
+            conn.execute(
+                account_table.update()
+                .where(account_table.c.acct == 2)
+                .values(balance=account_table.c.balance + 1)
+            )
+            time.sleep(0.01)
+
+        batch = run_transactions(testing.db, [txn_body] * 8, workers=4, limiter=limiter)
+        assert batch.stats["committed"] == 8
+        assert max(in_flight) <= 2
+        stats = limiter.stats()
+        assert (stats["in_flight"], stats["queue_depth"]) == (0, 0)
+        assert stats["limit"] == 3 and stats["waits"] > 0
+        with testing.db.connect() as conn:
+            assert self.get_balances(conn) == [100, 108]
+
+    def test_run_transactions(self):
+        def deposit(acct):
+            def txn_body(conn):
+                conn.execute(
+                    account_table.update()
+                    .where(account_table.c.acct == acct)
+                    .values(balance=account_table.c.balance + 1)
+                )
+                return acct
+
+            return txn_body
+
+        batch = run_transactions(testing.db, [deposit(1 + i % 2) for i in range(20)], workers=4)
+        assert batch.results == [1 + i % 2 for i in range(20)]
+        assert batch.stats["committed"] == 20
+        with testing.db.connect() as conn:
+            assert self.get_balances(conn) == [110, 110]
+
+    def test_run_transaction_implicit(self):
+        def txn_body(conn):
+            return conn.execute(
+                account_table.update()
+                .where(account_table.c.acct == 1)
+                .values(balance=account_table.c.balance - 10)
+            ).rowcount
+
+        assert run_transaction(testing.db, txn_body, implicit=True) == 1
+        assert run_transaction(testing.db, txn_body, implicit=True, inject_error=True) == 1
+        with pytest.raises(ValueError, match="priority can't be used with implicit=True"):
+            run_transaction(testing.db, txn_body, implicit=True, priority="HIGH")
+        batch = StatementBatch(
+            [
+                account_table.update().where(account_table.c.acct == 2).values(balance=120),
+                "UPDATE account SET balance = balance - 10 WHERE acct = 2",
+            ]
+        )
+        with testing.db.connect() as conn:
+            run_transaction(conn, batch, implicit=True)
+            assert not conn.in_transaction()
+            assert conn.get_isolation_level() != "AUTOCOMMIT"
+            assert self.get_balances(conn) == [80, 110]
+
     def test_run_chained_transaction(self):
         def txn_body(conn):
             # first transaction inserts
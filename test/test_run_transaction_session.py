@@ -1,5 +1,5 @@
 from concurrent.futures import ThreadPoolExecutor
-from sqlalchemy import Column, DateTime, func, Integer, select, testing, text
+from sqlalchemy import Column, DateTime, func, inspect, Integer, select, testing, text
 from sqlalchemy.orm import Session, sessionmaker
 from sqlalchemy.testing import fixtures
 import threading
@@ -120,6 +120,30 @@ class RunTransactionSessionTest(BaseRunTransactionTest):
         rs = run_transaction(Session, txn_body)
         assert rs[0] == (1, 100)
 
+    def test_run_transaction_restore_session_state(self):
+        Account = self.classes.Account
+        loaded = []
+
+        session = Session(testing.db, expire_on_commit=False)
+        account = session.get(Account, 1)
+        session.commit()
+
+        def txn_body(sess):
+            # The retries find the balance that the account had before them.
+            loaded.append(inspect(account).dict.get("balance"))
+            account.balance -= 10
+            sess.flush()
+            if sess.bind.dialect._is_v261plus:
+                sess.execute(text("SET allow_unsafe_internals = true"))
+            sess.execute(text("select crdb_internal.force_retry('1s')"))
+
+        run_transaction(session, txn_body, max_backoff=0.1, restore_session_state=True)
+        session.close()
+        assert len(loaded) > 1
+        assert loaded == [100] * len(loaded)
+        with testing.db.connect() as conn:
+            assert self.get_balances(conn) == [90, 100]
+
 
 class InsertReturningTest(fixtures.DeclarativeMappedTest):
     @classmethod
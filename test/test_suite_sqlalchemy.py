@@ -5,7 +5,6 @@ from sqlalchemy.testing.suite import (
     ComponentReflectionTest as _ComponentReflectionTest,
 )
 from sqlalchemy.testing.suite import HasIndexTest as _HasIndexTest
-from sqlalchemy.testing.suite import HasTableTest as _HasTableTest
 from sqlalchemy.testing.suite import IntegerTest as _IntegerTest
 from sqlalchemy.testing.suite import InsertBehaviorTest as _InsertBehaviorTest
 from sqlalchemy.testing.suite import IsolationLevelTest as _IsolationLevelTest
@@ -425,12 +424,6 @@ class HasIndexTest(_HasIndexTest):
         pass
 
 
-class HasTableTest(_HasTableTest):
-    @skip("cockroachdb")
-    def test_has_table_cache(self):
-        pass
-
-
 class InsertBehaviorTest(_InsertBehaviorTest):
     @skip("cockroachdb")
     def test_no_results_for_non_returning_insert(self):